@@ -0,0 +1,201 @@
+# admission_control.py
+"""
+Admission control for the AITA Interaction Service's generation endpoints.
+
+At most `max_concurrent` turns run inside the inference pipeline at once. Further turns wait in a
+bounded priority queue instead of all piling onto the model and timing out together:
+- live student turns ("student") are admitted ahead of teacher previews ("teacher_preview"),
+  which go ahead of bulk traffic ("bulk"); requests of the same class are served in arrival order;
+- when the queue is full, a new request is rejected at once with an `AdmissionRejectedError` and a
+  suggested Retry-After, unless it outranks a queued request. The lowest-priority, most recent
+  queued request is then shed (rejected) to make room;
+- a request that has waited `max_wait_s` without being admitted is rejected as well.
+
+The Retry-After estimate is the time the current queue needs to drain at the recent average
+service time. `snapshot()` reports in-flight and queued counts per class, rejection counters and
+queue-wait percentiles.
+
+All methods must be called from the event loop; none of them block.
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import math
+import statistics
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from model_loader_utils import DefaultLogger
+
+# Request class -> priority (lower is admitted first).
+REQUEST_CLASS_PRIORITIES: Dict[str, int] = {"student": 0, "teacher_preview": 1, "bulk": 2}
+DEFAULT_SERVICE_SECONDS = 5.0 # Retry-After basis until a turn has completed.
+MAX_RETRY_AFTER_SECONDS = 120
+
+
+class AdmissionRejectedError(Exception):
+    """`reason` is "queue_full", "shed" or "queue_timeout"; `retry_after_s` is a whole number of seconds."""
+    def __init__(self, reason: str, retry_after_s: int):
+        super().__init__(f"Request not admitted ({reason.replace('_', ' ')}); retry after {retry_after_s}s.")
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+class AdmissionTicket:
+    """A granted slot; pass it back to `release` exactly once (repeat calls are ignored)."""
+    def __init__(self, request_class: str, queue_wait_s: float):
+        self.request_class = request_class
+        self.queue_wait_s = queue_wait_s
+        self.admitted_at = time.perf_counter()
+        self.released = False
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int = 16, max_queue_depth: int = 64, max_wait_s: float = 0.0, wait_samples: int = 1024, logger: Optional[Any] = None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue_depth = max(0, max_queue_depth)
+        self.max_wait_s = max_wait_s # 0 = wait until admitted.
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        self._in_flight = 0
+        self._waiters: List[Tuple[int, int, str, "asyncio.Future[None]"]] = [] # heap of (priority, arrival, class, future)
+        self._arrivals = itertools.count()
+        self._service_seconds: Optional[float] = None # Exponential moving average of admitted-turn durations.
+        self._wait_seconds: Dict[str, Deque[float]] = {name: deque(maxlen=wait_samples) for name in REQUEST_CLASS_PRIORITIES}
+        self.stats: Dict[str, int] = {"admitted": 0, "admitted_after_queueing": 0, "rejected_queue_full": 0, "rejected_shed": 0, "rejected_queue_timeout": 0}
+
+    # --- Admission ---
+    async def acquire(self, request_class: str = "student", max_wait_s: Optional[float] = None) -> AdmissionTicket:
+        """
+        Waits for a slot and returns its ticket, or raises `AdmissionRejectedError`. `max_wait_s`
+        (e.g. the turn's remaining deadline) tightens the controller's own queue timeout.
+        """
+        priority = self.priority_of(request_class)
+        queued_at = time.perf_counter()
+        if self._in_flight < self.max_concurrent and not self._waiters:
+            self._in_flight += 1
+            return self._admit(request_class, queued_at)
+
+        if len(self._waiters) >= self.max_queue_depth:
+            self.raise_if_full(request_class)
+            self._shed_lowest() # The newcomer outranks someone in the full queue.
+        entry = (priority, next(self._arrivals), request_class, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        timeouts = [t for t in (self.max_wait_s or None, max_wait_s) if t is not None]
+        try:
+            # A shed entry's future raises AdmissionRejectedError here.
+            await asyncio.wait_for(asyncio.shield(entry[3]), min(timeouts) if timeouts else None)
+        except asyncio.TimeoutError:
+            if self._abandon(entry):
+                self.stats["rejected_queue_timeout"] += 1
+                raise AdmissionRejectedError("queue_timeout", self.retry_after_seconds())
+            if entry[3].exception() is not None:
+                raise entry[3].exception()
+            # Granted at the same moment it timed out: keep the slot.
+        except asyncio.CancelledError:
+            if not self._abandon(entry) and not entry[3].cancelled() and entry[3].exception() is None:
+                self._hand_over_slot() # Granted, but nobody will use it.
+            raise
+        self.stats["admitted_after_queueing"] += 1
+        return self._admit(request_class, queued_at)
+
+    def release(self, ticket: AdmissionTicket):
+        if ticket.released:
+            return
+        ticket.released = True
+        duration_s = time.perf_counter() - ticket.admitted_at
+        self._service_seconds = duration_s if self._service_seconds is None else 0.8 * self._service_seconds + 0.2 * duration_s
+        self._hand_over_slot()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, request_class: str = "student", max_wait_s: Optional[float] = None):
+        """`async with controller.admit(...) as ticket:` holds a slot for the block."""
+        ticket = await self.acquire(request_class, max_wait_s)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def raise_if_full(self, request_class: str = "student"):
+        """Raises the "queue_full" rejection `acquire` would raise right now, without queueing or shedding anything."""
+        priority = self.priority_of(request_class)
+        if self._in_flight < self.max_concurrent and not self._waiters:
+            return
+        if len(self._waiters) >= self.max_queue_depth and not (self._waiters and max(self._waiters)[0] > priority):
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejectedError("queue_full", self.retry_after_seconds())
+
+    # --- Metrics ---
+    def retry_after_seconds(self) -> int:
+        service_s = self._service_seconds if self._service_seconds is not None else DEFAULT_SERVICE_SECONDS
+        drain_s = service_s * (len(self._waiters) + 1) / self.max_concurrent
+        return int(min(MAX_RETRY_AFTER_SECONDS, max(1, math.ceil(drain_s))))
+
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def snapshot(self) -> Dict[str, Any]:
+        queued_by_class = {name: 0 for name in REQUEST_CLASS_PRIORITIES}
+        for _, _, request_class, _ in self._waiters:
+            queued_by_class[request_class] += 1
+        return {
+            "in_flight": self._in_flight, "max_concurrent": self.max_concurrent,
+            "queue_depth": len(self._waiters), "max_queue_depth": self.max_queue_depth, "queue_depth_by_class": queued_by_class,
+            "max_wait_s": self.max_wait_s, "mean_service_seconds": self._service_seconds, "retry_after_s": self.retry_after_seconds(),
+            "queue_wait_seconds": {name: summarize_waits(samples) for name, samples in self._wait_seconds.items()},
+            **self.stats,
+        }
+
+    @staticmethod
+    def priority_of(request_class: str) -> int:
+        if request_class not in REQUEST_CLASS_PRIORITIES:
+            raise ValueError(f"Unknown request class '{request_class}'. Expected one of {tuple(REQUEST_CLASS_PRIORITIES)}.")
+        return REQUEST_CLASS_PRIORITIES[request_class]
+
+    # --- Internals ---
+    def _admit(self, request_class: str, queued_at: float) -> AdmissionTicket:
+        ticket = AdmissionTicket(request_class, time.perf_counter() - queued_at)
+        self._wait_seconds[request_class].append(ticket.queue_wait_s)
+        self.stats["admitted"] += 1
+        return ticket
+
+    def _shed_lowest(self):
+        """Rejects the lowest-priority, most recently queued waiter to free its queue place."""
+        lowest = max(self._waiters)
+        self._remove(lowest)
+        lowest[3].set_exception(AdmissionRejectedError("shed", self.retry_after_seconds()))
+        self.stats["rejected_shed"] += 1
+        self.logger.info(f"Admission: shed a queued '{lowest[2]}' request to admit a higher-priority one.")
+
+    def _hand_over_slot(self):
+        """Gives a freed slot to the highest-priority live waiter, or returns it to the pool."""
+        while self._waiters:
+            _, _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None) # The slot passes to this waiter; `_in_flight` is unchanged.
+                return
+        self._in_flight -= 1
+
+    def _abandon(self, entry: Tuple[int, int, str, "asyncio.Future[None]"]) -> bool:
+        """Removes a still-queued entry; False if it had already been granted a slot or shed."""
+        if entry[3].done():
+            return False
+        self._remove(entry)
+        entry[3].cancel()
+        return True
+
+    def _remove(self, entry: Tuple[int, int, str, "asyncio.Future[None]"]):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+
+
+def summarize_waits(samples: Deque[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "max": None}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered), "mean": round(statistics.fmean(ordered), 4), "p50": round(ordered[len(ordered) // 2], 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 4), "max": round(ordered[-1], 4),
+    }
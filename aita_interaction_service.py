@@ -1,18 +1,43 @@
 import uuid
-from fastapi import FastAPI, HTTPException
+import hashlib
+import asyncio
+import contextlib
+import threading
+import time
+from dataclasses import dataclass, field
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
-import torch
-# from transformers import AutoModelForCausalLM, AutoTokenizer # No longer directly needed here
-# from peft import PeftModel # No longer directly needed here
+from typing import List, Dict, Optional, Set, Any, Callable, AsyncIterator, Literal, TYPE_CHECKING
+# torch / transformers / peft (and generation_scheduler, which imports torch) are imported lazily by the
+# functions that use them, so the server starts accepting connections while they load in the background.
 import uvicorn
 from datetime import datetime
 import os
 import json
 
 # --- Import new utility ---
-from model_loader_utils import load_model_tokenizer_with_adapter, DefaultLogger
+from model_loader_utils import load_model_tokenizer_with_adapter, load_model_tokenizer_with_adapters, assisted_generation_kwargs, DefaultLogger, DummySLM
 # We'll use DefaultLogger from the utility if a more complex FastAPI/Uvicorn logger isn't set up globally
+from model_registry import ModelRegistry, RegistryEntry
+from kv_cache import PrefixKVCache, SessionKVCache, common_prefix_length
+from response_cache import ResponseCache
+from inference_executor import InferenceExecutor
+from service_readiness import ReadinessTracker, SERVING_STATES
+from request_cancellation import CancellationToken, GenerationCancelledError
+from service_storage import create_stores, UsernameTakenError
+from admission_control import AdmissionController, AdmissionRejectedError
+from moderation_batcher import ModerationMicroBatcher
+from moderation_cache import ModerationResultCache
+from moderation_prefilter import LexicalPrefilter
+from moderation_stream import StreamingOutputModerator
+from tutor_prompt import build_tutor_system_prompt
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from service_metrics import ComponentCollector, LATENCY_BUCKETS, RetiredTotals, TOKENS_PER_SECOND_BUCKETS, stats_families
+
+if TYPE_CHECKING:
+    import torch
+    from generation_scheduler import ContinuousBatchingScheduler, IncrementalDetokenizer
 
 # --- SDK Imports ---
 try:
@@ -28,9 +53,12 @@ try:
 except ImportError:
     print("WARNING: moderation_service.py not found. Moderation will be disabled.")
     class ModerationService:
-        def __init__(self, logger=None): self.logger = logger; print("INFO: Using DUMMY ModerationService.")
+        is_fallback = True
+        def __init__(self, logger=None, result_cache=None, **kwargs): self.logger = logger; print("INFO: Using DUMMY ModerationService.")
         def check_text(self, text:str) -> Dict[str, Any]:
             return {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": "dummy_moderation_disabled"}
+        def check_texts(self, texts: List[str]) -> List[Dict[str, Any]]:
+            return [self.check_text(text) for text in texts]
 
 # --- 1. Pydantic Models ---
 class UserProfileCreate(BaseModel):
@@ -53,6 +81,8 @@ class InteractionRequest(BaseModel):
     current_item_title: Optional[str] = None
     current_item_text_snippet: Optional[str] = None
     target_learning_objectives: Optional[List[Dict[str,str]]] = None
+    # Admission priority under load: live student turns first, then teacher previews, then bulk jobs.
+    request_class: Literal["student", "teacher_preview", "bulk"] = "student"
 
 class InteractionResponse(BaseModel):
     session_id: str
@@ -62,14 +92,123 @@ class InteractionResponse(BaseModel):
 # --- 2. FastAPI App Initialization & Global Configurations ---
 app = FastAPI(title="AITA Interaction Service", version="0.4.0") # Version bump for utility integration
 
-BASE_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+BASE_MODEL_ID = os.environ.get("AITA_BASE_MODEL_ID", "microsoft/Phi-3-mini-4k-instruct")
 XAPI_LOG_FILE_PATH = "service_xapi_statements.jsonl"
 
 ADAPTER_CONFIG: Dict[str, str] = {
     "ReadingExplorerAITA_4thGrade_Pilot1": "./adapters/reading_explorer_pilot1",
     "EcoExplorerAITA_7thGrade_Pilot1": "./adapters/eco_explorer_pilot1",
 }
-LOADED_MODELS_CACHE: Dict[str, Dict[str, Any]] = {}
+# Loaded models live in MODEL_REGISTRY (created below): an LRU cache bounded by this estimated
+# weight-memory budget (0 = unlimited) with single-flight loading per persona.
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("AITA_MODEL_MEMORY_BUDGET_MB", "0"))
+# Weight dtype for persona models: auto / bfloat16 / float16 / float32, or int8 (dynamic quantization, CPU only).
+MODEL_DTYPE = os.environ.get("AITA_MODEL_DTYPE", "auto")
+# Inference backend for persona models: "hf" (PyTorch), "onnx" (ONNX Runtime CPU graph with the adapter
+# merged in, exported on first load) or "dummy" (DummySLM). See inference_backends.py.
+INFERENCE_BACKEND = os.environ.get("AITA_INFERENCE_BACKEND", "hf")
+# Multi-adapter mode loads the base weights once and registers every ADAPTER_CONFIG adapter on
+# that single model; personas then share it and switch adapters with `set_adapter`. "hf" backend only.
+ENABLE_MULTI_ADAPTER = os.environ.get("AITA_MULTI_ADAPTER", "0") == "1" and INFERENCE_BACKEND == "hf"
+SHARED_MODEL_KEY = "__shared_base_with_adapters__"
+# When set, base weights are exported once under this directory and memory-mapped read-only by every
+# process that loads them (uvicorn --workers N, "process" executor workers), so they share one physical copy.
+# CPU and non-int8 models only; a tmpfs path such as /dev/shm/aita_weights keeps them in shared memory.
+SHARED_WEIGHTS_DIR = os.environ.get("AITA_SHARED_WEIGHTS_DIR") or None
+# Serializes adapter switches and forward passes on the shared multi-adapter model.
+SHARED_MODEL_LOCK = threading.Lock()
+
+# --- Generation Settings ---
+MAX_NEW_TOKENS = 300
+GENERATION_TEMPERATURE = 0.7
+GENERATION_TOP_P = 0.9
+# Deadline for a whole turn (queueing included). student_frontend_streamlit.py gives up after 60s, so
+# generation stops a little earlier and the turn is logged as timed out. 0 disables the deadline.
+REQUEST_TIMEOUT_S = float(os.environ.get("AITA_REQUEST_TIMEOUT_S", "55"))
+# How often a running /interact turn checks whether its client has disconnected.
+DISCONNECT_POLL_INTERVAL_S = 0.5
+# Continuous batching merges concurrent requests for the same persona into shared decode steps.
+ENABLE_CONTINUOUS_BATCHING = os.environ.get("AITA_CONTINUOUS_BATCHING", "1") == "1"
+MAX_BATCH_SIZE = int(os.environ.get("AITA_MAX_BATCH_SIZE", "8"))
+GENERATION_SCHEDULERS: Dict[str, "ContinuousBatchingScheduler"] = {}
+GENERATION_SCHEDULERS_LOCK = threading.Lock()
+# Schedulers of evicted models finish their in-flight jobs before their counters move to
+# RETIRED_METRIC_TOTALS; GET /metrics keeps reporting both so the summed counters never go backwards.
+DRAINING_SCHEDULERS: Set["ContinuousBatchingScheduler"] = set()
+RETIRED_METRIC_TOTALS = RetiredTotals()
+# Each scheduler keeps the KV state of recent shared system-prompt prefixes (per adapter), so
+# students on the same activity only prefill their own history and utterance. 0 entries disables it.
+PREFIX_CACHE_MAX_ENTRIES = int(os.environ.get("AITA_PREFIX_CACHE_ENTRIES", "32"))
+PREFIX_CACHE_MAX_MB = int(os.environ.get("AITA_PREFIX_CACHE_MB", "256"))
+# Per-session KV state kept between turns, so a new turn only prefills the new user message.
+# Shared by all schedulers; 0 MB disables it.
+SESSION_CACHE_MAX_MB = int(os.environ.get("AITA_SESSION_CACHE_MB", "512"))
+SESSION_CACHE_IDLE_TIMEOUT_S = float(os.environ.get("AITA_SESSION_IDLE_TIMEOUT_S", "900"))
+
+# --- Speculative Decoding Settings ---
+# Persona id -> draft model id for assisted (speculative) decoding, e.g.
+# AITA_DRAFT_MODELS='{"ReadingExplorerAITA_4thGrade_Pilot1": "<small model id>", "*": "<default draft>"}'.
+# The draft proposes a few tokens and the persona model verifies them in one forward pass, which cuts
+# per-reply latency on CPU. Personas with a draft generate one request at a time (no continuous batching).
+DRAFT_MODEL_CONFIG: Dict[str, str] = json.loads(os.environ.get("AITA_DRAFT_MODELS", "{}"))
+
+# --- Response Cache Settings ---
+# Optional cache of replies to repeated questions (same persona, passage/LO prompt and normalized
+# utterance). Only turns with at most RESPONSE_CACHE_MAX_HISTORY prior messages are cached/served.
+# A similarity below 1.0 opts into fuzzy matching of utterances with the same numbers and negations.
+ENABLE_RESPONSE_CACHE = os.environ.get("AITA_RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL_S = float(os.environ.get("AITA_RESPONSE_CACHE_TTL_S", "3600"))
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("AITA_RESPONSE_CACHE_SIMILARITY", "1.0"))
+RESPONSE_CACHE_MAX_HISTORY = int(os.environ.get("AITA_RESPONSE_CACHE_MAX_HISTORY", "0"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("AITA_RESPONSE_CACHE_ENTRIES", "1024"))
+
+# --- Executor Settings ---
+# "thread" runs blocking stages in a thread pool sharing this process's models;
+# "process" runs them in worker processes that each load and hold their own models.
+EXECUTOR_MODE = os.environ.get("AITA_EXECUTOR_MODE", "thread")
+EXECUTOR_WORKERS = int(os.environ.get("AITA_EXECUTOR_WORKERS", "4"))
+
+# --- Admission Control Settings ---
+# At most MAX_CONCURRENT_REQUESTS turns run at once; up to MAX_QUEUE_DEPTH more wait, students ahead of
+# teacher previews ahead of bulk. A turn arriving at a full queue (unless it can displace a lower-priority
+# one), or still queued after ADMISSION_QUEUE_TIMEOUT_S (0 = until its deadline), gets 503 + Retry-After.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("AITA_MAX_CONCURRENT_REQUESTS", "16"))
+MAX_QUEUE_DEPTH = int(os.environ.get("AITA_MAX_QUEUE_DEPTH", "64"))
+ADMISSION_QUEUE_TIMEOUT_S = float(os.environ.get("AITA_ADMISSION_QUEUE_TIMEOUT_S", "20"))
+
+# --- Moderation Settings ---
+# Moderation checks (input and output of every in-flight turn) arriving within MODERATION_BATCH_WINDOW_MS
+# of each other run as one batched classifier call of up to MODERATION_MAX_BATCH_SIZE texts.
+ENABLE_MODERATION_BATCHING = os.environ.get("AITA_MODERATION_BATCHING", "1") == "1"
+MODERATION_BATCH_WINDOW_MS = float(os.environ.get("AITA_MODERATION_BATCH_WINDOW_MS", "5"))
+MODERATION_MAX_BATCH_SIZE = int(os.environ.get("AITA_MODERATION_MAX_BATCH_SIZE", "32"))
+# How the classifier runs: "hf" (PyTorch pipeline) or "onnx" (ONNX Runtime, exported to AITA_ONNX_EXPORT_DIR on first
+# use); "int8" quantizes its weights for CPU. benchmark_moderation_backends.py compares their verdicts and throughput.
+MODERATION_BACKEND = os.environ.get("AITA_MODERATION_BACKEND", "hf")
+MODERATION_DTYPE = os.environ.get("AITA_MODERATION_DTYPE", "float32")
+# Texts longer than the classifier's input are classified in overlapping windows of up to AITA_MODERATION_WINDOW_TOKENS
+# tokens (unset = the classifier's limit, 0 = no windows, long texts are truncated), stopping at the first unsafe window.
+MODERATION_WINDOW_TOKENS = int(os.environ["AITA_MODERATION_WINDOW_TOKENS"]) if os.environ.get("AITA_MODERATION_WINDOW_TOKENS") else None
+MODERATION_WINDOW_OVERLAP_TOKENS = int(os.environ.get("AITA_MODERATION_WINDOW_OVERLAP_TOKENS", "64"))
+# Verdicts of recently moderated texts (repeated pastes, the fixed fallback replies) are reused instead of
+# re-running the classifier: LRU within an entry count and size cap, expiring after a TTL. 0 entries disables it.
+MODERATION_CACHE_MAX_ENTRIES = int(os.environ.get("AITA_MODERATION_CACHE_ENTRIES", "10000"))
+MODERATION_CACHE_MAX_MB = int(os.environ.get("AITA_MODERATION_CACHE_MB", "16"))
+MODERATION_CACHE_TTL_S = float(os.environ.get("AITA_MODERATION_CACHE_TTL_S", "3600"))
+# Lexical first tier, run in the event loop before a text is queued for the classifier: blocklist hits, and short texts
+# made only of everyday classroom words, are decided at once. The word lists in moderation_prefilter.py are replaced
+# by these files (one term per line) when set.
+ENABLE_MODERATION_PREFILTER = os.environ.get("AITA_MODERATION_PREFILTER", "1") == "1"
+MODERATION_BLOCKLIST_PATH = os.environ.get("AITA_MODERATION_BLOCKLIST_PATH") or None
+MODERATION_ALLOWLIST_PATH = os.environ.get("AITA_MODERATION_ALLOWLIST_PATH") or None
+# Streamed replies are moderated in chunks of about this many characters (cut at sentence ends) while they are
+# generated, and text is only streamed once its chunk is cleared; an unsafe chunk stops generation and is never sent.
+# 0 moderates the whole reply once it is decoded and sends it in one piece.
+OUTPUT_MODERATION_CHUNK_CHARS = int(os.environ.get("AITA_OUTPUT_MODERATION_CHUNK_CHARS", "200"))
+
+# --- Storage Settings ---
+# SQLite file for user profiles and LMS contexts (kept across restarts); unset keeps them in memory.
+USER_DB_PATH = os.environ.get("AITA_USER_DB_PATH") or None
 
 # --- Mock LMS Data ---
 DEFAULT_4TH_GRADE_PASSAGES: List[Dict[str, str]] = [
@@ -89,71 +228,414 @@ MOCK_DB: Dict[str, Any] = {
         "student001_Ecology_eco_passage_foodweb_001": {"student_id_anonymized": "student001", "subject": "Ecology", "current_item_id": "eco_passage_foodweb_001", "current_item_title": DEFAULT_7TH_GRADE_SCIENCE_PASSAGES[0]["title"], "current_item_text_snippet": get_passage_snippet(DEFAULT_7TH_GRADE_SCIENCE_PASSAGES[0]["text"]), "target_learning_objectives_for_activity": [{"lo_id": "SCI.7.ECO.LO1", "description": "Understand food webs."}]}
     }
 }
-USER_PROFILES_DB: Dict[str, UserProfile] = {}
 
 # --- Services & Loggers ---
-moderation_service: ModerationService
+moderation_service: Any = None # Set by load_moderation_component, or by init_process_worker inside each worker.
 service_logger = DefaultLogger() # Use DefaultLogger from utility, or integrate with Uvicorn's logger
+SERVICE_READINESS = ReadinessTracker(logger=service_logger)
+# Per process: in "process" executor mode every worker has its own.
+MODERATION_RESULT_CACHE = ModerationResultCache(
+    max_entries=MODERATION_CACHE_MAX_ENTRIES, max_bytes=MODERATION_CACHE_MAX_MB * 1024 * 1024,
+    ttl_s=MODERATION_CACHE_TTL_S, logger=service_logger
+) if MODERATION_CACHE_MAX_ENTRIES > 0 else None
+MODERATION_PREFILTER = LexicalPrefilter.from_files(
+    MODERATION_BLOCKLIST_PATH, MODERATION_ALLOWLIST_PATH, logger=service_logger
+) if ENABLE_MODERATION_PREFILTER else None
+RESPONSE_CACHE = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl_s=RESPONSE_CACHE_TTL_S,
+    similarity_threshold=RESPONSE_CACHE_SIMILARITY, logger=service_logger
+) if ENABLE_RESPONSE_CACHE else None
+# Profiles indexed by user id and username; LMS contexts by (user, subject, item) and by user.
+USER_STORE, LMS_CONTEXT_STORE = create_stores(USER_DB_PATH, logger=service_logger)
+LMS_CONTEXT_STORE.load(
+    (context["student_id_anonymized"], context["subject"], context.get("current_passage_id") or context.get("current_item_id"), context)
+    for context in MOCK_DB["student_activity_contexts"].values()
+)
 
 # --- 3. Model Loading Logic (Refactored) ---
-def get_model_and_tokenizer_for_persona(persona_id: str, base_model_id: str) -> tuple[Optional[Any], Optional[Any], Optional[torch.device]]:
-    if persona_id in LOADED_MODELS_CACHE:
-        service_logger.info(f"Returning cached model for persona: {persona_id}")
-        cached = LOADED_MODELS_CACHE[persona_id]
-        return cached["model"], cached["tokenizer"], cached["device"]
+def load_persona_entry(persona_id: str, base_model_id: str) -> Optional[RegistryEntry]:
+    """Loader used by MODEL_REGISTRY on a miss; returns None if the utility failed to load the model."""
+    if ENABLE_MULTI_ADAPTER:
+        service_logger.info(f"Loading shared base '{base_model_id}' with adapters for personas: {list(ADAPTER_CONFIG.keys())}")
+        model, tokenizer, device, adapter_names = load_model_tokenizer_with_adapters(
+            model_id=base_model_id, adapter_paths=ADAPTER_CONFIG, logger=service_logger,
+            trust_remote_code_flag=True, torch_dtype_str=MODEL_DTYPE, shared_weights_dir=SHARED_WEIGHTS_DIR
+        )
+    else:
+        service_logger.info(f"Attempting to load model for persona: {persona_id} (base: {base_model_id})")
+        # Call the shared utility
+        # trust_remote_code_flag and torch_dtype_str can be global configs or defaults in the utility
+        model, tokenizer, device = load_model_tokenizer_with_adapter(
+            model_id=base_model_id,
+            adapter_path=ADAPTER_CONFIG.get(persona_id),
+            logger=service_logger,
+            trust_remote_code_flag=True, # Default from utility
+            torch_dtype_str=MODEL_DTYPE, # "auto" by default; "int8" for quantized CPU nodes
+            shared_weights_dir=SHARED_WEIGHTS_DIR,
+            backend=INFERENCE_BACKEND
+        )
+        adapter_names = []
+
+    if model and tokenizer and device:
+        service_logger.info(f"Model & tokenizer for persona '{persona_id}' loaded and cached.")
+        return {"model": model, "tokenizer": tokenizer, "device": device, "adapter_names": adapter_names}
+    service_logger.error(f"Failed to load model/tokenizer for persona '{persona_id}' using utility.")
+    return None
+
+def on_model_evicted(registry_key: str, entry: RegistryEntry):
+    # Let the evicted model's scheduler finish its in-flight jobs, then drop it so the weights can be freed.
+    with GENERATION_SCHEDULERS_LOCK:
+        scheduler = GENERATION_SCHEDULERS.pop(registry_key, None)
+        if scheduler:
+            DRAINING_SCHEDULERS.add(scheduler)
+    if scheduler:
+        scheduler.close(on_drained=retire_scheduler_metrics)
+        if SESSION_KV_CACHE is not None:
+            SESSION_KV_CACHE.discard(lambda namespace: namespace[0] == scheduler.name)
 
-    service_logger.info(f"Attempting to load model for persona: {persona_id} (base: {base_model_id})")
+def retire_scheduler_metrics(scheduler: "ContinuousBatchingScheduler"):
+    # Runs on the scheduler's thread once its last job is done; its counters are final.
+    with GENERATION_SCHEDULERS_LOCK:
+        DRAINING_SCHEDULERS.discard(scheduler)
+        RETIRED_METRIC_TOTALS.retire("scheduler", scheduler.stats)
+        if scheduler.prefix_cache is not None:
+            RETIRED_METRIC_TOTALS.retire("prefix_cache", scheduler.prefix_cache.snapshot())
 
-    adapter_path_for_persona = ADAPTER_CONFIG.get(persona_id)
+SESSION_KV_CACHE = SessionKVCache(
+    max_bytes=SESSION_CACHE_MAX_MB * 2**20, idle_timeout_s=SESSION_CACHE_IDLE_TIMEOUT_S, logger=service_logger
+) if SESSION_CACHE_MAX_MB > 0 else None
+
+MODEL_REGISTRY = ModelRegistry(
+    memory_budget_bytes=MODEL_MEMORY_BUDGET_MB * 2**20, logger=service_logger, on_evict=on_model_evicted
+)
+
+def get_registry_key(persona_id: str) -> str:
+    return SHARED_MODEL_KEY if ENABLE_MULTI_ADAPTER else persona_id
+
+def get_model_and_tokenizer_for_persona(persona_id: str, base_model_id: str) -> tuple[Optional[Any], Optional[Any], Optional["torch.device"]]:
+    entry = MODEL_REGISTRY.get_or_load(get_registry_key(persona_id), lambda: load_persona_entry(persona_id, base_model_id))
+    if not entry:
+        return None, None, None
+    return entry["model"], entry["tokenizer"], entry["device"]
 
-    # Call the shared utility
-    # trust_remote_code_flag and torch_dtype_str can be global configs or defaults in the utility
+def get_adapter_name_for_persona(persona_id: str) -> Optional[str]:
+    """The adapter to activate for a persona on the shared model, or None for the plain base model."""
+    entry = MODEL_REGISTRY.peek(SHARED_MODEL_KEY) if ENABLE_MULTI_ADAPTER else None
+    if not entry:
+        return None
+    return persona_id if persona_id in entry["adapter_names"] else None
+
+@contextlib.contextmanager
+def persona_adapter_context(model: Any, persona_id: str):
+    """
+    Activates the persona's adapter on the shared model for the duration of a `generate` call.
+    The active adapter is model-wide state, so SHARED_MODEL_LOCK is held for the whole call: in
+    multi-adapter mode unbatched generations (AITA_CONTINUOUS_BATCHING=0) run one at a time.
+    The continuous-batching scheduler only takes the lock per forward pass.
+    """
+    if not ENABLE_MULTI_ADAPTER or not hasattr(model, "set_adapter"):
+        yield
+        return
+    adapter_name = get_adapter_name_for_persona(persona_id)
+    with SHARED_MODEL_LOCK:
+        if adapter_name is None:
+            with model.disable_adapter():
+                yield
+        else:
+            model.set_adapter(adapter_name)
+            yield
+
+def get_draft_model_id(persona_id: str) -> Optional[str]:
+    if INFERENCE_BACKEND != "hf": # Assisted decoding needs the draft and persona models in PyTorch.
+        return None
+    return DRAFT_MODEL_CONFIG.get(persona_id, DRAFT_MODEL_CONFIG.get("*"))
+
+def load_draft_entry(draft_model_id: str, target_tokenizer: Any) -> Optional[RegistryEntry]:
+    service_logger.info(f"Loading draft model '{draft_model_id}' for assisted decoding...")
     model, tokenizer, device = load_model_tokenizer_with_adapter(
-        model_id=base_model_id,
-        adapter_path=adapter_path_for_persona,
-        logger=service_logger,
-        trust_remote_code_flag=True, # Default from utility
-        torch_dtype_str="auto" # Default from utility
+        model_id=draft_model_id, adapter_path=None, logger=service_logger, trust_remote_code_flag=True, torch_dtype_str=MODEL_DTYPE,
+        shared_weights_dir=SHARED_WEIGHTS_DIR
     )
+    if not model or not device:
+        service_logger.error(f"Failed to load draft model '{draft_model_id}'. Its personas will generate without assistance.")
+        return None
+    return {"model": model, "tokenizer": tokenizer, "device": device, "generation_kwargs": assisted_generation_kwargs(model, tokenizer, target_tokenizer)}
 
-    if model and tokenizer and device:
-        LOADED_MODELS_CACHE[persona_id] = {"model": model, "tokenizer": tokenizer, "device": device}
-        service_logger.info(f"Model & tokenizer for persona '{persona_id}' loaded and cached.")
-        return model, tokenizer, device
-    else:
-        service_logger.error(f"Failed to load model/tokenizer for persona '{persona_id}' using utility.")
-        return None, None, None
+def get_assisted_generation_kwargs(persona_id: str, target_tokenizer: Any) -> Dict[str, Any]:
+    """`generate()` kwargs that enable assisted decoding for the persona, or {} when it has no (loadable) draft model."""
+    draft_model_id = get_draft_model_id(persona_id)
+    if not draft_model_id:
+        return {}
+    entry = MODEL_REGISTRY.get_or_load(f"draft::{draft_model_id}", lambda: load_draft_entry(draft_model_id, target_tokenizer))
+    return entry["generation_kwargs"] if entry else {}
 
-@app.on_event("startup")
-async def startup_event():
-    global moderation_service # Ensure we're assigning to the global instance
-    service_logger.info("Service Startup: Initializing Moderation Service...")
+def get_generation_scheduler(persona_id: str, base_model_id: str) -> Optional["ContinuousBatchingScheduler"]:
+    from generation_scheduler import ContinuousBatchingScheduler
+    # Schedulers share the registry key of the model they drive, so eviction can close the right one.
+    scheduler_key = get_registry_key(persona_id)
+    model, tokenizer, device = get_model_and_tokenizer_for_persona(persona_id, base_model_id)
+    if not model or not tokenizer or not device:
+        return None
+    with GENERATION_SCHEDULERS_LOCK:
+        scheduler = GENERATION_SCHEDULERS.get(scheduler_key)
+        if scheduler is None or scheduler.model is not model:
+            scheduler = ContinuousBatchingScheduler(
+                model, tokenizer, device, max_batch_size=MAX_BATCH_SIZE,
+                temperature=GENERATION_TEMPERATURE, top_p=GENERATION_TOP_P, do_sample=True,
+                logger=service_logger, name=f"scheduler[{scheduler_key}]",
+                adapter_switching=ENABLE_MULTI_ADAPTER and hasattr(model, "set_adapter"),
+                model_lock=SHARED_MODEL_LOCK if ENABLE_MULTI_ADAPTER else None,
+                prefix_cache=PrefixKVCache(max_entries=PREFIX_CACHE_MAX_ENTRIES, max_bytes=PREFIX_CACHE_MAX_MB * 2**20, logger=service_logger) if PREFIX_CACHE_MAX_ENTRIES > 0 else None,
+                session_cache=SESSION_KV_CACHE
+            )
+            GENERATION_SCHEDULERS[scheduler_key] = scheduler
+        return scheduler
+
+class ModelUnavailableError(RuntimeError):
+    pass
+
+# --- Interaction Pipeline Stages ---
+# Blocking, module-level functions so they can run in either executor mode. In "process"
+# mode they execute inside a worker, where the globals below belong to that worker.
+def build_moderation_service() -> Any:
     try:
-        moderation_service = ModerationService(logger=service_logger)
+        service = ModerationService(
+            logger=service_logger, result_cache=MODERATION_RESULT_CACHE, backend=MODERATION_BACKEND, torch_dtype_str=MODERATION_DTYPE,
+            window_tokens=MODERATION_WINDOW_TOKENS, window_overlap_tokens=MODERATION_WINDOW_OVERLAP_TOKENS
+        )
         service_logger.info("Moderation Service initialized successfully.")
+        return service
     except Exception as e:
         service_logger.error(f"Failed to initialize real ModerationService: {e}. Using DUMMY service.", exc_info=True)
         class _DummyModService: # Renamed to avoid potential conflicts if moderation_service.py also defines DummyModerationService
+            is_fallback = True
             def __init__(self, logger=None): self.logger = logger; service_logger.info("Using _DummyModService.")
             def check_text(self, text:str) -> Dict[str, Any]:
                 return {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": "dummy_moderation_startup_failed"}
-        moderation_service = _DummyModService(logger=service_logger)
+            def check_texts(self, texts: List[str]) -> List[Dict[str, Any]]:
+                return [self.check_text(text) for text in texts]
+        return _DummyModService(logger=service_logger)
 
-    service_logger.info("Service Startup: Pre-loading default base model ('default_phi3_base')...")
+def init_process_worker():
+    """Initializer for "process" executor workers: each worker holds its own moderation model and base model."""
+    global moderation_service
+    moderation_service = build_moderation_service()
     get_model_and_tokenizer_for_persona("default_phi3_base", BASE_MODEL_ID)
 
+def moderate_text(text: str) -> Dict[str, Any]:
+    return moderation_service.check_text(text)
+
+def moderate_texts(texts: List[str]) -> List[Dict[str, Any]]:
+    return moderation_service.check_texts(texts)
+
+async def run_moderation_batch(texts: List[str]) -> List[Dict[str, Any]]:
+    return await inference_executor.run(moderate_texts, texts)
+
+async def run_moderation(text: str) -> Dict[str, Any]:
+    """
+    Moderates `text` in the executor, first waiting for the moderation model if it is still loading in the background.
+    With moderation batching, the check joins concurrent ones in a single classifier call. Texts the lexical
+    prefilter can decide are answered at once, without the model, the batching window or the executor.
+    """
+    if MODERATION_PREFILTER is not None:
+        verdict = MODERATION_PREFILTER.decide(text)
+        if verdict is not None:
+            return verdict
+    state = await SERVICE_READINESS.wait("moderation")
+    if state not in SERVING_STATES:
+        # The component failed (e.g. the inference runtime it depends on did not import): answer like the dummy service does.
+        service_logger.warning(f"Moderation is '{state}'; using the dummy moderation verdict.")
+        return {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": "dummy_moderation_unavailable"}
+    if MODERATION_BATCHER is not None:
+        return await MODERATION_BATCHER.check_text(text)
+    return await inference_executor.run(moderate_text, text)
+
+def prepare_prompt(persona_id: str, messages: List[Dict[str, str]]) -> tuple[str, List[int], str, int, Dict[str, float]]:
+    """
+    Applies the chat template and tokenizes. Returns (prompt_text, prompt_ids, model_name, shared_prefix_len, stage_seconds),
+    where the first `shared_prefix_len` prompt ids encode the system prompt shared by everyone on the activity and
+    `stage_seconds` holds the "templating" and "tokenization" times.
+    """
+    model, tokenizer, device = get_model_and_tokenizer_for_persona(persona_id, BASE_MODEL_ID)
+    if not model or not tokenizer or not device:
+        raise ModelUnavailableError(f"Model resources for persona '{persona_id}' are not available.")
+    timer = StageTimer()
+    with timer.stage("templating"):
+        prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    with timer.stage("tokenization"):
+        prompt_ids = tokenizer(prompt_text, return_tensors="pt", add_special_tokens=True).input_ids[0].tolist()
+    shared_prefix_len = 0
+    if PREFIX_CACHE_MAX_ENTRIES > 0 and messages and messages[0]["role"] == "system":
+        with timer.stage("templating", accumulate=True):
+            system_text = tokenizer.apply_chat_template(messages[:1], tokenize=False, add_generation_prompt=False)
+        with timer.stage("tokenization", accumulate=True):
+            system_ids = tokenizer(system_text, return_tensors="pt", add_special_tokens=True).input_ids[0].tolist()
+        shared_prefix_len = common_prefix_length(system_ids, prompt_ids)
+    model_name = model.name_or_path if hasattr(model, "name_or_path") else BASE_MODEL_ID
+    return prompt_text, prompt_ids, model_name, shared_prefix_len, timer.seconds
+
+def generate_response_ids_sync(
+    persona_id: str, prompt_ids: List[int], on_token: Optional[Callable[[int], None]] = None, cancellation: Optional[CancellationToken] = None
+) -> List[int]:
+    model, tokenizer, device = get_model_and_tokenizer_for_persona(persona_id, BASE_MODEL_ID)
+    if not model or not tokenizer or not device:
+        raise ModelUnavailableError(f"Model resources for persona '{persona_id}' are not available.")
+    import torch
+    from generation_scheduler import TokenCallbackStreamer
+    from request_cancellation import cancellation_stopping_criteria
+    if cancellation is not None:
+        cancellation.raise_if_cancelled()
+    input_ids = torch.tensor([prompt_ids], dtype=torch.long, device=device)
+    extra_kwargs = get_assisted_generation_kwargs(persona_id, tokenizer)
+    if cancellation is not None:
+        extra_kwargs = {**extra_kwargs, "stopping_criteria": cancellation_stopping_criteria(cancellation)}
+    with persona_adapter_context(model, persona_id), torch.no_grad():
+        generated_outputs = model.generate(
+            input_ids, max_new_tokens=MAX_NEW_TOKENS, eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id, do_sample=True, temperature=GENERATION_TEMPERATURE, top_p=GENERATION_TOP_P,
+            streamer=TokenCallbackStreamer(on_token) if on_token else None, **extra_kwargs
+        )
+    response_ids = generated_outputs[0][len(prompt_ids):].tolist()
+    stopped_early = len(response_ids) < MAX_NEW_TOKENS and (not response_ids or response_ids[-1] != tokenizer.eos_token_id)
+    if cancellation is not None and stopped_early:
+        cancellation.raise_if_cancelled(response_ids)
+    return response_ids
+
+def decode_response(persona_id: str, response_ids: List[int]) -> str:
+    _, tokenizer, _ = get_model_and_tokenizer_for_persona(persona_id, BASE_MODEL_ID)
+    if not tokenizer:
+        raise ModelUnavailableError(f"Tokenizer for persona '{persona_id}' is not available.")
+    return tokenizer.decode(response_ids, skip_special_tokens=True).strip()
+
+inference_executor = InferenceExecutor(
+    mode=EXECUTOR_MODE, max_workers=EXECUTOR_WORKERS,
+    initializer=init_process_worker if EXECUTOR_MODE == "process" else None, logger=service_logger
+)
+ADMISSION_CONTROLLER = AdmissionController(
+    max_concurrent=MAX_CONCURRENT_REQUESTS, max_queue_depth=MAX_QUEUE_DEPTH, max_wait_s=ADMISSION_QUEUE_TIMEOUT_S, logger=service_logger
+)
+MODERATION_BATCHER = ModerationMicroBatcher(
+    run_moderation_batch, max_batch_size=MODERATION_MAX_BATCH_SIZE, window_s=MODERATION_BATCH_WINDOW_MS / 1000, logger=service_logger
+) if ENABLE_MODERATION_BATCHING else None
+
+async def generate_response_ids(
+    persona_id: str, prompt_ids: List[int], on_token: Optional[Callable[[int], None]] = None,
+    shared_prefix_len: int = 0, session_id: Optional[str] = None, cancellation: Optional[CancellationToken] = None
+) -> List[int]:
+    """
+    Generates the reply token ids (prompt excluded) for a single tokenized prompt.
+    `on_token` is called from a worker thread with each new token id; it is ignored in
+    "process" mode, where callbacks cannot cross the process boundary. `shared_prefix_len`
+    marks the leading prompt ids the batching scheduler may keep in its prefix cache, and
+    `session_id` lets it resume from the KV state of the session's previous turn.
+    Generation stops early once `cancellation` is cancelled, raising `GenerationCancelledError`
+    (in "process" mode only its deadline reaches the worker).
+    """
+    if inference_executor.mode != "thread":
+        return await inference_executor.run(generate_response_ids_sync, persona_id, prompt_ids, None, cancellation)
+    # The batching scheduler shares this process's models, so it only applies in "thread" mode.
+    # Assisted decoding verifies one sequence at a time, so personas with a draft model skip it.
+    # It steps PyTorch models only; other backends run one `generate` call per executor thread.
+    if ENABLE_CONTINUOUS_BATCHING and INFERENCE_BACKEND == "hf" and not get_draft_model_id(persona_id):
+        from generation_scheduler import SchedulerClosedError
+        for _ in range(2): # Retry once if the scheduler was closed by a model eviction in the meantime.
+            scheduler = await inference_executor.run(get_generation_scheduler, persona_id, BASE_MODEL_ID)
+            if not scheduler:
+                break
+            try:
+                future = scheduler.submit(
+                    prompt_ids, max_new_tokens=MAX_NEW_TOKENS, on_token=on_token,
+                    adapter_name=get_adapter_name_for_persona(persona_id), prefix_len=shared_prefix_len, session_id=session_id,
+                    cancellation=cancellation
+                )
+            except SchedulerClosedError:
+                continue
+            return await asyncio.wrap_future(future)
+    return await inference_executor.run(generate_response_ids_sync, persona_id, prompt_ids, on_token, cancellation)
+
+# --- Background Startup ---
+# Startup only schedules the loaders below and returns, so the server accepts connections at once.
+# Progress is reported per component by GET /ready; request handlers wait for what they need
+# (moderation via `run_moderation`, models via the registry's single-flight loading).
+def import_inference_runtime():
+    """Imports the heavy inference libraries once, before the loaders that need them run concurrently."""
+    import torch # noqa: F401
+    from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline # noqa: F401
+    from peft import PeftModel # noqa: F401
+    import generation_scheduler # noqa: F401
+
+def moderation_component_state(service: Any) -> str:
+    return "degraded" if getattr(service, "is_fallback", False) else "ready"
+
+def model_component_state(model: Any) -> str:
+    if model is None:
+        raise ModelUnavailableError("The default base model could not be loaded.")
+    return "degraded" if isinstance(model, DummySLM) else "ready"
+
+def load_moderation_component() -> str:
+    global moderation_service # Ensure we're assigning to the global instance
+    service_logger.info("Service Startup: Initializing Moderation Service...")
+    moderation_service = build_moderation_service()
+    return moderation_component_state(moderation_service)
+
+def load_default_model_component() -> str:
+    service_logger.info("Service Startup: Pre-loading default base model ('default_phi3_base')...")
+    model, _, _ = get_model_and_tokenizer_for_persona("default_phi3_base", BASE_MODEL_ID)
+    return model_component_state(model)
+
+def worker_component_states() -> Dict[str, str]:
+    """Runs in a "process" worker after its initializer; reports what that worker loaded."""
+    model, _, _ = get_model_and_tokenizer_for_persona("default_phi3_base", BASE_MODEL_ID)
+    return {"moderation": moderation_component_state(moderation_service), "default_model": model_component_state(model)}
+
+async def load_process_workers() -> None:
+    # The first task submitted spawns the workers; it completes once one of them has run its initializer.
+    try:
+        states = await inference_executor.run(worker_component_states)
+    except Exception as e:
+        for name in ("moderation", "default_model"):
+            SERVICE_READINESS.mark(name, "failed", detail=str(e))
+        raise
+    for name, state in states.items():
+        SERVICE_READINESS.mark(name, state)
+
+@app.on_event("startup")
+async def startup_event():
+    inference_executor.start()
+    if inference_executor.mode == "process":
+        service_logger.info("Service Startup: 'process' executor mode; models and moderation load inside the workers.")
+        for name in ("moderation", "default_model"):
+            SERVICE_READINESS.mark(name, "loading")
+        SERVICE_READINESS.start("process_workers", load_process_workers)
+        return
+    SERVICE_READINESS.start("inference_runtime", lambda: inference_executor.run(import_inference_runtime))
+    # Moderation and the default model load concurrently once the shared libraries are imported.
+    SERVICE_READINESS.start("moderation", lambda: inference_executor.run(load_moderation_component), after=["inference_runtime"])
+    SERVICE_READINESS.start("default_model", lambda: inference_executor.run(load_default_model_component), after=["inference_runtime"])
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await SERVICE_READINESS.cancel()
+    with GENERATION_SCHEDULERS_LOCK:
+        schedulers = list(GENERATION_SCHEDULERS.items())
+        GENERATION_SCHEDULERS.clear()
+    for persona_id, scheduler in schedulers:
+        service_logger.info(f"Service Shutdown: Stopping generation scheduler for persona '{persona_id}'...")
+        scheduler.shutdown()
+    inference_executor.shutdown()
+
 
 # --- 4. Simulated LMS Context Function (remains the same) ---
 def get_simulated_lms_context(user_id: str, subject: Optional[str], item_id: Optional[str]) -> Optional[Dict[str, Any]]:
     if not subject or not item_id:
-        for key, context in MOCK_DB["student_activity_contexts"].items():
-            if key.startswith(user_id):
-                service_logger.info(f"Found a default context for user {user_id}: {key}")
-                return context
+        default_context = LMS_CONTEXT_STORE.get_default(user_id)
+        if default_context:
+            service_logger.info(f"Found a default context for user {user_id}: {default_context[0]}")
+            return default_context[1]
         service_logger.info(f"No specific context found for user {user_id} with subject/item, and no default context available.")
         return None
     resource_key = f"{user_id}_{subject}_{item_id}"
-    context = MOCK_DB["student_activity_contexts"].get(resource_key)
+    context = LMS_CONTEXT_STORE.get(user_id, subject, item_id)
     if context: service_logger.info(f"Simulated LMS context found for key: {resource_key}")
     else: service_logger.warning(f"No simulated LMS context found for key: {resource_key}")
     return context
@@ -161,42 +643,200 @@ def get_simulated_lms_context(user_id: str, subject: Optional[str], item_id: Opt
 # --- 5. User Profile Endpoints (remains the same) ---
 @app.post("/users/register", response_model=UserProfile, status_code=201)
 async def register_user(user_create: UserProfileCreate):
-    for profile in USER_PROFILES_DB.values():
-        if profile.username == user_create.username:
-            raise HTTPException(status_code=400, detail=f"Username '{user_create.username}' already exists.")
     user_id = uuid.uuid4().hex; created_at = datetime.utcnow()
     user_profile = UserProfile(user_id=user_id, **user_create.model_dump(), created_at=created_at) # Use model_dump for Pydantic v2
-    USER_PROFILES_DB[user_id] = user_profile
+    try:
+        USER_STORE.add(user_profile.model_dump())
+    except UsernameTakenError:
+        raise HTTPException(status_code=400, detail=f"Username '{user_create.username}' already exists.")
     service_logger.info(f"User registered: {user_profile.username} (ID: {user_id})")
     return user_profile
 
 @app.get("/users/{user_id}", response_model=UserProfile)
 async def get_user_profile(user_id: str):
-    user_profile = USER_PROFILES_DB.get(user_id)
-    if not user_profile: raise HTTPException(status_code=404, detail="User not found")
-    return user_profile
+    user_record = USER_STORE.get(user_id)
+    if not user_record: raise HTTPException(status_code=404, detail="User not found")
+    return UserProfile(**user_record)
+
+@app.get("/ready")
+async def get_readiness():
+    """200 once every startup component is ready (or running on its fallback), else 503, with per-component state."""
+    snapshot = SERVICE_READINESS.snapshot()
+    return JSONResponse(status_code=200 if snapshot["ready"] else 503, content=snapshot)
+
+@app.get("/models/registry")
+async def get_model_registry():
+    """Loaded models, their estimated sizes and the registry's hit/miss/eviction counters."""
+    return MODEL_REGISTRY.snapshot()
+
+@app.get("/models/schedulers")
+async def get_generation_schedulers():
+    """Per-scheduler batching counters and prefix-cache hit rates."""
+    with GENERATION_SCHEDULERS_LOCK:
+        schedulers = list(GENERATION_SCHEDULERS.items())
+    return {
+        key: {**scheduler.stats, "prefix_cache": scheduler.prefix_cache.snapshot() if scheduler.prefix_cache is not None else None}
+        for key, scheduler in schedulers
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text format: stage and turn latency histograms, token counters, admission/cache/registry counters."""
+    return Response(content=generate_latest(SERVICE_METRICS), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/models/admission")
+async def get_admission_control():
+    """In-flight and queued turns (per request class), rejection counters and queue-wait percentiles."""
+    return ADMISSION_CONTROLLER.snapshot()
+
+@app.get("/models/response_cache")
+async def get_response_cache():
+    """Response cache size and exact/similar hit counters."""
+    return RESPONSE_CACHE.snapshot() if RESPONSE_CACHE is not None else {"enabled": False}
+
+@app.get("/models/session_cache")
+async def get_session_cache():
+    """Per-session KV cache occupancy, hit rate and eviction counters."""
+    return SESSION_KV_CACHE.snapshot() if SESSION_KV_CACHE is not None else {"enabled": False}
+
+@app.get("/models/moderation_cache")
+async def get_moderation_cache():
+    """Moderation result cache size and hit/miss/eviction counters ("thread" executor mode; workers keep their own)."""
+    return MODERATION_RESULT_CACHE.snapshot() if MODERATION_RESULT_CACHE is not None else {"enabled": False}
+
+@app.get("/models/moderation_batcher")
+async def get_moderation_batcher():
+    """Moderation micro-batching: batch count, mean and largest batch size."""
+    return MODERATION_BATCHER.snapshot() if MODERATION_BATCHER is not None else {"enabled": False}
 
 # --- 6. /interact Endpoint (Uses refactored model loader) ---
-@app.post("/interact", response_model=InteractionResponse)
-async def interact_with_aita(request: InteractionRequest):
+@dataclass
+class TurnContext:
+    session_id: str
+    persona_id: str
+    user_profile: Optional[UserProfile]
+    lms_context: Optional[Dict[str, Any]]
+    passage_title: str
+    passage_id_log: str
+    lo_id_log: str
+    system_prompt: str
+
+@dataclass
+class StageTimer:
+    """Wall-clock seconds spent in each pipeline stage of one turn, returned as `debug_info["stage_seconds"]`."""
+    seconds: Dict[str, float] = field(default_factory=dict)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, accumulate: bool = False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, accumulate)
+
+    def record(self, name: str, start: float, accumulate: bool = False):
+        elapsed = time.perf_counter() - start
+        self.seconds[name] = round(elapsed + (self.seconds.get(name, 0.0) if accumulate else 0.0), 4)
+
+    def record_generation(self, start: float, first_token_at: Optional[float]):
+        """Records "generation" and, when the first reply token's arrival is known, its "prefill" and "decode" parts."""
+        end = time.perf_counter()
+        self.seconds["generation"] = round(end - start, 4)
+        if first_token_at is not None:
+            self.seconds["prefill"] = round(first_token_at - start, 4)
+            self.seconds["decode"] = round(end - first_token_at, 4)
+
+class FirstTokenClock:
+    """`on_token` wrapper that notes when the first reply token arrives (the end of prefill) and forwards every token."""
+    def __init__(self, on_token: Optional[Callable[[int], None]] = None):
+        self.on_token = on_token
+        self.first_token_at: Optional[float] = None
+
+    def __call__(self, token_id: int):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        if self.on_token is not None:
+            self.on_token(token_id)
+
+# --- Metrics (GET /metrics) ---
+# A registry of our own (not prometheus_client's global one) so reloading the module does not register the metrics twice.
+SERVICE_METRICS = CollectorRegistry()
+STAGE_SECONDS = Histogram("aita_stage_duration_seconds", "Seconds spent in each pipeline stage of a turn.", ("endpoint", "stage"), buckets=LATENCY_BUCKETS, registry=SERVICE_METRICS)
+TURN_SECONDS = Histogram("aita_turn_duration_seconds", "End-to-end seconds per turn, by outcome.", ("endpoint", "outcome"), buckets=LATENCY_BUCKETS, registry=SERVICE_METRICS)
+PROMPT_TOKENS = Counter("aita_prompt_tokens_total", "Prompt tokens sent to generation.", ("persona",), registry=SERVICE_METRICS)
+GENERATED_TOKENS = Counter("aita_generated_tokens_total", "Reply tokens generated.", ("persona",), registry=SERVICE_METRICS)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "aita_decode_tokens_per_second", "Reply tokens per second of decoding (of generation when prefill is not measured), per turn.", ("persona",), buckets=TOKENS_PER_SECOND_BUCKETS, registry=SERVICE_METRICS
+)
+
+def persona_metric_label(persona_id: str) -> str:
+    # Persona ids come from requests; only configured ones become label values.
+    return persona_id if persona_id in ADAPTER_CONFIG or persona_id == "default_phi3_base" else "other"
+
+def record_turn_metrics(
+    endpoint: str, outcome: str, timer: StageTimer, turn_seconds: float, persona_id: str,
+    prompt_ids: Optional[List[int]] = None, response_ids: Optional[List[int]] = None
+):
+    """`outcome`: completed, response_cache, unsafe_input, rejected, cancelled, timed_out, model_unavailable or error."""
+    for stage, seconds in timer.seconds.items():
+        STAGE_SECONDS.labels(endpoint=endpoint, stage=stage).observe(seconds)
+    TURN_SECONDS.labels(endpoint=endpoint, outcome=outcome).observe(turn_seconds)
+    persona = persona_metric_label(persona_id)
+    if prompt_ids is not None:
+        PROMPT_TOKENS.labels(persona=persona).inc(len(prompt_ids))
+    if response_ids:
+        GENERATED_TOKENS.labels(persona=persona).inc(len(response_ids))
+        decode_s = timer.seconds.get("decode", timer.seconds.get("generation"))
+        if decode_s:
+            DECODE_TOKENS_PER_SECOND.labels(persona=persona).observe(len(response_ids) / decode_s)
+
+def collect_component_metrics() -> List[Any]:
+    """Admission queue, scheduler, cache and model-registry counters, read from their snapshots at scrape time."""
+    admission = ADMISSION_CONTROLLER.snapshot()
+    families: List[Any] = [
+        ("aita_admission_in_flight", "gauge", "Turns inside the inference pipeline.", [({}, admission["in_flight"])]),
+        ("aita_admission_queue_depth", "gauge", "Turns waiting for admission, by request class.", [({"request_class": name}, depth) for name, depth in admission["queue_depth_by_class"].items()]),
+        ("aita_admission_admitted_total", "counter", "Turns admitted.", [({}, admission["admitted"])]),
+        ("aita_admission_rejected_total", "counter", "Turns rejected with 503, by reason.", [({"reason": reason}, admission[f"rejected_{reason}"]) for reason in ("queue_full", "shed", "queue_timeout")]),
+    ]
+    with GENERATION_SCHEDULERS_LOCK:
+        # Evicted schedulers are counted while they drain and through their retired totals afterwards.
+        schedulers = [*GENERATION_SCHEDULERS.values(), *DRAINING_SCHEDULERS]
+        scheduler_stats = [RETIRED_METRIC_TOTALS.snapshot("scheduler")] + [dict(scheduler.stats) for scheduler in schedulers]
+        prefix_cache_stats = [RETIRED_METRIC_TOTALS.snapshot("prefix_cache")] + [scheduler.prefix_cache.snapshot() for scheduler in schedulers if scheduler.prefix_cache is not None]
+    families += stats_families("aita_scheduler", {}, scheduler_stats)
+    families += stats_families("aita_cache", {"cache": "prefix"}, prefix_cache_stats)
+    if SESSION_KV_CACHE is not None:
+        families += stats_families("aita_cache", {"cache": "session"}, [SESSION_KV_CACHE.snapshot()])
+    if RESPONSE_CACHE is not None:
+        families += stats_families("aita_cache", {"cache": "response"}, [RESPONSE_CACHE.snapshot()], gauge_keys=("entries", "contexts"))
+    families += stats_families("aita_model_registry", {}, [MODEL_REGISTRY.snapshot()], gauge_keys=("bytes_in_use", "memory_budget_bytes"))
+    if MODERATION_RESULT_CACHE is not None and inference_executor.mode == "thread":
+        families += stats_families("aita_cache", {"cache": "moderation"}, [MODERATION_RESULT_CACHE.snapshot()], gauge_keys=("entries", "bytes_in_use"))
+    if MODERATION_PREFILTER is not None:
+        families += stats_families("aita_moderation_prefilter", {}, [MODERATION_PREFILTER.stats], gauge_keys=())
+    if MODERATION_BATCHER is not None:
+        moderation_batching = MODERATION_BATCHER.snapshot()
+        gauge_keys = ("queued_texts", "running_batches")
+        families += stats_families("aita_moderation_batcher", {}, [{key: moderation_batching[key] for key in (*MODERATION_BATCHER.stats, *gauge_keys)}], gauge_keys=gauge_keys)
+    return families
+
+SERVICE_METRICS.register(ComponentCollector(collect_component_metrics))
+
+def build_turn_context(request: InteractionRequest, timer: Optional[StageTimer] = None) -> TurnContext:
     current_session_id = request.session_id if request.session_id else uuid.uuid4().hex
-    timestamp_utc = datetime.utcnow().isoformat() + "Z"
+    timer = timer if timer is not None else StageTimer()
 
     effective_aita_persona_id = request.aita_persona_id
-    user_profile = USER_PROFILES_DB.get(request.user_id)
+    with timer.stage("profile_lookup"):
+        user_record = USER_STORE.get(request.user_id)
+    user_profile = UserProfile(**user_record) if user_record else None
     if user_profile and user_profile.preferred_aita_persona_id:
         effective_aita_persona_id = user_profile.preferred_aita_persona_id
         service_logger.info(f"Using user's preferred AITA: {effective_aita_persona_id}")
 
-    # Use the refactored function to get model, tokenizer, device
-    current_model, current_tokenizer, current_device = get_model_and_tokenizer_for_persona(effective_aita_persona_id, BASE_MODEL_ID)
-
-    if not current_model or not current_tokenizer or not current_device: # Check all three
-        service_logger.error(f"Model resources for persona '{effective_aita_persona_id}' are not available (utility returned None). Check startup & persona loading logs.")
-        raise HTTPException(status_code=503, detail=f"Model resources for persona '{effective_aita_persona_id}' are not available.")
-
-    lms_context = get_simulated_lms_context(request.user_id, request.subject, request.current_item_id)
-    grade_level_info = f" The student is in grade {user_profile.grade_level}." if user_profile and user_profile.grade_level else ""
+    with timer.stage("context_fetch"):
+        lms_context = get_simulated_lms_context(request.user_id, request.subject, request.current_item_id)
     passage_title = lms_context.get("current_passage_title", lms_context.get("current_item_title", "the current topic")) if lms_context else "the current topic"
     passage_snippet = lms_context.get("current_passage_text_snippet", lms_context.get("current_item_text_snippet", "a relevant educational activity")) if lms_context else "a relevant educational activity"
     lo_list = lms_context.get("target_learning_objectives_for_activity", []) if lms_context else []
@@ -206,71 +846,479 @@ async def interact_with_aita(request: InteractionRequest):
     teacher_notes_log = lms_context.get("teacher_notes_for_student_on_lo", "") if lms_context else ""
     passage_id_log = lms_context.get("current_passage_id", lms_context.get("current_item_id", "unknown_item")) if lms_context else "unknown_item"
 
-    system_prompt = f"You are {effective_aita_persona_id}, a helpful AI Tutor.{grade_level_info} You are discussing '{passage_title}' related to the learning objective: '{lo_desc}'. Passage snippet: \"{passage_snippet}\". {f'Teacher note: \"{teacher_notes_log}\" ' if teacher_notes_log else ''}Respond clearly, concisely, and age-appropriately. Guide the student; don't just give answers."
+    system_prompt = build_tutor_system_prompt(
+        effective_aita_persona_id, passage_title, passage_snippet, lo_desc,
+        grade_level=user_profile.grade_level if user_profile else None, teacher_note=teacher_notes_log
+    )
 
-    mod_input_results = moderation_service.check_text(request.user_utterance) # Ensure moderation_service is initialized
-    if not mod_input_results["is_safe"]:
-        aita_final_response = "I'm sorry, I can't process that request due to content policy. Let's focus on our learning task."
-        # Log xAPI (simplified for brevity here, full structure in client)
-        log_xapi_statement({"error": "unsafe input", "user_id": request.user_id, "input": request.user_utterance}, XAPI_LOG_FILE_PATH, service_logger)
-        return InteractionResponse(session_id=current_session_id, aita_response=aita_final_response, debug_info={"input_moderation_triggered": True})
+    return TurnContext(
+        session_id=current_session_id, persona_id=effective_aita_persona_id, user_profile=user_profile, lms_context=lms_context,
+        passage_title=passage_title, passage_id_log=passage_id_log, lo_id_log=lo_id_log, system_prompt=system_prompt
+    )
 
-    messages = [{"role": "system", "content": system_prompt}]
+def build_messages(turn: TurnContext, request: InteractionRequest) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "content": turn.system_prompt}]
     messages.extend(request.conversation_history)
     messages.append({"role": "user", "content": request.user_utterance})
+    return messages
 
-    try:
-        prompt_text = current_tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = current_tokenizer(prompt_text, return_tensors="pt", add_special_tokens=True).to(current_device)
-        input_ids_length = inputs.input_ids.shape[1]
-
-        start_time = time.time()
-        with torch.no_grad():
-            generated_outputs = current_model.generate(
-                inputs.input_ids, max_new_tokens=300, eos_token_id=current_tokenizer.eos_token_id,
-                pad_token_id=current_tokenizer.pad_token_id, do_sample=True, temperature=0.7, top_p=0.9
-            )
-        duration_s = time.time() - start_time
-
-        response_ids = generated_outputs[0][input_ids_length:]
-        aita_raw_response = current_tokenizer.decode(response_ids, skip_special_tokens=True).strip()
-
-        mod_output_results = moderation_service.check_text(aita_raw_response)
-        aita_final_response = aita_raw_response
-        if not mod_output_results["is_safe"]:
-            aita_final_response = "I may have generated a response that isn't quite right. Let's try a different approach."
-
-        xapi_log_data = {
-            "actor_name": "ServiceUser", "actor_account_name": request.user_id,
-            "verb_id": "http://adlnet.gov/expapi/verbs/interacted", "verb_display": "interacted with AITA Service",
-            "object_activity_id": f"http://example.com/aita_service/{current_session_id}/turn_{uuid.uuid4().hex[:8]}",
-            "object_activity_name": "AITA Service Interaction Turn",
-            "object_activity_description": f"User '{request.user_id}' interacted with '{effective_aita_persona_id}' on content '{passage_title}'. LO: {lo_id_log}.",
-            "session_id": current_session_id, "aita_persona": effective_aita_persona_id,
-            "result_response": aita_final_response, "result_duration_seconds": duration_s,
-            "result_extensions": {"input_moderation_details": mod_input_results, "output_moderation_details": mod_output_results},
-            "context_parent_activity_id": f"http://example.com/content/{passage_id_log}",
-            "context_extensions": {
-                "learning_objective_active": lo_id_log, "full_prompt_to_llm": prompt_text,
-                "user_utterance_raw": request.user_utterance, "aita_response_raw": aita_raw_response,
-                "pedagogical_notes": ["Service Placeholder: Note 1", "Service Placeholder: Note 2"], # Placeholder reasoner fields
-                "aita_turn_narrative_rationale": "Service Placeholder: Simulated rationale for this turn."
-            }
+def response_cache_applies(request: InteractionRequest) -> bool:
+    return RESPONSE_CACHE is not None and len(request.conversation_history) <= RESPONSE_CACHE_MAX_HISTORY
+
+def response_cache_context_key(turn: TurnContext) -> tuple[str, str]:
+    # The system prompt carries the passage, LO, grade and teacher note, so equal prompts mean equal context.
+    return turn.persona_id, hashlib.sha1(turn.system_prompt.encode("utf-8")).hexdigest()
+
+def lookup_cached_response(turn: TurnContext, request: InteractionRequest) -> Optional[Dict[str, Any]]:
+    if not response_cache_applies(request):
+        return None
+    return RESPONSE_CACHE.get(response_cache_context_key(turn), request.user_utterance)
+
+def remember_response(turn: TurnContext, request: InteractionRequest, aita_raw_response: str, mod_output_results: Dict[str, Any]):
+    # Only replies that passed output moderation are worth serving again.
+    if response_cache_applies(request) and mod_output_results.get("is_safe"):
+        RESPONSE_CACHE.put(response_cache_context_key(turn), request.user_utterance, aita_raw_response)
+
+def response_cache_marker(request: InteractionRequest, cache_hit: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """The xAPI `context_extensions["response_cache"]` value: None when the cache was not consulted."""
+    if not response_cache_applies(request):
+        return None
+    if cache_hit is None:
+        return {"hit": False}
+    return {"hit": True, "similarity": cache_hit["similarity"], "matched_utterance": cache_hit["matched_utterance"], "age_seconds": cache_hit["age_seconds"]}
+
+async def log_unsafe_input(turn: TurnContext, request: InteractionRequest, timer: Optional[StageTimer] = None) -> InteractionResponse:
+    aita_final_response = "I'm sorry, I can't process that request due to content policy. Let's focus on our learning task."
+    # Log xAPI (simplified for brevity here, full structure in client)
+    with (timer if timer is not None else StageTimer()).stage("xapi_write"):
+        await asyncio.to_thread(log_xapi_statement, {"error": "unsafe input", "user_id": request.user_id, "input": request.user_utterance}, XAPI_LOG_FILE_PATH, service_logger)
+    return InteractionResponse(session_id=turn.session_id, aita_response=aita_final_response, debug_info={"input_moderation_triggered": True})
+
+async def finalize_turn(
+    turn: TurnContext, request: InteractionRequest, prompt_text: Optional[str], aita_raw_response: str,
+    duration_s: float, mod_input_results: Dict[str, Any], response_cache_info: Optional[Dict[str, Any]] = None,
+    timer: Optional[StageTimer] = None, mod_output_results: Optional[Dict[str, Any]] = None
+) -> tuple[str, Dict[str, Any]]:
+    """
+    Runs output moderation on the finished (or cached) reply, unless `mod_output_results` already holds the
+    verdict of incremental moderation, and writes the turn's xAPI statement, timed as the "output_moderation"
+    and "xapi_write" stages. `prompt_text` is None when the reply came from the response cache.
+    """
+    timer = timer if timer is not None else StageTimer()
+    if mod_output_results is None:
+        with timer.stage("output_moderation"):
+            mod_output_results = await run_moderation(aita_raw_response)
+    aita_final_response = aita_raw_response
+    if not mod_output_results["is_safe"]:
+        aita_final_response = "I may have generated a response that isn't quite right. Let's try a different approach."
+
+    xapi_log_data = build_turn_xapi_data(turn, request, prompt_text, aita_final_response, aita_raw_response, duration_s, mod_input_results, mod_output_results, "completed")
+    if response_cache_info is not None:
+        xapi_log_data["context_extensions"]["response_cache"] = response_cache_info
+    with timer.stage("xapi_write"):
+        await asyncio.to_thread(log_xapi_statement, create_interaction_xapi_statement(**xapi_log_data), XAPI_LOG_FILE_PATH, service_logger)
+    return aita_final_response, mod_output_results
+
+async def log_abandoned_turn(
+    turn: TurnContext, request: InteractionRequest, prompt_text: Optional[str], partial_response_ids: List[int],
+    duration_s: float, mod_input_results: Optional[Dict[str, Any]], reason: str
+):
+    """
+    Writes the xAPI statement of a turn whose client disconnected ("cancelled") or whose deadline passed
+    ("timed_out"). No reply reached the student, so `result_response` is empty; whatever was generated
+    before generation stopped is kept as `aita_response_raw`.
+    """
+    partial_text = ""
+    if partial_response_ids:
+        try:
+            partial_text = await inference_executor.run(decode_response, turn.persona_id, partial_response_ids)
+        except Exception as e:
+            service_logger.warning(f"Could not decode the partial reply of an abandoned turn: {e}")
+    service_logger.info(f"Turn for session '{turn.session_id}' {reason.replace('_', ' ')} after {duration_s:.1f}s ({len(partial_response_ids)} tokens generated).")
+    xapi_log_data = build_turn_xapi_data(turn, request, prompt_text, "", partial_text, duration_s, mod_input_results, None, reason)
+    await asyncio.to_thread(log_xapi_statement, create_interaction_xapi_statement(**xapi_log_data), XAPI_LOG_FILE_PATH, service_logger)
+
+def build_turn_xapi_data(
+    turn: TurnContext, request: InteractionRequest, prompt_text: Optional[str], aita_final_response: str, aita_raw_response: str,
+    duration_s: float, mod_input_results: Optional[Dict[str, Any]], mod_output_results: Optional[Dict[str, Any]], turn_outcome: str
+) -> Dict[str, Any]:
+    """Keyword arguments for `create_interaction_xapi_statement`; `turn_outcome` is "completed", "cancelled" or "timed_out"."""
+    return {
+        "actor_name": "ServiceUser", "actor_account_name": request.user_id,
+        "verb_id": "http://adlnet.gov/expapi/verbs/interacted", "verb_display": "interacted with AITA Service",
+        "object_activity_id": f"http://example.com/aita_service/{turn.session_id}/turn_{uuid.uuid4().hex[:8]}",
+        "object_activity_name": "AITA Service Interaction Turn",
+        "object_activity_description": f"User '{request.user_id}' interacted with '{turn.persona_id}' on content '{turn.passage_title}'. LO: {turn.lo_id_log}.",
+        "session_id": turn.session_id, "aita_persona": turn.persona_id,
+        "result_response": aita_final_response, "result_duration_seconds": duration_s,
+        "result_extensions": {"turn_outcome": turn_outcome, "input_moderation_details": mod_input_results, "output_moderation_details": mod_output_results},
+        "context_parent_activity_id": f"http://example.com/content/{turn.passage_id_log}",
+        "context_extensions": {
+            "learning_objective_active": turn.lo_id_log, "full_prompt_to_llm": prompt_text,
+            "user_utterance_raw": request.user_utterance, "aita_response_raw": aita_raw_response,
+            "pedagogical_notes": ["Service Placeholder: Note 1", "Service Placeholder: Note 2"], # Placeholder reasoner fields
+            "aita_turn_narrative_rationale": "Service Placeholder: Simulated rationale for this turn."
         }
-        log_xapi_statement(create_interaction_xapi_statement(**xapi_log_data), XAPI_LOG_FILE_PATH, service_logger)
-
-        return InteractionResponse(
-            session_id=current_session_id, aita_response=aita_final_response,
-            debug_info={"model_used": current_model.name_or_path if hasattr(current_model, "name_or_path") else base_model_id,
-                        "aita_persona_resolved": effective_aita_persona_id,
-                        "user_profile_found": bool(user_profile),
-                        "lms_context_found": bool(lms_context)}
-        )
-    except Exception as e:
-        service_logger.error(f"Exception during model interaction: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error during model interaction: {str(e)}")
+    }
+
+def discard_future(future: "asyncio.Future[Any]"):
+    """Cancels `future`, or retrieves its exception if it already finished, so asyncio does not log it as never retrieved."""
+    if not future.cancel() and not future.cancelled():
+        future.exception()
+
+async def moderate_input_while_preparing(
+    turn: TurnContext, request: InteractionRequest, timer: StageTimer
+) -> tuple[Dict[str, Any], Optional[Dict[str, Any]], Optional["asyncio.Future[tuple]"]]:
+    """
+    Input moderation and prompt preparation don't depend on each other, so they run at the same time: moderation starts
+    first and, unless the response cache answers the turn, `prepare_prompt` (templating and tokenization, and loading
+    the persona's model if needed) runs in the executor meanwhile. Returns (mod_input_results, cache_hit, prompt) once
+    the verdict is in; `prompt` is the future of `prepare_prompt`'s result, None for a cache hit or an unsafe input,
+    whose preparation is discarded. The "input_moderation" stage overlaps "templating" and "tokenization".
+    """
+    moderation_started_at = time.perf_counter()
+    moderation = asyncio.ensure_future(run_moderation(request.user_utterance))
+    cache_hit = lookup_cached_response(turn, request)
+    prompt = None if cache_hit else asyncio.ensure_future(inference_executor.run(prepare_prompt, turn.persona_id, build_messages(turn, request)))
+    try:
+        mod_input_results = await moderation
+    except BaseException:
+        moderation.cancel()
+        if prompt is not None:
+            discard_future(prompt)
+        raise
+    timer.record("input_moderation", moderation_started_at)
+    if not mod_input_results["is_safe"] and prompt is not None:
+        discard_future(prompt)
+        prompt = None
+    return mod_input_results, cache_hit, prompt
+
+async def watch_for_disconnect(http_request: Request, cancellation: CancellationToken):
+    """Cancels the turn's generation as soon as its client goes away; runs until the turn ends or is cancelled."""
+    while not cancellation.is_cancelled():
+        if await http_request.is_disconnected():
+            cancellation.cancel("cancelled")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL_S)
+
+def admission_rejected_response(e: AdmissionRejectedError) -> Response:
+    service_logger.warning(f"Turn not admitted ({e.reason}); queue depth {ADMISSION_CONTROLLER.queue_depth()}, Retry-After {e.retry_after_s}s.")
+    return JSONResponse(
+        status_code=503, headers={"Retry-After": str(e.retry_after_s)},
+        content={"detail": "The tutor is busy right now. Please try again shortly.", "reason": e.reason, "retry_after_s": e.retry_after_s}
+    )
+
+def abandoned_turn_status(reason: str) -> tuple[int, str]:
+    """HTTP status and message for a turn whose generation was cancelled for `reason` (see `CANCELLATION_REASONS`)."""
+    if reason == "timed_out":
+        return 504, f"The tutor did not answer within {REQUEST_TIMEOUT_S:.0f}s. Please try again."
+    if reason == "cancelled":
+        return 499, "The request was cancelled." # Client closed the request.
+    if reason == "output_unsafe":
+        return 422, "The tutor's reply was stopped by content moderation. Please try asking differently."
+    return 500, f"Generation stopped unexpectedly ({reason})."
+
+def abandoned_turn_response(reason: str) -> Response:
+    status_code, detail = abandoned_turn_status(reason)
+    if status_code == 499:
+        return Response(status_code=499) # Nobody reads this response.
+    return JSONResponse(status_code=status_code, content={"detail": detail})
+
+@app.post("/interact", response_model=InteractionResponse)
+async def interact_with_aita(request: InteractionRequest, http_request: Request):
+    timer = StageTimer()
+    turn_started_at = time.time()
+    turn = build_turn_context(request, timer)
+    # Cancelled when the client disconnects or REQUEST_TIMEOUT_S passes; generation then stops at the next token.
+    cancellation = CancellationToken.with_timeout(REQUEST_TIMEOUT_S)
+    disconnect_watcher = asyncio.ensure_future(watch_for_disconnect(http_request, cancellation))
+    prompt_text: Optional[str] = None
+    mod_input_results: Optional[Dict[str, Any]] = None
+    outcome, prompt_ids, response_ids = "error", None, None
+
+    try:
+        queued_at = time.perf_counter()
+        async with ADMISSION_CONTROLLER.admit(request.request_class, max_wait_s=cancellation.remaining_seconds()):
+            timer.record("queue_wait", queued_at)
+            cancellation.raise_if_cancelled()
+            mod_input_results, cache_hit, prompt = await moderate_input_while_preparing(turn, request, timer)
+            if not mod_input_results["is_safe"]:
+                outcome = "unsafe_input"
+                return await log_unsafe_input(turn, request, timer)
+
+            if cache_hit:
+                aita_final_response, _ = await finalize_turn(turn, request, None, cache_hit["response"], 0.0, mod_input_results, response_cache_marker(request, cache_hit), timer)
+                outcome = "response_cache"
+                return InteractionResponse(
+                    session_id=turn.session_id, aita_response=aita_final_response,
+                    debug_info={"model_used": "response_cache",
+                                "aita_persona_resolved": turn.persona_id,
+                                "user_profile_found": bool(turn.user_profile),
+                                "lms_context_found": bool(turn.lms_context),
+                                "response_cache_hit": True,
+                                "stage_seconds": timer.seconds}
+                )
+
+            try:
+                prompt_text, prompt_ids, model_name, shared_prefix_len, prompt_stage_seconds = await prompt
+                timer.seconds.update(prompt_stage_seconds)
+            except ModelUnavailableError as e:
+                outcome = "model_unavailable"
+                service_logger.error(f"{e} Check startup & persona loading logs.")
+                raise HTTPException(status_code=503, detail=str(e))
+            cancellation.raise_if_cancelled()
+
+            try:
+                start_time = time.time()
+                generation_started_at, clock = time.perf_counter(), FirstTokenClock()
+                response_ids = await generate_response_ids(
+                    turn.persona_id, prompt_ids, on_token=clock, shared_prefix_len=shared_prefix_len, session_id=turn.session_id, cancellation=cancellation
+                )
+                timer.record_generation(generation_started_at, clock.first_token_at)
+                duration_s = time.time() - start_time
+
+                with timer.stage("decoding"):
+                    aita_raw_response = await inference_executor.run(decode_response, turn.persona_id, response_ids)
+                aita_final_response, mod_output_results = await finalize_turn(turn, request, prompt_text, aita_raw_response, duration_s, mod_input_results, response_cache_marker(request, None), timer)
+                remember_response(turn, request, aita_raw_response, mod_output_results)
+                outcome = "completed"
+
+                return InteractionResponse(
+                    session_id=turn.session_id, aita_response=aita_final_response,
+                    debug_info={"model_used": model_name,
+                                "aita_persona_resolved": turn.persona_id,
+                                "user_profile_found": bool(turn.user_profile),
+                                "lms_context_found": bool(turn.lms_context),
+                                "prompt_tokens": len(prompt_ids),
+                                "response_tokens": len(response_ids),
+                                "stage_seconds": timer.seconds}
+                )
+            except GenerationCancelledError:
+                raise
+            except Exception as e:
+                service_logger.error(f"Exception during model interaction: {e}", exc_info=True)
+                raise HTTPException(status_code=500, detail=f"Error during model interaction: {str(e)}")
+    except AdmissionRejectedError as e:
+        outcome = "rejected"
+        return admission_rejected_response(e)
+    except GenerationCancelledError as e:
+        outcome, response_ids = e.reason, e.generated_ids
+        await log_abandoned_turn(turn, request, prompt_text, e.generated_ids, time.time() - turn_started_at, mod_input_results, e.reason)
+        return abandoned_turn_response(e.reason)
+    finally:
+        disconnect_watcher.cancel()
+        record_turn_metrics("interact", outcome, timer, time.time() - turn_started_at, turn.persona_id, prompt_ids, response_ids)
+
+# --- 7. /interact/stream Endpoint (Server-Sent Events) ---
+def format_sse_event(payload: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+async def stream_turn_events(
+    turn: TurnContext, request: InteractionRequest, cancellation: CancellationToken, timer: StageTimer, turn_started_at: float
+) -> AsyncIterator[str]:
+    """
+    Yields SSE events for one turn: a "token" event per decoded text delta, then a single
+    "done" event carrying the moderated final response (or an "error" event).
+    If the client disconnects, Starlette cancels this generator; `cancellation` then stops the
+    generation and the turn is logged as cancelled.
+    """
+    prompt_text: Optional[str] = None
+    mod_input_results: Optional[Dict[str, Any]] = None
+    generation: Optional["asyncio.Future[List[int]]"] = None
+    output_moderator: Optional[StreamingOutputModerator] = None
+    outcome, prompt_ids, response_ids = "error", None, None
+    try:
+        queued_at = time.perf_counter()
+        async with ADMISSION_CONTROLLER.admit(request.request_class, max_wait_s=cancellation.remaining_seconds()):
+            timer.record("queue_wait", queued_at)
+            cancellation.raise_if_cancelled()
+            mod_input_results, cache_hit, prompt = await moderate_input_while_preparing(turn, request, timer)
+            if not mod_input_results["is_safe"]:
+                response = await log_unsafe_input(turn, request, timer)
+                outcome = "unsafe_input"
+                yield format_sse_event({"type": "done", **response.model_dump()})
+                return
+
+            if cache_hit:
+                aita_final_response, mod_output_results = await finalize_turn(turn, request, None, cache_hit["response"], 0.0, mod_input_results, response_cache_marker(request, cache_hit), timer)
+                outcome = "response_cache"
+                yield format_sse_event({"type": "token", "text": aita_final_response})
+                yield format_sse_event({
+                    "type": "done", "session_id": turn.session_id, "aita_response": aita_final_response,
+                    "debug_info": {"model_used": "response_cache",
+                                   "aita_persona_resolved": turn.persona_id,
+                                   "user_profile_found": bool(turn.user_profile),
+                                   "lms_context_found": bool(turn.lms_context),
+                                   "output_moderation_triggered": not mod_output_results["is_safe"],
+                                   "response_cache_hit": True,
+                                   "stage_seconds": timer.seconds}
+                })
+                return
+
+            try:
+                prompt_text, prompt_ids, model_name, shared_prefix_len, prompt_stage_seconds = await prompt
+                timer.seconds.update(prompt_stage_seconds)
+            except ModelUnavailableError as e:
+                outcome = "model_unavailable"
+                service_logger.error(f"{e} Check startup & persona loading logs.")
+                yield format_sse_event({"type": "error", "status_code": 503, "detail": str(e)})
+                return
+            cancellation.raise_if_cancelled()
+
+            try:
+                detokenizer: Optional["IncrementalDetokenizer"] = None
+                on_token: Optional[Callable[[int], None]] = None
+                token_queue: "asyncio.Queue[int]" = asyncio.Queue()
+                # Text is streamed only once the chunk holding it has passed moderation; an unsafe chunk stops generation,
+                # and neither it nor anything after it is streamed. Without chunked moderation, the reply is sent once moderated.
+                if inference_executor.mode == "thread" and OUTPUT_MODERATION_CHUNK_CHARS > 0:
+                    _, tokenizer, _ = await inference_executor.run(get_model_and_tokenizer_for_persona, turn.persona_id, BASE_MODEL_ID)
+                    import generation_scheduler # Lazy: it imports torch.
+                    detokenizer = generation_scheduler.IncrementalDetokenizer(tokenizer)
+                    loop = asyncio.get_running_loop()
+                    on_token = lambda token_id: loop.call_soon_threadsafe(token_queue.put_nowait, token_id)
+                    output_moderator = StreamingOutputModerator(
+                        run_moderation, max_chunk_chars=OUTPUT_MODERATION_CHUNK_CHARS,
+                        on_flagged=lambda _: cancellation.cancel("output_unsafe"), logger=service_logger
+                    )
+
+                start_time = time.time()
+                time_to_first_token_s: Optional[float] = None
+                streamed_text = ""
+                generation_started_at, clock = time.perf_counter(), FirstTokenClock(on_token)
+                generation = asyncio.ensure_future(generate_response_ids(
+                    turn.persona_id, prompt_ids, on_token=clock, shared_prefix_len=shared_prefix_len, session_id=turn.session_id,
+                    cancellation=cancellation
+                ))
+                while True:
+                    next_token = asyncio.ensure_future(token_queue.get())
+                    waiting_for = {next_token, generation}
+                    if output_moderator is not None: # Also wake up when a chunk check finishes, to release its text.
+                        output_moderator.cleared.clear()
+                        waiting_for.add(asyncio.ensure_future(output_moderator.cleared.wait()))
+                    done, pending = await asyncio.wait(waiting_for, return_when=asyncio.FIRST_COMPLETED)
+                    for waiter in pending - {generation}:
+                        waiter.cancel()
+                    new_ids = [next_token.result()] if next_token in done else []
+                    while not token_queue.empty():
+                        new_ids.append(token_queue.get_nowait())
+                    delta = detokenizer.push(new_ids) if new_ids and detokenizer else ""
+                    if output_moderator is not None:
+                        if output_moderator.flagged is None:
+                            output_moderator.push(delta)
+                        delta = output_moderator.take_cleared()
+                    if delta:
+                        if time_to_first_token_s is None:
+                            time_to_first_token_s = time.time() - start_time
+                        streamed_text += delta
+                        yield format_sse_event({"type": "token", "text": delta})
+                    if generation.done() and token_queue.empty():
+                        break
+                try:
+                    response_ids = generation.result()
+                except GenerationCancelledError as e:
+                    if e.reason != "output_unsafe":
+                        raise
+                    response_ids = e.generated_ids
+                timer.record_generation(generation_started_at, clock.first_token_at)
+                duration_s = time.time() - start_time
+
+                with timer.stage("decoding"):
+                    aita_raw_response = await inference_executor.run(decode_response, turn.persona_id, response_ids)
+                mod_output_results = None
+                if output_moderator is not None:
+                    with timer.stage("output_moderation"): # Only the checks still running and the last chunk are waited for.
+                        mod_output_results = await output_moderator.finish(aita_raw_response)
+                aita_final_response, mod_output_results = await finalize_turn(
+                    turn, request, prompt_text, aita_raw_response, duration_s, mod_input_results, response_cache_marker(request, None), timer, mod_output_results
+                )
+                remember_response(turn, request, aita_raw_response, mod_output_results)
+                outcome = "completed"
+                if not streamed_text:
+                    # Nothing was streamed incrementally (e.g. "process" executor mode, or the reply was held back by output
+                    # moderation): send the moderated reply as one chunk.
+                    time_to_first_token_s = time.time() - start_time
+                    yield format_sse_event({"type": "token", "text": aita_final_response})
+                elif output_moderator is not None and mod_output_results["is_safe"] and aita_final_response.startswith(streamed_text):
+                    # The rest of the reply, held back until its moderation finished above.
+                    if aita_final_response[len(streamed_text):]:
+                        yield format_sse_event({"type": "token", "text": aita_final_response[len(streamed_text):]})
+
+                yield format_sse_event({
+                    "type": "done", "session_id": turn.session_id, "aita_response": aita_final_response,
+                    "debug_info": {"model_used": model_name,
+                                   "aita_persona_resolved": turn.persona_id,
+                                   "user_profile_found": bool(turn.user_profile),
+                                   "lms_context_found": bool(turn.lms_context),
+                                   "output_moderation_triggered": not mod_output_results["is_safe"],
+                                   "time_to_first_token_seconds": time_to_first_token_s,
+                                   "generation_duration_seconds": duration_s,
+                                   "stage_seconds": timer.seconds}
+                })
+            except GenerationCancelledError:
+                raise
+            except Exception as e:
+                service_logger.error(f"Exception during streamed model interaction: {e}", exc_info=True)
+                yield format_sse_event({"type": "error", "status_code": 500, "detail": f"Error during model interaction: {str(e)}"})
+    except AdmissionRejectedError as e:
+        outcome = "rejected"
+        service_logger.warning(f"Streamed turn not admitted ({e.reason}); Retry-After {e.retry_after_s}s.")
+        yield format_sse_event({"type": "error", "status_code": 503, "detail": "The tutor is busy right now. Please try again shortly.", "reason": e.reason, "retry_after_s": e.retry_after_s})
+    except GenerationCancelledError as e:
+        outcome, response_ids = e.reason, e.generated_ids
+        await log_abandoned_turn(turn, request, prompt_text, e.generated_ids, time.time() - turn_started_at, mod_input_results, e.reason)
+        status_code, detail = abandoned_turn_status(e.reason)
+        yield format_sse_event({"type": "error", "status_code": status_code, "detail": detail, "reason": e.reason})
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        cancellation.cancel("cancelled")
+        # This task is being torn down, so the xAPI statement is written by a separate task.
+        asyncio.ensure_future(log_cancelled_stream(turn, request, prompt_text, generation, turn_started_at, mod_input_results))
+        raise
+    finally:
+        if output_moderator is not None:
+            output_moderator.cancel()
+        record_turn_metrics("interact_stream", outcome, timer, time.time() - turn_started_at, turn.persona_id, prompt_ids, response_ids)
+
+async def log_cancelled_stream(
+    turn: TurnContext, request: InteractionRequest, prompt_text: Optional[str], generation: Optional["asyncio.Future[List[int]]"],
+    turn_started_at: float, mod_input_results: Optional[Dict[str, Any]]
+):
+    partial_ids: List[int] = []
+    if generation is not None:
+        try:
+            partial_ids = await generation # Retires promptly now that the turn is cancelled.
+        except GenerationCancelledError as e:
+            partial_ids = e.generated_ids
+        except Exception:
+            pass
+    await log_abandoned_turn(turn, request, prompt_text, partial_ids, time.time() - turn_started_at, mod_input_results, "cancelled")
+
+@app.post("/interact/stream")
+async def interact_with_aita_stream(request: InteractionRequest):
+    """
+    Streaming variant of `/interact`. Emits `text/event-stream` events as tokens are generated.
+    The reply is moderated in chunks while it streams (see AITA_OUTPUT_MODERATION_CHUNK_CHARS), and a
+    "token" event only carries text whose chunk has passed moderation; an unsafe chunk stops generation
+    and is never sent. When output moderation rejects the reply, the "done" event's `aita_response`
+    replaces any text streamed before the unsafe chunk and `debug_info.output_moderation_triggered` is true.
+    A full admission queue is refused with a plain 503 + Retry-After before the stream starts; a turn
+    rejected later (queue timeout, shed) gets an "error" event with `retry_after_s`.
+    """
+    timer = StageTimer()
+    turn_started_at = time.time()
+    turn = build_turn_context(request, timer)
+    try:
+        ADMISSION_CONTROLLER.raise_if_full(request.request_class)
+    except AdmissionRejectedError as e:
+        record_turn_metrics("interact_stream", "rejected", timer, time.time() - turn_started_at, turn.persona_id)
+        return admission_rejected_response(e)
+    return StreamingResponse(
+        stream_turn_events(turn, request, CancellationToken.with_timeout(REQUEST_TIMEOUT_S), timer, turn_started_at), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-# --- 7. Main block for Uvicorn ---
+# --- 8. Main block for Uvicorn ---
 if __name__ == "__main__":
     service_logger.info("Starting AITA Interaction Service with Uvicorn (V1 Full Implementation with Model Loader Utility)...")
     for path_val in ADAPTER_CONFIG.values():
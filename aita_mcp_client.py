@@ -9,7 +9,7 @@ import uuid
 import time
 
 # --- Import new utility ---
-from model_loader_utils import load_model_tokenizer_with_adapter, DummySLM # Import DummySLM
+from model_loader_utils import load_model_tokenizer_with_adapter, assisted_generation_kwargs, DummySLM # Import DummySLM
 
 # MCP Imports
 from modelcontextprotocol.client.stdio_client import MCPStdIOClient
@@ -22,6 +22,10 @@ from moderation_service import ModerationService
 MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
 MAX_HISTORY_TURNS = 3
 XAPI_LOG_FILE_PATH = "xapi_statements.jsonl"
+# Optional small draft model for assisted (speculative) decoding; unset generates with the persona model alone.
+DRAFT_MODEL_ID: Optional[str] = os.environ.get("AITA_DRAFT_MODEL_ID") or None
+# "hf" (PyTorch), "onnx" (ONNX Runtime CPU graph with the adapter merged in) or "dummy"; see inference_backends.py.
+INFERENCE_BACKEND = os.environ.get("AITA_INFERENCE_BACKEND", "hf")
 
 DEFAULT_STUDENT_ID = "student001"
 DEFAULT_SUBJECT = "ReadingComprehension"
@@ -67,7 +71,8 @@ def fetch_lms_activity_context(mcp_client: MCPStdIOClient, student_id: str, subj
         return None
 
 # 4. Chat Loop (Adjusted for potential DummySLM from utility)
-def chat_with_aita(model: Any, tokenizer: AutoTokenizer, device: torch.device, mcp_client: MCPStdIOClient, moderation_service: ModerationService, student_id_override: Optional[str] = None):
+def chat_with_aita(model: Any, tokenizer: AutoTokenizer, device: torch.device, mcp_client: MCPStdIOClient, moderation_service: ModerationService, student_id_override: Optional[str] = None,
+                   draft_model: Optional[Any] = None, draft_tokenizer: Optional[AutoTokenizer] = None):
     current_student_id = student_id_override if student_id_override else DEFAULT_STUDENT_ID
     current_subject = DEFAULT_SUBJECT
     current_item_id = DEFAULT_ITEM_ID
@@ -83,6 +88,7 @@ def chat_with_aita(model: Any, tokenizer: AutoTokenizer, device: torch.device, m
     subject_from_context = lms_context.get("subject", current_subject) if lms_context else current_subject
     item_id_for_context = lms_context.get("current_passage_id", lms_context.get("current_item_id", "unknown_item")) if lms_context else "unknown_item"
     teacher_notes = lms_context.get("teacher_notes_for_student_on_lo", "") if lms_context else ""
+    teacher_note_info = f'Your teacher left a note: "{teacher_notes}" ' if teacher_notes else ''
     AITA_PERSONA_NAME = "Explorer AITA"
     if "ReadingComprehension" in subject_from_context: AITA_PERSONA_NAME = "Reading Explorer AITA"
     elif "Ecology" in subject_from_context or "Science" in subject_from_context: AITA_PERSONA_NAME = "Eco Explorer AITA"
@@ -90,7 +96,7 @@ def chat_with_aita(model: Any, tokenizer: AutoTokenizer, device: torch.device, m
     system_prompt = (
         f"You are {AITA_PERSONA_NAME}, a friendly and helpful AI tutor for {lms_context.get('grade_level','middle school')} {subject_from_context}. "
         f"You are currently helping a student with '{passage_title_from_context}'. The learning objective is: '{lo_description_from_context}'. "
-        f"The relevant text snippet is: \"{passage_text_from_context}\" {f'Your teacher left a note: \"{teacher_notes}\" ' if teacher_notes else ''}"
+        f"The relevant text snippet is: \"{passage_text_from_context}\" {teacher_note_info}"
         "Guide students with questions; don't give answers directly. Keep responses concise and age-appropriate."
     )
     initial_aita_message = f"Hi! I'm {AITA_PERSONA_NAME}. I see you're working on '{passage_title_from_context}'. The learning goal is: '{lo_description_from_context}'. {teacher_notes if teacher_notes else ''} What are your first thoughts or questions?"
@@ -98,6 +104,11 @@ def chat_with_aita(model: Any, tokenizer: AutoTokenizer, device: torch.device, m
         initial_aita_message = f"Hi! I'm {AITA_PERSONA_NAME}. What would you like to work on today?"
         system_prompt = (f"You are {AITA_PERSONA_NAME}, a friendly and helpful AI tutor. Guide students with questions. Keep responses concise and age-appropriate.")
 
+    # Assisted decoding is skipped for the DummySLM fallback, which has no real forward pass.
+    assisted_kwargs = assisted_generation_kwargs(draft_model, draft_tokenizer, tokenizer) if not isinstance(model, DummySLM) else {}
+    if assisted_kwargs:
+        logger.info("Assisted (speculative) decoding enabled with the draft model.")
+
     conversation_history: List[Dict[str, str]] = []
     session_id = uuid.uuid4().hex
     turn_counter = 0
@@ -166,7 +177,7 @@ def chat_with_aita(model: Any, tokenizer: AutoTokenizer, device: torch.device, m
                     inputs.input_ids, max_new_tokens=300,
                     eos_token_id=tokenizer.eos_token_id,
                     pad_token_id=tokenizer.pad_token_id,
-                    temperature=0.7, top_p=0.9, do_sample=True
+                    temperature=0.7, top_p=0.9, do_sample=True, **assisted_kwargs
                 )
 
             generation_duration_s = time.time() - generation_start_time
@@ -235,7 +246,8 @@ if __name__ == "__main__":
         model, tokenizer, device = load_model_tokenizer_with_adapter(
             MODEL_ID,
             adapter_path=ADAPTER_CHECKPOINT_PATH,
-            logger=logger
+            logger=logger,
+            backend=INFERENCE_BACKEND
         )
 
         # Refined DummySLM fallback logic
@@ -266,8 +278,16 @@ if __name__ == "__main__":
                  with open(XAPI_LOG_FILE_PATH, 'a') as f: json.dump(critical_error_log, f); f.write('\n')
                  model = None
 
+        draft_model, draft_tokenizer = None, None
+        if DRAFT_MODEL_ID and INFERENCE_BACKEND == "hf" and model is not None and not isinstance(model, DummySLM):
+            logger.info(f"Loading draft model '{DRAFT_MODEL_ID}' for assisted decoding...")
+            draft_model, draft_tokenizer, _ = load_model_tokenizer_with_adapter(DRAFT_MODEL_ID, adapter_path=None, logger=logger)
+            if draft_model is None:
+                logger.warning(f"Failed to load draft model '{DRAFT_MODEL_ID}'. Generating without assistance.")
+
         if model and tokenizer and device:
-            chat_with_aita(model, tokenizer, device, mcp_client, moderation_service, student_id_override=student_id_for_session)
+            chat_with_aita(model, tokenizer, device, mcp_client, moderation_service, student_id_override=student_id_for_session,
+                           draft_model=draft_model, draft_tokenizer=draft_tokenizer)
         else:
             logger.error("Failed to initialize model and tokenizer even with DummySLM fallback. Exiting CLI.")
             critical_error_log = {
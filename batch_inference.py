@@ -0,0 +1,256 @@
+# batch_inference.py
+"""
+Offline batch inference for evaluating a persona adapter on many prompts without the HTTP service.
+
+Reads a JSONL file of `InteractionRequest`-shaped records (user_utterance, conversation_history,
+aita_persona_id, current_item_title, current_item_text_snippet, target_learning_objectives, plus an
+optional "id", "grade_level" and "teacher_notes_for_student_on_lo"), builds the same chat prompt the service builds, and generates with
+the model loaded by `load_model_tokenizer_with_adapter`:
+- prompts are tokenized up front and sorted by length, so each padded batch holds prompts of similar
+  length (`--batch_size` prompts, at most `--max_batch_tokens` padded prompt tokens) and little
+  compute goes to padding;
+- each batch is left-padded and generated in one `model.generate` call; its replies are then
+  moderated together and appended to the output JSONL, which is flushed after every batch;
+- re-running with the same output file resumes: records whose "id" is already there are skipped
+  (records without an "id" are identified by their line number in the input file).
+
+Decoding is greedy by default so runs are comparable; `--do_sample` uses the service's sampling
+settings. The throughput report (prompts/s, generated tokens/s, padding share, time in generation
+and moderation) is printed as JSON and optionally written to `--output_json`.
+
+Usage:
+    python batch_inference.py --input_jsonl eval_prompts.jsonl --output_jsonl eval_outputs.jsonl --adapter_path ./adapters/reading_explorer_pilot1
+    python batch_inference.py --input_jsonl eval_prompts.jsonl --output_jsonl eval_outputs.jsonl --backend onnx --batch_size 16 --output_json batch_report.json
+"""
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from inference_backends import INFERENCE_BACKENDS
+from model_loader_utils import DefaultLogger, load_model_tokenizer_with_adapter
+from tutor_prompt import build_tutor_system_prompt
+
+# --- 1. Configuration ---
+DEFAULT_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+DEFAULT_MODERATION_MODEL = "unitary/toxic-bert"
+# Same sampling settings as the AITA Interaction Service (used with --do_sample).
+GENERATION_TEMPERATURE = 0.7
+GENERATION_TOP_P = 0.9
+
+logger = DefaultLogger()
+
+
+# --- 2. Records and prompts ---
+def read_records(input_path: str) -> List[Dict[str, Any]]:
+    """Loads the input JSONL; records without an "id" get their 1-based line number as id."""
+    records = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record["id"] = str(record.get("id", line_number))
+            records.append(record)
+    return records
+
+def build_system_prompt(record: Dict[str, Any], persona_id: str) -> str:
+    """The service's system prompt (`build_tutor_system_prompt`), filled from the record instead of the LMS context."""
+    lo_list = record.get("target_learning_objectives") or []
+    return build_tutor_system_prompt(
+        persona_id, record.get("current_item_title") or "the current topic", record.get("current_item_text_snippet") or "a relevant educational activity",
+        lo_list[0].get("description", "the learning goal") if lo_list and isinstance(lo_list[0], dict) else "the learning goal",
+        grade_level=record.get("grade_level"), teacher_note=record.get("teacher_notes_for_student_on_lo") or ""
+    )
+
+def build_messages(record: Dict[str, Any], persona_id: str) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "content": build_system_prompt(record, persona_id)}]
+    messages.extend(record.get("conversation_history") or [])
+    messages.append({"role": "user", "content": record["user_utterance"]})
+    return messages
+
+def tokenize_prompt(tokenizer: Any, messages: List[Dict[str, str]]) -> List[int]:
+    prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(prompt_text, add_special_tokens=True).input_ids
+
+
+# --- 3. Resume ---
+def read_completed_ids(output_path: str) -> Set[str]:
+    """
+    Ids already written to `output_path`. A last line cut off by an interruption is removed from the
+    file, so appended records start on a fresh line.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb") as f:
+        data = f.read()
+    complete_len = data.rfind(b"\n") + 1
+    if complete_len < len(data):
+        logger.warning(f"Dropping an incomplete last line from '{output_path}' ({len(data) - complete_len} bytes).")
+        with open(output_path, "r+b") as f:
+            f.truncate(complete_len)
+    return {str(json.loads(line)["id"]) for line in data[:complete_len].decode("utf-8").splitlines() if line.strip()}
+
+
+# --- 4. Batching ---
+def plan_batches(prompt_lengths: List[int], batch_size: int, max_batch_tokens: int = 0) -> List[List[int]]:
+    """
+    Groups prompt indices into batches of similar length: indices are sorted by length (longest first,
+    so an out-of-memory batch shows up at once) and cut into runs of at most `batch_size` prompts whose
+    padded size (`len(batch) * longest prompt`) stays within `max_batch_tokens` (0 = no limit).
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for index in sorted(range(len(prompt_lengths)), key=lambda i: prompt_lengths[i], reverse=True):
+        # Sorted longest first, so the batch's first prompt sets its padded length.
+        padded_len = prompt_lengths[current[0]] if current else prompt_lengths[index]
+        if current and (len(current) >= batch_size or (max_batch_tokens > 0 and (len(current) + 1) * padded_len > max_batch_tokens)):
+            batches.append(current)
+            current = []
+        current.append(index)
+    if current:
+        batches.append(current)
+    return batches
+
+def generate_batch(model: Any, tokenizer: Any, device: Any, batch_prompt_ids: List[List[int]], args: argparse.Namespace) -> List[List[int]]:
+    """Generates for a left-padded batch; returns each prompt's reply ids up to (excluding) its first EOS."""
+    import torch
+    padded_len = max(len(ids) for ids in batch_prompt_ids)
+    input_ids = torch.tensor([[tokenizer.pad_token_id] * (padded_len - len(ids)) + ids for ids in batch_prompt_ids], dtype=torch.long, device=device)
+    attention_mask = torch.tensor([[0] * (padded_len - len(ids)) + [1] * len(ids) for ids in batch_prompt_ids], dtype=torch.long, device=device)
+    sampling_kwargs = {"do_sample": True, "temperature": GENERATION_TEMPERATURE, "top_p": GENERATION_TOP_P} if args.do_sample else {"do_sample": False}
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids, attention_mask=attention_mask, max_new_tokens=args.max_new_tokens,
+            eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id, **sampling_kwargs
+        )
+    responses = []
+    for row in outputs[:, padded_len:].tolist():
+        # Finished rows are filled with padding (often the EOS id) until the whole batch is done.
+        responses.append(row[:row.index(tokenizer.eos_token_id)] if tokenizer.eos_token_id in row else row)
+    return responses
+
+
+# --- 5. Moderation ---
+def build_moderation_service(model_name: str) -> Optional[Any]:
+    try:
+        from moderation_service import ModerationService
+        return ModerationService(model_name=model_name, logger=logger)
+    except Exception as e:
+        logger.error(f"Moderation model '{model_name}' unavailable ({e}); outputs will not be moderated.")
+        return None
+
+def moderate_texts(moderation_service: Optional[Any], texts: List[str]) -> List[Optional[Dict[str, Any]]]:
+    if moderation_service is None:
+        return [None] * len(texts)
+    return moderation_service.check_texts(texts)
+
+
+# --- 6. Runner ---
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    load_start = time.perf_counter()
+    model, tokenizer, device = load_model_tokenizer_with_adapter(args.model_id, adapter_path=args.adapter_path, logger=logger, torch_dtype_str=args.torch_dtype, backend=args.backend)
+    if model is None or tokenizer is None:
+        raise RuntimeError(f"Could not load '{args.model_id}' with adapter '{args.adapter_path}'.")
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    moderation_service = build_moderation_service(args.moderation_model) if not args.skip_moderation else None
+    load_seconds = time.perf_counter() - load_start
+
+    records = read_records(args.input_jsonl)
+    completed_ids = read_completed_ids(args.output_jsonl)
+    pending = [record for record in records if record["id"] not in completed_ids]
+    logger.info(f"{len(records)} record(s) in '{args.input_jsonl}': {len(records) - len(pending)} already in '{args.output_jsonl}', {len(pending)} to run.")
+
+    prompts: List[Tuple[Dict[str, Any], str, List[int]]] = []
+    invalid = 0
+    for record in pending:
+        if not record.get("user_utterance"):
+            logger.warning(f"Skipping record '{record['id']}': no user_utterance.")
+            invalid += 1
+            continue
+        persona_id = args.persona_id or record.get("aita_persona_id") or "default_phi3_base"
+        prompts.append((record, persona_id, tokenize_prompt(tokenizer, build_messages(record, persona_id))))
+    batches = plan_batches([len(ids) for _, _, ids in prompts], args.batch_size, args.max_batch_tokens)
+
+    totals = {"records": 0, "failed": 0, "prompt_tokens": 0, "padded_prompt_tokens": 0, "generated_tokens": 0, "unsafe": 0}
+    generation_seconds = moderation_seconds = 0.0
+    run_start = time.perf_counter()
+    with open(args.output_jsonl, "a", encoding="utf-8") as out:
+        for batch_number, batch in enumerate(batches, start=1):
+            batch_prompt_ids = [prompts[i][2] for i in batch]
+            start = time.perf_counter()
+            try:
+                response_ids = generate_batch(model, tokenizer, device, batch_prompt_ids, args)
+            except Exception as e:
+                # Not written, so the next run retries these records.
+                logger.error(f"Batch {batch_number}/{len(batches)} ({len(batch)} prompts) failed: {e}", exc_info=True)
+                totals["failed"] += len(batch)
+                continue
+            generation_seconds += time.perf_counter() - start
+            responses = [tokenizer.decode(ids, skip_special_tokens=True).strip() for ids in response_ids]
+
+            start = time.perf_counter()
+            moderation_results = moderate_texts(moderation_service, responses)
+            moderation_seconds += time.perf_counter() - start
+
+            for i, ids, response, moderation in zip(batch, response_ids, responses, moderation_results):
+                record, persona_id, prompt_ids = prompts[i]
+                out.write(json.dumps({
+                    "id": record["id"], "aita_persona_id": persona_id, "user_utterance": record["user_utterance"], "aita_response": response,
+                    "prompt_tokens": len(prompt_ids), "generated_tokens": len(ids), "moderation": moderation,
+                }) + "\n")
+                totals["unsafe"] += bool(moderation and not moderation.get("is_safe"))
+            out.flush()
+            os.fsync(out.fileno())
+
+            totals["records"] += len(batch)
+            totals["prompt_tokens"] += sum(len(ids) for ids in batch_prompt_ids)
+            totals["padded_prompt_tokens"] += len(batch) * max(len(ids) for ids in batch_prompt_ids)
+            totals["generated_tokens"] += sum(len(ids) for ids in response_ids)
+            logger.info(f"Batch {batch_number}/{len(batches)}: {len(batch)} prompts, {totals['records']}/{len(prompts)} done.")
+    wall_seconds = time.perf_counter() - run_start
+
+    return {
+        "model_id": args.model_id, "adapter_path": args.adapter_path, "backend": args.backend, "torch_dtype": args.torch_dtype,
+        "moderation_model": args.moderation_model if moderation_service is not None else None,
+        "input_records": len(records), "resumed_records": len(records) - len(pending), "invalid_records": invalid,
+        "batches": len(batches), "batch_size": args.batch_size, "max_batch_tokens": args.max_batch_tokens, **totals,
+        "padding_share": round(1 - totals["prompt_tokens"] / totals["padded_prompt_tokens"], 4) if totals["padded_prompt_tokens"] else None,
+        "load_seconds": round(load_seconds, 3), "wall_seconds": round(wall_seconds, 3),
+        "generation_seconds": round(generation_seconds, 3), "moderation_seconds": round(moderation_seconds, 3),
+        "prompts_per_second": round(totals["records"] / wall_seconds, 3) if wall_seconds else None,
+        "generated_tokens_per_second": round(totals["generated_tokens"] / generation_seconds, 2) if generation_seconds else None,
+    }
+
+
+# --- 7. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of AITA interaction requests through a persona model in padded batches.")
+    parser.add_argument("--input_jsonl", required=True, help="InteractionRequest-shaped records, one per line.")
+    parser.add_argument("--output_jsonl", required=True, help="Appended to; records already in it are skipped (resume).")
+    parser.add_argument("--model_id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--adapter_path", default=None, help="PEFT adapter to evaluate.")
+    parser.add_argument("--persona_id", default=None, help="Persona named in the system prompt (default: each record's aita_persona_id).")
+    parser.add_argument("--backend", choices=INFERENCE_BACKENDS, default="hf")
+    parser.add_argument("--torch_dtype", default="auto")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_batch_tokens", type=int, default=0, help="Cap on padded prompt tokens per batch (0 = no cap).")
+    parser.add_argument("--max_new_tokens", type=int, default=300)
+    parser.add_argument("--do_sample", action="store_true", help="Sample like the service instead of greedy decoding.")
+    parser.add_argument("--moderation_model", default=DEFAULT_MODERATION_MODEL)
+    parser.add_argument("--skip_moderation", action="store_true")
+    parser.add_argument("--output_json", default=None, help="Also write the throughput report to this file.")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
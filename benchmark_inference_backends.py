@@ -0,0 +1,125 @@
+# benchmark_inference_backends.py
+"""
+Parity and latency check of the inference backends (see inference_backends.py) on the same prompts.
+
+Each backend loads the same model and adapter through `load_model_tokenizer_with_adapter(backend=...)`
+and answers a fixed set of AITA prompts with greedy decoding, so outputs are deterministic. Reported:
+- per backend: load time (the ONNX backend includes its one-time export when no graph exists yet),
+  per-prompt latency (median of `--runs`), mean latency and generated tokens/sec;
+- parity against the first backend (`hf` by default): prompts with identical token ids, and the
+  share of generated tokens that match before the first divergence. The fp32 ONNX graph should
+  match exactly; an int8 graph may diverge after a while. `dummy` returns a fixed reply, so it
+  only shows the cost of the surrounding pipeline.
+
+Usage:
+    python benchmark_inference_backends.py --adapter_path ./adapters/reading_explorer_pilot1 --output_json backend_report.json
+    python benchmark_inference_backends.py --backends hf onnx --torch_dtype int8   # int8 PyTorch vs int8 ONNX Runtime
+"""
+import argparse
+import json
+import statistics
+import time
+from typing import Any, Dict, List
+
+import torch
+
+from inference_backends import INFERENCE_BACKENDS
+from model_loader_utils import load_model_tokenizer_with_adapter
+
+# --- 1. Configuration ---
+DEFAULT_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+SYSTEM_PROMPT = "You are ReadingExplorerAITA_4thGrade_Pilot1, a helpful AI Tutor. The student is in grade 4. You are discussing 'Lily the Lost Kitten'. Respond clearly, concisely, and age-appropriately. Guide the student; don't just give answers."
+BENCHMARK_UTTERANCES = [
+    "What is the story about?",
+    "Why was Lily scared?",
+    "What does the word 'cozy' mean?",
+    "How do plants get the energy they need to grow?",
+    "Can you give me a hint about the main idea?",
+]
+
+
+# --- 2. Benchmark ---
+def run_backend(backend: str, args: argparse.Namespace) -> Dict[str, Any]:
+    start = time.perf_counter()
+    model, tokenizer, device = load_model_tokenizer_with_adapter(args.model_id, adapter_path=args.adapter_path, torch_dtype_str=args.torch_dtype, backend=backend)
+    load_seconds = time.perf_counter() - start
+    if model is None or tokenizer is None:
+        raise RuntimeError(f"Backend '{backend}' could not load '{args.model_id}'.")
+
+    prompts: List[List[int]] = []
+    for utterance in BENCHMARK_UTTERANCES:
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": utterance}]
+        prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prompts.append(tokenizer(prompt_text, return_tensors="pt", add_special_tokens=True).input_ids[0].tolist())
+
+    def generate(prompt_ids: List[int]) -> List[int]:
+        with torch.no_grad():
+            output = model.generate(
+                torch.tensor([prompt_ids], device=device), max_new_tokens=args.max_new_tokens, do_sample=False,
+                eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id
+            )
+        return output[0][len(prompt_ids):].tolist()
+
+    generate(prompts[0]) # Warm-up, not counted.
+    outputs, latencies = [], []
+    for prompt_ids in prompts:
+        samples = []
+        for _ in range(args.runs):
+            run_start = time.perf_counter()
+            response_ids = generate(prompt_ids)
+            samples.append(time.perf_counter() - run_start)
+        outputs.append(response_ids)
+        latencies.append(statistics.median(samples))
+    new_tokens = sum(len(ids) for ids in outputs)
+    return {
+        "load_seconds": round(load_seconds, 3), "latency_seconds": [round(s, 4) for s in latencies],
+        "mean_latency_seconds": round(statistics.fmean(latencies), 4), "new_tokens": new_tokens,
+        "tokens_per_second": round(new_tokens / sum(latencies), 2) if sum(latencies) else None,
+        "outputs": outputs,
+    }
+
+def compare_outputs(reference: List[List[int]], candidate: List[List[int]]) -> Dict[str, Any]:
+    matching_prefix, reference_tokens = 0, 0
+    for ref_ids, ids in zip(reference, candidate):
+        reference_tokens += len(ref_ids)
+        for ref_token, token in zip(ref_ids, ids):
+            if ref_token != token:
+                break
+            matching_prefix += 1
+    return {
+        "identical_prompts": sum(ref_ids == ids for ref_ids, ids in zip(reference, candidate)), "prompts": len(reference),
+        "matching_prefix_token_share": round(matching_prefix / reference_tokens, 4) if reference_tokens else None,
+    }
+
+
+# --- 3. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Compare output parity and latency of the hf / onnx / dummy inference backends.")
+    parser.add_argument("--model_id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--adapter_path", default=None, help="Optional PEFT adapter (merged into the ONNX graph).")
+    parser.add_argument("--backends", nargs="+", choices=INFERENCE_BACKENDS, default=list(INFERENCE_BACKENDS), help="The first one is the parity reference.")
+    parser.add_argument("--torch_dtype", default="float32", help="float32 for an exact-parity comparison, or int8 for quantized PyTorch and ONNX Runtime.")
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per prompt (median reported).")
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    results = {backend: run_backend(backend, args) for backend in args.backends}
+    reference = args.backends[0]
+    report: Dict[str, Any] = {
+        "model_id": args.model_id, "adapter_path": args.adapter_path, "torch_dtype": args.torch_dtype,
+        "max_new_tokens": args.max_new_tokens, "num_prompts": len(BENCHMARK_UTTERANCES), "parity_reference": reference, "backends": {},
+    }
+    reference_outputs = results[reference]["outputs"]
+    for backend, result in results.items():
+        outputs = result.pop("outputs")
+        report["backends"][backend] = {**result, "parity": compare_outputs(reference_outputs, outputs) if backend != reference else None}
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
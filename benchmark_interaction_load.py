@@ -0,0 +1,269 @@
+# benchmark_interaction_load.py
+"""
+Load test for the AITA Interaction Service's `/interact` endpoint, with `DummySLM` in place
+of the persona models so it runs anywhere (no GPU, no model download) and is repeatable.
+
+`DummySLM` sleeps `--prefill_latency_ms` per prompt token and `--decode_latency_ms` per
+generated token, so generation cost grows with the prompt like a real model's. `--students`
+simulated students run concurrently. Each one holds a session of `--turns` turns and resends
+its growing `conversation_history` (previous utterances and replies) on every turn.
+
+The app runs in this process, either behind an in-memory ASGI transport (`--transport asgi`,
+the default) or on a localhost uvicorn server (`--transport http`, includes HTTP overhead).
+The rest of the service (moderation, executor, caches) runs as configured by the usual
+AITA_* environment variables. If the moderation model cannot be loaded the service's
+dummy moderation is used, and the report says so.
+
+`--bulk_students` adds clients that send the same turns as `request_class="bulk"`, so the
+admission queue's priorities can be seen under overload (AITA_MAX_CONCURRENT_REQUESTS,
+AITA_MAX_QUEUE_DEPTH). Rejected turns (503) are counted and retried after their Retry-After,
+up to `--max_retries` times.
+
+Reported as JSON: p50/p95/p99 latency, requests/sec, errors, latency by turn number (history
+growth) and by request class, the same percentiles per pipeline stage from
+`debug_info["stage_seconds"]`, and the service's admission-control snapshot.
+
+Usage:
+    python benchmark_interaction_load.py --students 32 --turns 6 --output_json load_report.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+# --- 1. Configuration ---
+STUDENT_UTTERANCES = [
+    "What is the story about?",
+    "Why was Lily scared?",
+    "What does the word 'cozy' mean?",
+    "Can you give me a hint about the main idea?",
+    "I think she felt lonely. Is that right?",
+    "How did the story end?",
+    "What would you do if you were lost?",
+    "Can you explain that again in a simpler way?",
+]
+ACTIVITIES = [
+    {"subject": "ReadingComprehension", "current_item_id": "passage_kitten_001", "aita_persona_id": "ReadingExplorerAITA_4thGrade_Pilot1"},
+    {"subject": "Ecology", "current_item_id": "eco_passage_foodweb_001", "aita_persona_id": "EcoExplorerAITA_7thGrade_Pilot1"},
+]
+
+
+# --- 2. Simple tokenizer (used when no --tokenizer_id is given) ---
+class WordTokenizer:
+    """Whitespace tokenizer with a chat template, growing its vocabulary on the fly. Enough for DummySLM."""
+    eos_token_id = 1
+    pad_token_id = 0
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._words: List[str] = ["<pad>", "<eos>"]
+        self._lock = threading.Lock()
+
+    def apply_chat_template(self, messages: List[Dict[str, str]], tokenize: bool = False, add_generation_prompt: bool = True) -> str:
+        text = "".join(f"<|{m['role']}|> {m['content']} <|end|> " for m in messages)
+        return text + "<|assistant|> " if add_generation_prompt else text
+
+    def encode(self, text: str, add_special_tokens: bool = False, return_tensors: Optional[str] = None):
+        import torch
+        ids = []
+        with self._lock:
+            for word in text.split():
+                if word not in self._ids:
+                    self._ids[word] = len(self._words)
+                    self._words.append(word)
+                ids.append(self._ids[word])
+        return torch.tensor([ids], dtype=torch.long) if return_tensors == "pt" else ids
+
+    def __call__(self, text: str, return_tensors: Optional[str] = None, add_special_tokens: bool = True) -> Any:
+        return type("Encoding", (), {"input_ids": self.encode(text, return_tensors=return_tensors)})()
+
+    def decode(self, ids: List[int], skip_special_tokens: bool = True) -> str:
+        return " ".join(self._words[i] for i in ids if not (skip_special_tokens and i < 2))
+
+
+# --- 3. Service setup ---
+def configure_service(args: argparse.Namespace) -> Any:
+    """Imports the service with every persona model replaced by a latency-configured DummySLM."""
+    os.environ.setdefault("AITA_CONTINUOUS_BATCHING", str(args.continuous_batching))
+    import torch
+    import aita_interaction_service as svc
+    from model_loader_utils import DummySLM
+
+    if args.tokenizer_id:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_id)
+    else:
+        tokenizer = WordTokenizer()
+    device = torch.device("cpu")
+
+    def load_dummy(model_id: str, adapter_path: Optional[str] = None, logger: Any = None, **kwargs: Any):
+        model = DummySLM(device, tokenizer, logger=logger, prefill_latency_s=args.prefill_latency_ms / 1000, decode_latency_s=args.decode_latency_ms / 1000)
+        return model, tokenizer, device
+
+    svc.load_model_tokenizer_with_adapter = load_dummy
+    svc.load_model_tokenizer_with_adapters = lambda model_id, adapter_paths, **kwargs: (*load_dummy(model_id, **kwargs), [])
+    return svc
+
+
+# --- 4. Simulated students ---
+async def run_student(
+    client: httpx.AsyncClient, student_index: int, turns: int, think_time_s: float, rng: random.Random, samples: List[Dict[str, Any]],
+    request_class: str = "student", max_retries: int = 0
+):
+    activity = ACTIVITIES[student_index % len(ACTIVITIES)]
+    session_id, history = f"load_{request_class}_{student_index}", []
+    for turn_index in range(turns):
+        utterance = rng.choice(STUDENT_UTTERANCES)
+        payload = {
+            "session_id": session_id, "user_id": f"student{student_index:03d}", "user_utterance": utterance, "conversation_history": list(history),
+            "request_class": request_class, **activity
+        }
+        start, rejections = time.perf_counter(), 0
+        while True:
+            try:
+                response = await client.post("/interact", json=payload)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                response, status = None, type(e).__name__
+            if status != 503 or rejections >= max_retries:
+                break
+            rejections += 1
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+        sample = {
+            "turn": turn_index, "history_messages": len(history), "request_class": request_class, "status": status,
+            "rejections": rejections, "latency_seconds": time.perf_counter() - start
+        }
+        if response is not None and status == 200:
+            body = response.json()
+            sample["stage_seconds"] = (body.get("debug_info") or {}).get("stage_seconds", {})
+            history += [{"role": "user", "content": utterance}, {"role": "assistant", "content": body["aita_response"]}]
+        samples.append(sample)
+        if think_time_s > 0:
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think_time_s)
+
+
+# --- 5. Report ---
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile (q in 0..100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values), "mean": round(statistics.fmean(values), 4),
+        "p50": round(percentile(values, 50), 4), "p95": round(percentile(values, 95), 4), "p99": round(percentile(values, 99), 4), "max": round(max(values), 4),
+    }
+
+def build_report(samples: List[Dict[str, Any]], wall_seconds: float) -> Dict[str, Any]:
+    ok = [s for s in samples if s["status"] == 200]
+    stage_names = sorted({name for s in ok for name in s.get("stage_seconds", {})})
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if s["status"] != 200:
+            errors[str(s["status"])] = errors.get(str(s["status"]), 0) + 1
+    return {
+        "requests": len(samples), "successful_requests": len(ok), "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(len(ok) / wall_seconds, 3) if wall_seconds else None,
+        "latency_seconds": summarize([s["latency_seconds"] for s in ok]),
+        "latency_seconds_by_turn": {str(turn): summarize([s["latency_seconds"] for s in ok if s["turn"] == turn]) for turn in sorted({s["turn"] for s in ok})},
+        "latency_seconds_by_request_class": {name: summarize([s["latency_seconds"] for s in ok if s["request_class"] == name]) for name in sorted({s["request_class"] for s in samples})},
+        "rejected_attempts": sum(s["rejections"] for s in samples),
+        "stage_seconds": {name: summarize([s["stage_seconds"][name] for s in ok if name in s.get("stage_seconds", {})]) for name in stage_names},
+    }
+
+
+# --- 6. Main ---
+async def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    svc = configure_service(args)
+    server, server_task = None, None
+    if args.transport == "http":
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config(svc.app, host="127.0.0.1", port=args.port, log_level="warning"))
+        server_task = asyncio.get_running_loop().create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+        client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=args.request_timeout_s, limits=httpx.Limits(max_connections=args.students))
+    else:
+        await svc.startup_event()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=svc.app), base_url="http://loadtest", timeout=args.request_timeout_s)
+
+    try:
+        # Startup is not part of the measurement: wait for the service to report ready.
+        while (await client.get("/ready")).status_code != 200:
+            await asyncio.sleep(0.1)
+        components = (await client.get("/ready")).json()["components"]
+        samples: List[Dict[str, Any]] = []
+        rng = random.Random(args.seed)
+        start = time.perf_counter()
+        clients = [("student", i) for i in range(args.students)] + [("bulk", args.students + i) for i in range(args.bulk_students)]
+        await asyncio.gather(*(
+            run_student(client, i, args.turns, args.think_time_s, random.Random(rng.random()), samples, request_class=request_class, max_retries=args.max_retries)
+            for request_class, i in clients
+        ))
+        wall_seconds = time.perf_counter() - start
+        admission = (await client.get("/models/admission")).json()
+    finally:
+        await client.aclose()
+        if server is not None:
+            server.should_exit = True
+            await server_task
+        else:
+            await svc.shutdown_event()
+
+    return {
+        "config": {
+            "transport": args.transport, "students": args.students, "bulk_students": args.bulk_students, "turns": args.turns, "think_time_s": args.think_time_s,
+            "prefill_latency_ms": args.prefill_latency_ms, "decode_latency_ms": args.decode_latency_ms,
+            "tokenizer": args.tokenizer_id or "builtin_word_tokenizer", "executor_mode": svc.EXECUTOR_MODE,
+            "continuous_batching": svc.ENABLE_CONTINUOUS_BATCHING, "max_concurrent_requests": svc.MAX_CONCURRENT_REQUESTS,
+            "max_queue_depth": svc.MAX_QUEUE_DEPTH, "moderation": components.get("moderation", {}).get("state"),
+        },
+        **build_report(samples, wall_seconds),
+        "admission": admission,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /interact with simulated students and a latency-configured DummySLM.")
+    parser.add_argument("--students", type=int, default=16, help="Concurrent simulated students.")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per student; conversation_history grows by two messages per turn.")
+    parser.add_argument("--bulk_students", type=int, default=0, help="Additional concurrent clients sending request_class='bulk' turns.")
+    parser.add_argument("--max_retries", type=int, default=3, help="Retries of a turn rejected with 503, each after its Retry-After.")
+    parser.add_argument("--think_time_s", type=float, default=0.0, help="Mean pause between a student's turns.")
+    parser.add_argument("--prefill_latency_ms", type=float, default=0.2, help="DummySLM delay per prompt token.")
+    parser.add_argument("--decode_latency_ms", type=float, default=20.0, help="DummySLM delay per generated token.")
+    parser.add_argument("--tokenizer_id", default=None, help="Hugging Face tokenizer to use instead of the built-in word tokenizer.")
+    parser.add_argument("--continuous_batching", type=int, default=0, choices=[0, 1],
+                        help="AITA_CONTINUOUS_BATCHING if not set in the environment. DummySLM cannot be batched, so with 1 the scheduler runs its requests one at a time.")
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi")
+    parser.add_argument("--port", type=int, default=8012, help="Port for --transport http.")
+    parser.add_argument("--request_timeout_s", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the service's own log output (hidden by default).")
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(None if args.verbose else devnull):
+        report = asyncio.run(run_load_test(args))
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
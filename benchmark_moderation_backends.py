@@ -0,0 +1,130 @@
+# benchmark_moderation_backends.py
+"""
+Parity and CPU throughput of the moderation classifier's backends (`ModerationService(backend=...,
+torch_dtype_str=...)`): the PyTorch pipeline in float32 (the reference) and int8, and ONNX Runtime
+in float32 and int8.
+
+On a labelled sample (each text marked toxic or not), every configuration reports:
+- accuracy against the labels, and how many verdicts (`is_safe` plus flagged categories) match the
+  float32 pipeline, with the largest score difference. int8 weights move scores by a few
+  hundredths, so texts near the threshold are the ones that can flip;
+- throughput: texts/sec for `check_texts` in batches of `--batch_size`, and the mean latency of a
+  single `check_text` call, the cost a turn pays when moderation is not batched;
+- load time (including the one-off ONNX export when the graph is not cached yet).
+
+The built-in sample is short; `--labelled_jsonl` takes a larger one with a "text" and a boolean
+"toxic" field per line.
+
+Usage:
+    python benchmark_moderation_backends.py --output_json moderation_backends_report.json
+    python benchmark_moderation_backends.py --labelled_jsonl moderation_eval.jsonl --configs hf:float32 onnx:int8
+"""
+import argparse
+import json
+import statistics
+import time
+from typing import Any, Dict, List, Tuple
+
+from moderation_service import ModerationService
+
+# --- 1. Configuration ---
+LABELLED_SAMPLE: List[Tuple[str, bool]] = [
+    ("What is the story about?", False),
+    ("Why was Lily scared when she got lost?", False),
+    ("What does the word 'cozy' mean?", False),
+    ("How do plants get the energy they need to grow?", False),
+    ("Can you give me a hint about the main idea?", False),
+    ("I think the kitten felt lonely because nobody was around.", False),
+    ("Great question! Think about how Lily felt when she couldn't find her way home.", False),
+    ("Producers like grass make their own food from sunlight, and consumers eat other living things for energy.", False),
+    ("This story is boring, can we do something else?", False),
+    ("I don't get it, can you explain it again?", False),
+    ("The wolf is a predator and the rabbit is its prey.", False),
+    ("Let's look at the second paragraph together. Which words tell us where Lily was hiding?", False),
+    ("You are an idiot.", True),
+    ("Shut up, you stupid bot.", True),
+    ("This is a piece of junk and I hate it, you moron.", True),
+    ("I will kill you.", True),
+    ("You're so dumb it hurts.", True),
+    ("Go to hell, loser.", True),
+    ("Nobody likes you, you ugly freak.", True),
+    ("What a useless idiot teacher.", True),
+]
+
+
+def load_labelled(path: str) -> List[Tuple[str, bool]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [(record["text"], bool(record["toxic"])) for record in (json.loads(line) for line in f if line.strip())]
+
+def verdict(result: Dict[str, Any]) -> Tuple[bool, List[str]]:
+    return result["is_safe"], sorted(result["flagged_categories"])
+
+
+# --- 2. Benchmark ---
+def run_config(model_name: str, backend: str, dtype: str, texts: List[str], args: argparse.Namespace) -> Dict[str, Any]:
+    start = time.perf_counter()
+    service = ModerationService(model_name=model_name, backend=backend, torch_dtype_str=dtype)
+    load_seconds = time.perf_counter() - start
+    service.check_texts(texts[:8]) # Warm-up, not counted.
+
+    batched_seconds = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        results = service.check_texts(texts, batch_size=args.batch_size)
+        batched_seconds.append(time.perf_counter() - start)
+    single_seconds = []
+    for text in texts:
+        start = time.perf_counter()
+        service.check_text(text)
+        single_seconds.append(time.perf_counter() - start)
+    best = min(batched_seconds)
+    return {
+        "results": results, "load_seconds": round(load_seconds, 2),
+        "batched_texts_per_second": round(len(texts) / best, 2), "single_text_latency_ms": round(1000 * statistics.fmean(single_seconds), 2),
+    }
+
+def compare(reference: List[Dict[str, Any]], candidate: List[Dict[str, Any]]) -> Dict[str, Any]:
+    max_score_diff = 0.0
+    for ref, result in zip(reference, candidate):
+        for label, score in ref["scores"].items():
+            if isinstance(score, float) and isinstance(result["scores"].get(label), float):
+                max_score_diff = max(max_score_diff, abs(score - result["scores"][label]))
+    return {"identical_verdicts": sum(verdict(ref) == verdict(result) for ref, result in zip(reference, candidate)), "texts": len(reference), "max_score_diff": round(max_score_diff, 6)}
+
+
+# --- 3. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Compare moderation backends (PyTorch / ONNX Runtime, float32 / int8) for parity and CPU throughput.")
+    parser.add_argument("--model_name", default="unitary/toxic-bert")
+    parser.add_argument("--configs", nargs="+", default=["hf:float32", "hf:int8", "onnx:float32", "onnx:int8"], help="backend:dtype pairs; the first is the reference.")
+    parser.add_argument("--labelled_jsonl", default=None, help="Labelled texts instead of the built-in sample.")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes of the batched run; the fastest counts.")
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    sample = load_labelled(args.labelled_jsonl) if args.labelled_jsonl else LABELLED_SAMPLE
+    texts, labels = [text for text, _ in sample], [toxic for _, toxic in sample]
+    runs = {config: run_config(args.model_name, *config.split(":"), texts, args) for config in args.configs}
+
+    results = {config: run.pop("results") for config, run in runs.items()}
+    reference_config = args.configs[0]
+    reference = runs[reference_config]
+    report: Dict[str, Any] = {"model_name": args.model_name, "num_texts": len(texts), "batch_size": args.batch_size, "reference": reference_config, "configs": {}}
+    for config, run in runs.items():
+        report["configs"][config] = {
+            **run,
+            "batched_speedup": round(run["batched_texts_per_second"] / reference["batched_texts_per_second"], 2),
+            "single_text_speedup": round(reference["single_text_latency_ms"] / run["single_text_latency_ms"], 2),
+            "label_accuracy": round(sum((not result["is_safe"]) == toxic for result, toxic in zip(results[config], labels)) / len(labels), 4),
+            "parity": compare(results[reference_config], results[config]),
+        }
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# benchmark_moderation_batching.py
+"""
+Throughput and parity of batched moderation (`ModerationService.check_texts` and the service's
+`ModerationMicroBatcher`) against one `check_text` call per text.
+
+Runs the same sample of student utterances and tutor replies through:
+- `sequential`: `check_text` one text at a time (the reference);
+- `check_texts@N`: `check_texts` with batches of N texts;
+- `concurrent`: `--concurrency` callers each awaiting `check_text` in a thread pool, as the
+  service did without batching;
+- `micro_batcher`: the same callers going through `ModerationMicroBatcher`, which groups texts
+  arriving within `--window_ms` into one `check_texts` call.
+
+For each mode it reports texts/sec and, against `sequential`, how many verdicts (`is_safe` plus
+flagged categories) are identical and the largest score difference. Padding in a batch can move
+scores in the last float digits, so the verdicts are what must match. The caller modes also
+report per-text latency percentiles, and `micro_batcher` its mean batch size.
+
+Usage:
+    python benchmark_moderation_batching.py --num_texts 512 --concurrency 32 --output_json moderation_batching_report.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from moderation_batcher import ModerationMicroBatcher
+from moderation_service import ModerationService
+
+# --- 1. Configuration ---
+SAMPLE_TEXTS = [
+    "What is the story about?",
+    "Why was Lily scared when she got lost?",
+    "What does the word 'cozy' mean?",
+    "How do plants get the energy they need to grow?",
+    "Can you give me a hint about the main idea?",
+    "This is a piece of junk and I hate it.",
+    "You are an idiot.",
+    "Great question! Think about how Lily felt when she couldn't find her way home. What clues does the story give?",
+    "Producers like grass make their own food from sunlight, and consumers eat other living things for energy.",
+    "I don't get it, this is so stupid.",
+    "Can we read the next chapter now?",
+    "Let's look at the second paragraph together. Which words tell us where Lily was hiding?",
+]
+
+
+def build_texts(num_texts: int) -> List[str]:
+    # Distinct strings (so nothing can be answered from a cache) with the sample's length mix.
+    return [f"{SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]} ({i // len(SAMPLE_TEXTS)})" for i in range(num_texts)]
+
+
+# --- 2. Modes ---
+def run_sequential(service: ModerationService, texts: List[str]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    results = [service.check_text(text) for text in texts]
+    return {"seconds": time.perf_counter() - start, "results": results}
+
+def run_check_texts(service: ModerationService, texts: List[str], batch_size: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    results = service.check_texts(texts, batch_size=batch_size)
+    return {"seconds": time.perf_counter() - start, "results": results}
+
+async def run_callers(service: ModerationService, texts: List[str], args: argparse.Namespace, batched: bool) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+
+    async def run_batch(batch: List[str]) -> List[Dict[str, Any]]:
+        return await loop.run_in_executor(pool, service.check_texts, batch)
+    batcher = ModerationMicroBatcher(run_batch, max_batch_size=args.max_batch_size, window_s=args.window_ms / 1000) if batched else None
+
+    results: List[Any] = [None] * len(texts)
+    latencies: List[float] = []
+    async def caller(indices: List[int]):
+        for i in indices:
+            call_start = time.perf_counter()
+            if batcher is not None:
+                results[i] = await batcher.check_text(texts[i])
+            else:
+                results[i] = await loop.run_in_executor(pool, service.check_text, texts[i])
+            latencies.append(time.perf_counter() - call_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(caller(list(range(c, len(texts), args.concurrency))) for c in range(args.concurrency)))
+    seconds = time.perf_counter() - start
+    pool.shutdown()
+    ordered = sorted(latencies)
+    run = {
+        "seconds": seconds, "results": results,
+        "latency_seconds": {"p50": round(ordered[len(ordered) // 2], 4), "p95": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 4), "mean": round(statistics.fmean(ordered), 4)},
+    }
+    if batcher is not None:
+        run["mean_batch_texts"] = batcher.snapshot()["mean_batch_texts"]
+    return run
+
+
+# --- 3. Parity ---
+def compare_results(reference: List[Dict[str, Any]], candidate: List[Dict[str, Any]]) -> Dict[str, Any]:
+    identical_verdicts, max_score_diff = 0, 0.0
+    for ref, result in zip(reference, candidate):
+        identical_verdicts += ref["is_safe"] == result["is_safe"] and sorted(ref["flagged_categories"]) == sorted(result["flagged_categories"])
+        for label, score in ref["scores"].items():
+            if isinstance(score, float) and isinstance(result["scores"].get(label), float):
+                max_score_diff = max(max_score_diff, abs(score - result["scores"][label]))
+    return {"identical_verdicts": identical_verdicts, "texts": len(reference), "max_score_diff": max_score_diff}
+
+
+# --- 4. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Compare batched and one-at-a-time moderation throughput and verdicts.")
+    parser.add_argument("--model_name", default="unitary/toxic-bert")
+    parser.add_argument("--num_texts", type=int, default=256)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent callers in the concurrent and micro_batcher modes.")
+    parser.add_argument("--workers", type=int, default=4, help="Thread pool size, like AITA_EXECUTOR_WORKERS.")
+    parser.add_argument("--window_ms", type=float, default=5.0)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    service = ModerationService(model_name=args.model_name)
+    texts = build_texts(args.num_texts)
+    service.check_texts(texts[:8]) # Warm-up, not counted.
+
+    runs: Dict[str, Dict[str, Any]] = {"sequential": run_sequential(service, texts)}
+    for batch_size in args.batch_sizes:
+        runs[f"check_texts@{batch_size}"] = run_check_texts(service, texts, batch_size)
+    runs["concurrent"] = asyncio.run(run_callers(service, texts, args, batched=False))
+    runs["micro_batcher"] = asyncio.run(run_callers(service, texts, args, batched=True))
+
+    reference, sequential_seconds = runs["sequential"]["results"], runs["sequential"]["seconds"]
+    report: Dict[str, Any] = {
+        "model_name": args.model_name, "num_texts": len(texts), "concurrency": args.concurrency, "workers": args.workers,
+        "window_ms": args.window_ms, "max_batch_size": args.max_batch_size, "modes": {},
+    }
+    for mode, run in runs.items():
+        results, seconds = run.pop("results"), run.pop("seconds")
+        report["modes"][mode] = {
+            "seconds": round(seconds, 3), "texts_per_second": round(len(texts) / seconds, 2),
+            "speedup_vs_sequential": round(sequential_seconds / seconds, 2),
+            **run, "parity": compare_results(reference, results),
+        }
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# benchmark_moderation_prefilter.py
+"""
+How much moderation traffic the lexical prefilter (moderation_prefilter.py) takes off the
+classifier, and what that saves.
+
+Every text is checked twice, one `check_text` call at a time: by the classifier alone and by
+the two-tier `ModerationService` (prefilter first, classifier for the rest). Reported:
+- the share of texts decided by each tier (lexical "allowed" / "blocked", or "model");
+- mean latency per text of each tier, and the total time of both setups, i.e. the latency saved;
+- agreement: of the texts decided lexically, how many got the classifier's verdict. A lexical
+  "blocked" that the classifier would pass shows where the blocklist is stricter; a lexical
+  "allowed" that the classifier would flag points at an allowlist phrase to remove.
+
+The default sample mixes typical student utterances, tutor replies and a few abusive lines;
+`--texts_jsonl` takes real traffic instead (a "text" or "user_utterance" field per line, e.g. the
+input of batch_inference.py).
+
+Usage:
+    python benchmark_moderation_prefilter.py --output_json moderation_prefilter_report.json
+    python benchmark_moderation_prefilter.py --texts_jsonl eval_prompts.jsonl --allowlist_path classroom_phrases.txt
+"""
+import argparse
+import json
+import statistics
+import time
+from typing import Any, Dict, List
+
+from moderation_prefilter import LexicalPrefilter
+from moderation_service import ModerationService
+
+# --- 1. Configuration ---
+SAMPLE_TEXTS = [
+    "What is the story about?",
+    "Why was Lily scared?",
+    "I don't understand the main idea.",
+    "Can you give me a hint?",
+    "What does the word 'cozy' mean?",
+    "Where was Lily hiding?",
+    "How do plants get energy from the sun?",
+    "What do producers and consumers eat?",
+    "Is a rabbit a predator or prey?",
+    "ok thanks",
+    "I think Lily felt lost and scared because she couldn't find her home.",
+    "Can we read the next chapter now?",
+    "This story is boring.",
+    "I hate this assignment, it's so stupid.",
+    "You are an idiot.",
+    "This is bullshit.",
+    "shut up",
+    "Great question! Think about how Lily felt when she couldn't find her way home. What clues does the story give?",
+    "Producers like grass make their own food from sunlight, and consumers eat other living things for energy.",
+    "Let's look at the second paragraph together. Which words tell us where Lily was hiding?",
+]
+
+
+def load_texts(path: str) -> List[str]:
+    texts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                texts.append(record.get("text") or record.get("user_utterance") or "")
+    return [text for text in texts if text]
+
+
+# --- 2. Benchmark ---
+def timed_checks(service: ModerationService, texts: List[str]) -> List[Dict[str, Any]]:
+    runs = []
+    for text in texts:
+        start = time.perf_counter()
+        result = service.check_text(text)
+        runs.append({"result": result, "seconds": time.perf_counter() - start})
+    return runs
+
+def tier_of(result: Dict[str, Any]) -> str:
+    if result.get("moderation_tier") != "lexical":
+        return "model"
+    return "lexical_allowed" if result["is_safe"] else "lexical_blocked"
+
+
+# --- 3. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Share of moderation traffic decided by the lexical prefilter, latency saved and agreement with the classifier.")
+    parser.add_argument("--model_name", default="unitary/toxic-bert")
+    parser.add_argument("--texts_jsonl", default=None, help="Texts to check instead of the built-in sample.")
+    parser.add_argument("--repeat", type=int, default=5, help="Passes over the texts (the built-in sample is small).")
+    parser.add_argument("--blocklist_path", default=None)
+    parser.add_argument("--allowlist_path", default=None)
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    texts = (load_texts(args.texts_jsonl) if args.texts_jsonl else SAMPLE_TEXTS) * args.repeat
+    model_only = ModerationService(model_name=args.model_name)
+    two_tier = ModerationService(model_name=args.model_name)
+    two_tier.pipeline = model_only.pipeline # One copy of the classifier; only the prefilter differs.
+    two_tier.prefilter = LexicalPrefilter.from_files(args.blocklist_path, args.allowlist_path)
+    model_only.check_texts(texts[:8]) # Warm-up, not counted.
+
+    reference = timed_checks(model_only, texts)
+    candidate = timed_checks(two_tier, texts)
+
+    tiers: Dict[str, Dict[str, Any]] = {}
+    for ref, run in zip(reference, candidate):
+        tier = tier_of(run["result"])
+        stats = tiers.setdefault(tier, {"texts": 0, "seconds": [], "agrees_with_model": 0})
+        stats["texts"] += 1
+        stats["seconds"].append(run["seconds"])
+        stats["agrees_with_model"] += run["result"]["is_safe"] == ref["result"]["is_safe"]
+    model_only_seconds = sum(run["seconds"] for run in reference)
+    two_tier_seconds = sum(run["seconds"] for run in candidate)
+    report: Dict[str, Any] = {
+        "model_name": args.model_name, "num_texts": len(texts),
+        "tiers": {
+            tier: {
+                "texts": stats["texts"], "share": round(stats["texts"] / len(texts), 4),
+                "mean_latency_ms": round(1000 * statistics.fmean(stats["seconds"]), 4),
+                "agrees_with_model": stats["agrees_with_model"],
+            }
+            for tier, stats in sorted(tiers.items())
+        },
+        "model_only": {"seconds": round(model_only_seconds, 4), "mean_latency_ms": round(1000 * model_only_seconds / len(texts), 4)},
+        "two_tier": {"seconds": round(two_tier_seconds, 4), "mean_latency_ms": round(1000 * two_tier_seconds / len(texts), 4)},
+        "latency_saved_share": round(1 - two_tier_seconds / model_only_seconds, 4) if model_only_seconds else None,
+        "disagreements": sorted({
+            text for text, ref, run in zip(texts, reference, candidate)
+            if run["result"].get("moderation_tier") == "lexical" and run["result"]["is_safe"] != ref["result"]["is_safe"]
+        }),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
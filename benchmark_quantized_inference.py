@@ -0,0 +1,144 @@
+# benchmark_quantized_inference.py
+"""
+Compares the int8 (dynamic quantization) CPU loading mode of `model_loader_utils` with
+the float32 baseline on a fixed set of AITA prompts.
+
+Each mode is loaded in its own fresh process, so peak RSS is measured per mode. Reported:
+- tokens/sec of greedy generation and model load time;
+- peak resident set size of the process;
+- output drift vs float32: how many greedy replies are identical, and, teacher-forced on
+  the float32 replies, the next-token agreement and mean KL divergence per position.
+
+Usage:
+    python benchmark_quantized_inference.py --adapter_path ./adapters/reading_explorer_pilot1 --output_json quant_report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import torch
+
+# --- 1. Configuration ---
+DEFAULT_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+BASELINE_DTYPE = "float32"
+QUANTIZED_DTYPE = "int8"
+SYSTEM_PROMPT = "You are ReadingExplorerAITA_4thGrade_Pilot1, a helpful AI Tutor. The student is in grade 4. You are discussing 'Lily the Lost Kitten'. Respond clearly, concisely, and age-appropriately. Guide the student; don't just give answers."
+BENCHMARK_UTTERANCES = [
+    "What is the story about?",
+    "Why was Lily scared?",
+    "What does the word 'cozy' mean?",
+    "How do plants get the energy they need to grow?",
+    "Why do leaves change color in the fall?",
+    "Can you give me a hint about the main idea?",
+]
+
+
+# --- 2. Per-mode run (executed in a fresh process) ---
+def run_mode(model_id: str, adapter_path: Optional[str], dtype_str: str, max_new_tokens: int,
+             reference_sequences: Optional[List[List[int]]], logprobs_path: str) -> Dict[str, Any]:
+    """Loads the model in `dtype_str`, times greedy generation and saves teacher-forced log-probs to `logprobs_path`."""
+    from model_loader_utils import load_model_tokenizer_with_adapter
+    torch.manual_seed(0)
+    load_start = time.time()
+    model, tokenizer, device = load_model_tokenizer_with_adapter(model_id=model_id, adapter_path=adapter_path, torch_dtype_str=dtype_str)
+    load_seconds = time.time() - load_start
+    if model is None or tokenizer is None:
+        raise RuntimeError(f"Could not load '{model_id}' with dtype '{dtype_str}'.")
+
+    prompts = []
+    for utterance in BENCHMARK_UTTERANCES:
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": utterance}]
+        prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prompts.append(tokenizer(prompt_text, return_tensors="pt", add_special_tokens=True).input_ids[0].tolist())
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    with torch.no_grad():
+        model.generate(torch.tensor([prompts[0]], device=device), max_new_tokens=4, do_sample=False, pad_token_id=pad_token_id) # Warm-up
+        sequences, generated_tokens, generation_seconds = [], 0, 0.0
+        for prompt_ids in prompts:
+            start = time.time()
+            output = model.generate(torch.tensor([prompt_ids], device=device), max_new_tokens=max_new_tokens, do_sample=False,
+                                    eos_token_id=tokenizer.eos_token_id, pad_token_id=pad_token_id)
+            generation_seconds += time.time() - start
+            sequences.append(output[0].tolist())
+            generated_tokens += output.shape[1] - len(prompt_ids)
+
+        # Next-token log-probs over each reply, always scored on the baseline's sequences so modes are comparable.
+        scored_sequences = reference_sequences if reference_sequences is not None else sequences
+        logprobs = []
+        for prompt_ids, sequence in zip(prompts, scored_sequences):
+            logits = model(torch.tensor([sequence], device=device)).logits[0, len(prompt_ids) - 1:-1, :]
+            logprobs.append(torch.log_softmax(logits.float(), dim=-1).cpu())
+    torch.save(logprobs, logprobs_path)
+
+    return {
+        "dtype": dtype_str,
+        "load_seconds": round(load_seconds, 3),
+        "generated_tokens": generated_tokens,
+        "tokens_per_second": round(generated_tokens / generation_seconds, 2) if generation_seconds else 0.0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # ru_maxrss is in KiB on Linux
+        "prompt_lengths": [len(p) for p in prompts],
+        "sequences": sequences,
+    }
+
+def run_mode_in_fresh_process(*args: Any) -> Dict[str, Any]:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_mode, *args).result()
+
+
+# --- 3. Drift metrics ---
+def compute_drift(baseline: Dict[str, Any], candidate: Dict[str, Any], baseline_logprobs: List[torch.Tensor], candidate_logprobs: List[torch.Tensor]) -> Dict[str, Any]:
+    exact_matches = sum(1 for a, b in zip(baseline["sequences"], candidate["sequences"]) if a == b)
+    agreeing, positions, kl_total = 0, 0, 0.0
+    for base_lp, cand_lp in zip(baseline_logprobs, candidate_logprobs):
+        agreeing += int((base_lp.argmax(dim=-1) == cand_lp.argmax(dim=-1)).sum())
+        positions += base_lp.shape[0]
+        kl_total += float((base_lp.exp() * (base_lp - cand_lp)).sum())
+    return {
+        "greedy_reply_exact_match_rate": round(exact_matches / len(baseline["sequences"]), 3),
+        "teacher_forced_top1_agreement": round(agreeing / positions, 4) if positions else None,
+        "teacher_forced_mean_kl": round(kl_total / positions, 6) if positions else None,
+        "scored_positions": positions,
+    }
+
+
+# --- 4. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Compare int8 dynamic-quantized CPU inference with the float32 baseline.")
+    parser.add_argument("--model_id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--adapter_path", default=None, help="Optional PEFT adapter directory to load on top of the base model.")
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        baseline_path = os.path.join(tmp_dir, "baseline_logprobs.pt")
+        candidate_path = os.path.join(tmp_dir, "candidate_logprobs.pt")
+        print(f"--- Running {BASELINE_DTYPE} baseline ---")
+        baseline = run_mode_in_fresh_process(args.model_id, args.adapter_path, BASELINE_DTYPE, args.max_new_tokens, None, baseline_path)
+        print(f"--- Running {QUANTIZED_DTYPE} ---")
+        candidate = run_mode_in_fresh_process(args.model_id, args.adapter_path, QUANTIZED_DTYPE, args.max_new_tokens, baseline["sequences"], candidate_path)
+        drift = compute_drift(baseline, candidate, torch.load(baseline_path), torch.load(candidate_path))
+
+    report = {
+        "model_id": args.model_id, "adapter_path": args.adapter_path, "max_new_tokens": args.max_new_tokens,
+        "num_prompts": len(BENCHMARK_UTTERANCES),
+        "modes": {run["dtype"]: {k: v for k, v in run.items() if k not in ("sequences", "prompt_lengths")} for run in (baseline, candidate)},
+        "speedup": round(candidate["tokens_per_second"] / baseline["tokens_per_second"], 3) if baseline["tokens_per_second"] else None,
+        "drift_vs_float32": drift,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# benchmark_speculative_decoding.py
+"""
+Measures assisted (speculative) decoding against plain sampling for one persona model.
+
+For each fixed AITA prompt, a reply is sampled twice with the service's settings
+(temperature 0.7, top-p 0.9): once with the persona model alone and once with the
+draft model proposing tokens. Reported:
+- tokens/sec and total wall time for both modes, and the end-to-end speedup;
+- draft acceptance rate: accepted draft tokens / proposed draft tokens. It is derived
+  from forward-pass counts. Each draft forward proposes one token. Each verification
+  pass of the persona model emits the accepted tokens plus one of its own.
+
+Usage:
+    python benchmark_speculative_decoding.py --draft_model_id <small model id> --adapter_path ./adapters/reading_explorer_pilot1
+"""
+import argparse
+import json
+import time
+from typing import Any, Dict, List
+
+import torch
+
+from model_loader_utils import assisted_generation_kwargs, load_model_tokenizer_with_adapter
+
+# --- 1. Configuration ---
+DEFAULT_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+SYSTEM_PROMPT = "You are ReadingExplorerAITA_4thGrade_Pilot1, a helpful AI Tutor. The student is in grade 4. You are discussing 'Lily the Lost Kitten'. Respond clearly, concisely, and age-appropriately. Guide the student; don't just give answers."
+BENCHMARK_UTTERANCES = [
+    "What is the story about?",
+    "Why was Lily scared?",
+    "What does the word 'cozy' mean?",
+    "How do plants get the energy they need to grow?",
+    "Why do leaves change color in the fall?",
+    "Can you give me a hint about the main idea?",
+]
+TEMPERATURE = 0.7
+TOP_P = 0.9
+
+
+# --- 2. Forward-pass counting ---
+class ForwardCounter:
+    """Counts top-level forward calls of a model (for PEFT models, of the wrapped base model that `generate` runs)."""
+    def __init__(self, model: Any):
+        target = model.get_base_model() if hasattr(model, "get_base_model") else model
+        self.calls = 0
+        self._handle = target.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        self.calls += 1
+
+    def reset(self) -> int:
+        calls, self.calls = self.calls, 0
+        return calls
+
+    def remove(self):
+        self._handle.remove()
+
+
+# --- 3. Benchmark ---
+def run_benchmark(model: Any, tokenizer: Any, device: torch.device, draft_model: Any, draft_tokenizer: Any, max_new_tokens: int, seed: int) -> Dict[str, Any]:
+    prompts: List[List[int]] = []
+    for utterance in BENCHMARK_UTTERANCES:
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": utterance}]
+        prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prompts.append(tokenizer(prompt_text, return_tensors="pt", add_special_tokens=True).input_ids[0].tolist())
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    assisted_kwargs = assisted_generation_kwargs(draft_model, draft_tokenizer, tokenizer)
+    if not assisted_kwargs:
+        raise RuntimeError("The draft model could not be used for assisted decoding.")
+
+    target_counter, draft_counter = ForwardCounter(model), ForwardCounter(draft_model)
+    results: Dict[str, Dict[str, float]] = {mode: {"seconds": 0.0, "new_tokens": 0, "target_forwards": 0, "draft_forwards": 0} for mode in ("plain", "assisted")}
+    try:
+        with torch.no_grad():
+            for index, prompt_ids in enumerate([prompts[0]] + prompts): # Index 0 is a warm-up run and is not counted.
+                for mode, extra_kwargs in (("plain", {}), ("assisted", assisted_kwargs)):
+                    torch.manual_seed(seed)
+                    target_counter.reset(); draft_counter.reset()
+                    start = time.time()
+                    output = model.generate(
+                        torch.tensor([prompt_ids], device=device), max_new_tokens=max_new_tokens, do_sample=True,
+                        temperature=TEMPERATURE, top_p=TOP_P, eos_token_id=tokenizer.eos_token_id, pad_token_id=pad_token_id, **extra_kwargs
+                    )
+                    elapsed = time.time() - start
+                    if index == 0:
+                        continue
+                    results[mode]["seconds"] += elapsed
+                    results[mode]["new_tokens"] += output.shape[1] - len(prompt_ids)
+                    results[mode]["target_forwards"] += target_counter.reset()
+                    results[mode]["draft_forwards"] += draft_counter.reset()
+    finally:
+        target_counter.remove(); draft_counter.remove()
+
+    assisted = results["assisted"]
+    proposed = assisted["draft_forwards"]
+    accepted = max(0, assisted["new_tokens"] - assisted["target_forwards"])
+    report: Dict[str, Any] = {
+        mode: {
+            "seconds": round(r["seconds"], 3), "new_tokens": r["new_tokens"],
+            "tokens_per_second": round(r["new_tokens"] / r["seconds"], 2) if r["seconds"] else 0.0,
+            "persona_model_forward_passes": r["target_forwards"],
+        } for mode, r in results.items()
+    }
+    report["assisted"]["draft_tokens_proposed"] = proposed
+    report["assisted"]["draft_tokens_accepted"] = accepted
+    report["acceptance_rate"] = round(accepted / proposed, 4) if proposed else None
+    report["tokens_per_persona_forward"] = round(assisted["new_tokens"] / assisted["target_forwards"], 3) if assisted["target_forwards"] else None
+    report["speedup"] = round(report["assisted"]["tokens_per_second"] / report["plain"]["tokens_per_second"], 3) if report["plain"]["tokens_per_second"] else None
+    return report
+
+
+# --- 4. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark assisted (speculative) decoding against plain sampling.")
+    parser.add_argument("--model_id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--adapter_path", default=None, help="Optional PEFT adapter directory for the persona model.")
+    parser.add_argument("--draft_model_id", required=True)
+    parser.add_argument("--torch_dtype", default="auto", help="auto / bfloat16 / float16 / float32 / int8, for both models.")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    model, tokenizer, device = load_model_tokenizer_with_adapter(args.model_id, adapter_path=args.adapter_path, torch_dtype_str=args.torch_dtype)
+    draft_model, draft_tokenizer, _ = load_model_tokenizer_with_adapter(args.draft_model_id, adapter_path=None, torch_dtype_str=args.torch_dtype)
+    if model is None or draft_model is None:
+        raise SystemExit("Could not load the persona model and/or the draft model.")
+
+    report = {
+        "model_id": args.model_id, "adapter_path": args.adapter_path, "draft_model_id": args.draft_model_id,
+        "torch_dtype": args.torch_dtype, "max_new_tokens": args.max_new_tokens, "num_prompts": len(BENCHMARK_UTTERANCES),
+        **run_benchmark(model, tokenizer, device, draft_model, draft_tokenizer, args.max_new_tokens, args.seed)
+    }
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
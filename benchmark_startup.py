@@ -0,0 +1,133 @@
+# benchmark_startup.py
+"""
+Measures how quickly the AITA Interaction Service becomes useful after a (re)start.
+
+Reported:
+- import time of `aita_interaction_service` in a fresh interpreter (median of several
+  runs), next to the import time of the inference libraries it now defers
+  (torch / transformers / peft), which the service pays in the background instead;
+- for a service started with uvicorn in a subprocess:
+  - time until it accepts connections (first answer from GET /ready);
+  - time until GET /ready returns 200, with the per-component states and load times;
+  - time until the first POST /interact succeeds. The request is sent as soon as the
+    server accepts connections, so it also measures waiting on components that are
+    still loading. Its own latency is reported separately.
+
+Usage:
+    python benchmark_startup.py --port 8011 --output_json startup_report.json
+    AITA_BASE_MODEL_ID=<small model id> python benchmark_startup.py   # the service reads its usual AITA_* settings
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+# --- 1. Configuration ---
+SERVICE_MODULE = "aita_interaction_service"
+FIRST_INTERACT_PAYLOAD = {"user_id": "student001", "user_utterance": "What is the story about?", "subject": "ReadingComprehension", "current_item_id": "passage_kitten_001"}
+POLL_INTERVAL_S = 0.05
+
+
+# --- 2. Import time (fresh interpreters) ---
+def time_import(statement: str, runs: int) -> float:
+    """Median wall time, in a new interpreter per run, of executing `statement`."""
+    script = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    samples: List[float] = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return round(statistics.median(samples), 3)
+
+
+# --- 3. Service start-up ---
+def measure_service_startup(port: int, timeout_s: float, log_path: str) -> Dict[str, Any]:
+    base_url = f"http://127.0.0.1:{port}"
+    result: Dict[str, Any] = {"accepting_connections_seconds": None, "ready_seconds": None, "first_interact_seconds": None, "first_interact_latency_seconds": None}
+    with open(log_path, "w") as log_file:
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", f"{SERVICE_MODULE}:app", "--host", "127.0.0.1", "--port", str(port)],
+            stdout=log_file, stderr=subprocess.STDOUT, env=os.environ.copy()
+        )
+        try:
+            with httpx.Client(base_url=base_url, timeout=timeout_s) as client:
+                wait_for_connections(client, server, start, timeout_s)
+                result["accepting_connections_seconds"] = round(time.perf_counter() - start, 3)
+                # /ready is polled on its own thread while the first /interact is in flight.
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    readiness_future = pool.submit(poll_until_ready, client, start, timeout_s)
+                    interact_sent = time.perf_counter()
+                    response = client.post("/interact", json=FIRST_INTERACT_PAYLOAD)
+                    if response.status_code == 200:
+                        result["first_interact_seconds"] = round(time.perf_counter() - start, 3)
+                        result["first_interact_latency_seconds"] = round(time.perf_counter() - interact_sent, 3)
+                    result["first_interact_status"] = response.status_code
+                    ready_seconds, snapshot = readiness_future.result()
+                result["ready_seconds"] = ready_seconds
+                result["components"] = snapshot["components"]
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    return result
+
+def wait_for_connections(client: httpx.Client, server: subprocess.Popen, start: float, timeout_s: float):
+    while time.perf_counter() - start < timeout_s:
+        if server.poll() is not None:
+            raise RuntimeError(f"The service exited during startup with code {server.returncode}.")
+        try:
+            client.get("/ready")
+            return
+        except httpx.TransportError:
+            time.sleep(POLL_INTERVAL_S)
+    raise TimeoutError(f"The service did not accept connections within {timeout_s}s.")
+
+def poll_until_ready(client: httpx.Client, start: float, timeout_s: float) -> Tuple[Optional[float], Dict[str, Any]]:
+    """Returns (seconds from launch until /ready returned 200, or None if a component failed or timed out; last snapshot)."""
+    while True:
+        response = client.get("/ready")
+        snapshot = response.json()
+        if response.status_code == 200:
+            return round(time.perf_counter() - start, 3), snapshot
+        loading = any(c["state"] in ("pending", "loading") for c in snapshot["components"].values())
+        if not loading or time.perf_counter() - start > timeout_s:
+            return None, snapshot
+        time.sleep(POLL_INTERVAL_S)
+
+
+# --- 4. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AITA Interaction Service import time, time to ready and time to first /interact.")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--import_runs", type=int, default=3)
+    parser.add_argument("--timeout_s", type=float, default=600.0)
+    parser.add_argument("--server_log", default="benchmark_startup_server.log", help="Where the service's stdout/stderr is written.")
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    print("--- Measuring import times ---")
+    report: Dict[str, Any] = {
+        "service_import_seconds": time_import(f"import {SERVICE_MODULE}", args.import_runs),
+        "deferred_inference_imports_seconds": time_import("import torch; from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline; from peft import PeftModel", args.import_runs),
+        "import_runs": args.import_runs,
+    }
+    print("--- Starting the service ---")
+    report["startup"] = measure_service_startup(args.port, args.timeout_s, args.server_log)
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# benchmark_worker_memory.py
+"""
+Measures the memory cost of running several inference workers, with and without shared weights.
+
+For each worker count (1, 2, 4 and 8 by default) and each mode, N worker processes are
+started together. Each one loads the persona model the way a uvicorn worker of the AITA
+Interaction Service does (`load_model_tokenizer_with_adapter` with the service's dtype)
+and generates a few tokens, so the weights are actually touched. Modes:
+- "private": every worker holds its own copy of the weights (the default deployment);
+- "shared":  `shared_weights_dir` is set, so workers memory-map one exported copy
+             (AITA_SHARED_WEIGHTS_DIR in the service).
+
+Reported per worker, once all N are loaded:
+- RSS: resident memory, including shared pages (so shared weights count in every worker);
+- PSS: resident memory with each shared page divided among the processes mapping it;
+- USS: memory private to the worker.
+Totals are summed over the workers. Summed RSS overstates the real footprint when pages are
+shared; summed PSS is the physical memory the workers use together. PSS/USS need Linux.
+
+Usage:
+    python benchmark_worker_memory.py --model_id microsoft/Phi-3-mini-4k-instruct --output_json worker_memory.json
+    python benchmark_worker_memory.py --shared_weights_dir /dev/shm/aita_weights --worker_counts 1 2 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import time
+from typing import Any, Dict, List, Optional
+
+import psutil
+
+# --- 1. Configuration ---
+DEFAULT_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+WARMUP_PROMPT = "What is the story about?"
+MODES = ("private", "shared")
+
+
+# --- 2. Worker process ---
+def run_worker(model_id: str, adapter_path: Optional[str], dtype_str: str, shared_weights_dir: Optional[str], max_new_tokens: int, ready_queue: Any, stop_event: Any):
+    import torch
+    from model_loader_utils import load_model_tokenizer_with_adapter
+    model, tokenizer, device = load_model_tokenizer_with_adapter(
+        model_id, adapter_path=adapter_path, torch_dtype_str=dtype_str, shared_weights_dir=shared_weights_dir
+    )
+    if model is None:
+        ready_queue.put((os.getpid(), "model failed to load"))
+        return
+    input_ids = tokenizer(WARMUP_PROMPT, return_tensors="pt").input_ids.to(device)
+    with torch.no_grad():
+        model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+    ready_queue.put((os.getpid(), None))
+    stop_event.wait()
+
+
+# --- 3. Measurement ---
+def memory_of(pid: int) -> Dict[str, Optional[int]]:
+    info = psutil.Process(pid).memory_full_info()
+    return {"rss_mb": info.rss >> 20, "pss_mb": info.pss >> 20 if hasattr(info, "pss") else None, "uss_mb": info.uss >> 20 if hasattr(info, "uss") else None}
+
+def measure_workers(num_workers: int, args: argparse.Namespace, shared_weights_dir: Optional[str]) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    ready_queue, stop_event = context.Queue(), context.Event()
+    workers = [
+        context.Process(target=run_worker, args=(args.model_id, args.adapter_path, args.torch_dtype, shared_weights_dir, args.max_new_tokens, ready_queue, stop_event), daemon=True)
+        for _ in range(num_workers)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    try:
+        for _ in workers:
+            pid, error = ready_queue.get(timeout=args.timeout_s)
+            if error:
+                raise RuntimeError(f"Worker {pid}: {error}.")
+        load_seconds = time.perf_counter() - start
+        per_worker = [memory_of(worker.pid) for worker in workers]
+    except queue.Empty:
+        raise TimeoutError(f"{num_workers} workers did not finish loading within {args.timeout_s}s.")
+    finally:
+        stop_event.set()
+        for worker in workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+
+    def total(key: str) -> Optional[int]:
+        values = [w[key] for w in per_worker]
+        return sum(values) if all(v is not None for v in values) else None
+    return {
+        "workers": num_workers, "load_seconds": round(load_seconds, 2), "per_worker": per_worker,
+        "total_rss_mb": total("rss_mb"), "total_pss_mb": total("pss_mb"), "total_uss_mb": total("uss_mb"),
+    }
+
+
+# --- 4. Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Report per-worker and total RSS for N inference workers, with private or shared (memory-mapped) weights.")
+    parser.add_argument("--model_id", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--adapter_path", default=None, help="Optional PEFT adapter directory (kept private per worker).")
+    parser.add_argument("--torch_dtype", default="auto", help="auto / bfloat16 / float16 / float32. int8 models cannot share weights.")
+    parser.add_argument("--worker_counts", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--shared_weights_dir", default="/dev/shm/aita_weights" if os.path.isdir("/dev/shm") else "./shared_weights",
+                        help="Where the shared export is written on the first 'shared' run and reused afterwards.")
+    parser.add_argument("--max_new_tokens", type=int, default=8, help="Tokens each worker generates after loading, so its weights are touched.")
+    parser.add_argument("--timeout_s", type=float, default=1800.0)
+    parser.add_argument("--output_json", default=None, help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    runs: List[Dict[str, Any]] = []
+    for mode in args.modes:
+        for num_workers in args.worker_counts:
+            print(f"--- {num_workers} worker(s), {mode} weights ---")
+            result = measure_workers(num_workers, args, args.shared_weights_dir if mode == "shared" else None)
+            runs.append({"mode": mode, **result})
+            print(f"total RSS {result['total_rss_mb']} MB, total PSS {result['total_pss_mb']} MB, load {result['load_seconds']}s")
+
+    report = {"model_id": args.model_id, "adapter_path": args.adapter_path, "torch_dtype": args.torch_dtype, "shared_weights_dir": args.shared_weights_dir, "runs": runs}
+    print(json.dumps(report, indent=2))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
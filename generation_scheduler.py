@@ -0,0 +1,482 @@
+# generation_scheduler.py
+"""
+Continuous-batching generation scheduler for the AITA Interaction Service.
+
+Concurrent requests for the same persona are merged into one padded batch that
+shares every decode forward pass. New sequences are admitted between decode
+steps (after their own prefill) and finished sequences are retired immediately,
+so a classroom of students hitting the same persona at once no longer waits in
+line behind each other's full 300-token generations.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+from model_loader_utils import DefaultLogger
+from request_cancellation import CancellationToken, GenerationCancelledError, cancellation_stopping_criteria
+
+# A KV cache in "legacy" layout: one (key, value) pair per layer, each shaped [batch, heads, seq_len, head_dim].
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+# --- KV cache helpers (work with both tuple caches and transformers' Cache objects) ---
+def cache_to_tuples(past_key_values: Any) -> LegacyCache:
+    if isinstance(past_key_values, (tuple, list)):
+        return tuple((layer[0], layer[1]) for layer in past_key_values)
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return tuple(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+def tuples_to_cache(layers: LegacyCache) -> Any:
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return layers
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(layers)
+    return DynamicCache(layers)
+
+def left_pad_cache(layers: LegacyCache, target_len: int) -> LegacyCache:
+    """Pads every key/value tensor on the left of the sequence axis up to `target_len`."""
+    padded = []
+    for key, value in layers:
+        missing = target_len - key.shape[-2]
+        if missing > 0:
+            key = torch.cat([key.new_zeros(key.shape[:-2] + (missing, key.shape[-1])), key], dim=-2)
+            value = torch.cat([value.new_zeros(value.shape[:-2] + (missing, value.shape[-1])), value], dim=-2)
+        padded.append((key, value))
+    return tuple(padded)
+
+def resolve_eos_token_ids(model: Any, tokenizer: Any) -> Set[int]:
+    """Collects every EOS id the model may emit (Phi-3 declares several in its generation config)."""
+    eos_ids: Set[int] = set()
+    candidates = [getattr(tokenizer, "eos_token_id", None), getattr(getattr(model, "generation_config", None), "eos_token_id", None)]
+    for candidate in candidates:
+        if isinstance(candidate, int):
+            eos_ids.add(candidate)
+        elif isinstance(candidate, (list, tuple)):
+            eos_ids.update(int(c) for c in candidate if c is not None)
+    return eos_ids
+
+
+class SchedulerClosedError(RuntimeError):
+    pass
+
+
+@dataclass
+class GenerationJob:
+    prompt_ids: List[int]
+    max_new_tokens: int
+    future: Future = field(default_factory=Future)
+    generated_ids: List[int] = field(default_factory=list)
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    # Called from the scheduler thread with each newly generated token id (used for streaming).
+    on_token: Optional[Callable[[int], None]] = None
+    # PEFT adapter to run this job under (multi-adapter mode); None means the plain base model.
+    adapter_name: Optional[str] = None
+    # Length of the leading part of `prompt_ids` shared with other requests (e.g. the system prompt),
+    # which is worth keeping in the scheduler's prefix cache after this job's prefill.
+    prefix_len: int = 0
+    # Conversation this job continues; its KV state is kept in the session cache once the job finishes.
+    session_id: Optional[str] = None
+    # Set when the client disconnects or the turn's deadline passes; the job then leaves its batch early.
+    cancellation: Optional[CancellationToken] = None
+
+    def is_cancelled(self) -> bool:
+        return self.cancellation is not None and self.cancellation.is_cancelled()
+
+    def add_token(self, token_id: int):
+        self.generated_ids.append(token_id)
+        if self.on_token is not None:
+            try:
+                self.on_token(token_id)
+            except Exception:
+                self.on_token = None # A broken consumer must not stall the batch.
+
+
+class BatchLane:
+    """The running padded batch for one adapter: its jobs, their shared KV cache and attention mask."""
+    def __init__(self, adapter_name: Optional[str]):
+        self.adapter_name = adapter_name
+        self.active: List[GenerationJob] = []
+        self.past: Optional[LegacyCache] = None
+        self.attention_mask: Optional[torch.Tensor] = None
+
+    def reset(self):
+        self.active = []
+        self.past = None
+        self.attention_mask = None
+
+
+class ContinuousBatchingScheduler:
+    """
+    Runs generation for one persona's model on a dedicated background thread.
+
+    `submit()` is thread-safe and returns a `concurrent.futures.Future` that resolves to
+    the list of generated token ids (prompt excluded), i.e. the same slice the service
+    previously took from `model.generate(...)[0][input_ids_length:]`. An optional
+    `on_token` callback receives each token id as soon as it is sampled.
+
+    With `adapter_switching=True` the model is a PEFT model carrying several named
+    adapters (see `load_model_tokenizer_with_adapters`). Jobs are grouped into one lane
+    per adapter and the scheduler calls `set_adapter` before stepping each lane, so a
+    batch never mixes adapters. Pass `model_lock` when other threads may also run the
+    same model, so adapter switches and forward passes are not interleaved.
+
+    With a `prefix_cache` (see `kv_cache.PrefixKVCache`), a job's prefill starts from the
+    cached KV state of the longest known prefix of its prompt, and the first `prefix_len`
+    tokens of each job are stored for later requests (namespaced by adapter). With a
+    `session_cache` (`kv_cache.SessionKVCache`), a finished job's prompt-plus-reply KV state
+    is kept under its `session_id`, and the session's next turn starts from it instead.
+
+    Models that are not `torch.nn.Module`s (e.g. `DummySLM`) cannot be stepped token by
+    token, so their jobs fall back to one `generate` call per request on the same thread.
+
+    A job submitted with a `cancellation` token is dropped from its batch at the first decode
+    step after the token is cancelled (or before it starts, if it is still queued). Its future
+    then fails with `GenerationCancelledError`, which carries the tokens generated so far.
+    """
+    def __init__(
+        self,
+        model: Any,
+        tokenizer: Any,
+        device: torch.device,
+        max_batch_size: int = 8,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        logger: Optional[Any] = None,
+        name: str = "generation_scheduler",
+        adapter_switching: bool = False,
+        model_lock: Optional[threading.Lock] = None,
+        prefix_cache: Optional[Any] = None,
+        session_cache: Optional[Any] = None
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max(1, max_batch_size)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.do_sample = do_sample
+        self.logger = logger if logger is not None else DefaultLogger()
+        self.name = name
+        self.adapter_switching = adapter_switching
+        self.model_lock = model_lock if model_lock is not None else threading.Lock()
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+
+        self.supports_batching = isinstance(model, torch.nn.Module)
+        self.eos_token_ids = resolve_eos_token_ids(model, tokenizer)
+        self.pad_token_id = getattr(tokenizer, "pad_token_id", None)
+
+        self.stats: Dict[str, float] = {"jobs_completed": 0, "jobs_failed": 0, "jobs_cancelled": 0, "decode_steps": 0, "tokens_generated": 0, "max_observed_batch": 0, "adapter_switches": 0}
+
+        self._pending: "queue.Queue[GenerationJob]" = queue.Queue()
+        self._waiting: List[GenerationJob] = [] # Dequeued jobs whose lane is full, in arrival order.
+        self._lanes: Dict[Optional[str], BatchLane] = {}
+        self._current_adapter: Optional[str] = None
+        self._stop_event = threading.Event()
+        self._drain_event = threading.Event()
+        self._on_drained: Optional[Callable[["ContinuousBatchingScheduler"], None]] = None
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run_loop, name=f"{name}_thread", daemon=True)
+        self._thread.start()
+        self.logger.info(f"{self.name}: started (max_batch_size={self.max_batch_size}, batching={'on' if self.supports_batching else 'off (unbatched fallback)'}, adapter_switching={adapter_switching}).")
+
+    # --- Public API ---
+    def submit(
+        self, prompt_ids: Sequence[int], max_new_tokens: int, on_token: Optional[Callable[[int], None]] = None, adapter_name: Optional[str] = None,
+        prefix_len: int = 0, session_id: Optional[str] = None, cancellation: Optional[CancellationToken] = None
+    ) -> Future:
+        job = GenerationJob(
+            prompt_ids=list(prompt_ids), max_new_tokens=max_new_tokens, on_token=on_token, adapter_name=adapter_name,
+            prefix_len=prefix_len, session_id=session_id, cancellation=cancellation
+        )
+        with self._submit_lock:
+            if self._stop_event.is_set() or self._drain_event.is_set():
+                raise SchedulerClosedError(f"{self.name} is no longer accepting jobs.")
+            self._pending.put(job)
+        return job.future
+
+    def close(self, on_drained: Optional[Callable[["ContinuousBatchingScheduler"], None]] = None):
+        """Stops accepting new jobs; the scheduler thread exits once queued and running jobs have finished, calling `on_drained(self)` last."""
+        self._on_drained = on_drained
+        self._drain_event.set()
+
+    def shutdown(self, timeout: float = 5.0):
+        self._stop_event.set()
+        self._thread.join(timeout=timeout)
+        for lane in self._lanes.values():
+            self._fail_jobs(lane.active, RuntimeError(f"{self.name} shut down before the job completed."))
+            lane.reset()
+        self._fail_jobs(self._waiting, RuntimeError(f"{self.name} shut down before the job started."))
+        self._waiting = []
+        while True:
+            try:
+                job = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            self._fail_jobs([job], RuntimeError(f"{self.name} shut down before the job started."))
+
+    @property
+    def active_batch_size(self) -> int:
+        return sum(len(lane.active) for lane in self._lanes.values())
+
+    @property
+    def pending_count(self) -> int:
+        return self._pending.qsize() + len(self._waiting)
+
+    # --- Scheduler loop ---
+    def _run_loop(self):
+        while not self._stop_event.is_set():
+            if self._drain_event.is_set():
+                with self._submit_lock:
+                    drained = self.active_batch_size == 0 and self.pending_count == 0
+                if drained:
+                    self.logger.info(f"{self.name}: drained and closed.")
+                    if self._on_drained is not None:
+                        self._on_drained(self)
+                    return
+            self._admit_pending(block=self.active_batch_size == 0)
+            # Round-robin one decode step per lane so every adapter's batch keeps moving.
+            for lane in list(self._lanes.values()):
+                if not lane.active:
+                    continue
+                try:
+                    self._decode_step(lane)
+                except Exception as e:
+                    self.logger.error(f"{self.name}: generation step failed for adapter '{lane.adapter_name}': {e}", exc_info=True)
+                    self._fail_jobs(lane.active, e)
+                    lane.reset()
+
+    def _admit_pending(self, block: bool):
+        waiting, self._waiting = self._waiting, []
+        for job in waiting:
+            self._admit(job)
+        block = block and not self._waiting
+        while True:
+            try:
+                job = self._pending.get(timeout=0.05) if block else self._pending.get_nowait()
+            except queue.Empty:
+                return
+            block = False
+            self._admit(job)
+
+    def _admit(self, job: GenerationJob):
+        if job.is_cancelled():
+            self._cancel(job)
+            return
+        if not self.supports_batching:
+            job.started_at = time.time()
+            self._run_unbatched(job)
+            return
+        lane = self._lanes.setdefault(job.adapter_name, BatchLane(job.adapter_name))
+        if len(lane.active) >= self.max_batch_size:
+            self._waiting.append(job)
+            return
+        job.started_at = time.time()
+        try:
+            self._prefill_and_merge(lane, job)
+        except Exception as e:
+            self.logger.error(f"{self.name}: prefill failed for a job: {e}", exc_info=True)
+            self._fail_jobs([job], e)
+
+    def _forward(self, adapter_name: Optional[str], **model_kwargs: Any) -> Any:
+        with self.model_lock, torch.no_grad():
+            if not self.adapter_switching:
+                return self.model(**model_kwargs)
+            if adapter_name is None:
+                with self.model.disable_adapter():
+                    return self.model(**model_kwargs)
+            if self._current_adapter != adapter_name or getattr(self.model, "active_adapter", adapter_name) != adapter_name:
+                self.model.set_adapter(adapter_name)
+                self._current_adapter = adapter_name
+                self.stats["adapter_switches"] += 1
+            return self.model(**model_kwargs)
+
+    def _lookup_cached_prefix(self, job: GenerationJob) -> Tuple[int, Optional[LegacyCache]]:
+        """Finds the longest reusable KV state for the job's prompt: its session's previous turn, else a shared prefix."""
+        cached_len, cached_past = 0, None
+        if self.session_cache is not None and job.session_id:
+            cached_len, cached_past = self.session_cache.lookup(job.session_id, (self.name, job.adapter_name), job.prompt_ids)
+        if self.prefix_cache is not None and cached_len < job.prefix_len:
+            prefix_len, prefix_past = self.prefix_cache.lookup(job.adapter_name, job.prompt_ids)
+            if prefix_len > cached_len:
+                cached_len, cached_past = prefix_len, prefix_past
+        return cached_len, cached_past
+
+    def _save_session_state(self, job: GenerationJob, past: LegacyCache, row: int):
+        if self.session_cache is None or not job.session_id:
+            return
+        # The cache holds every token fed to the model: the prompt and all but the last sampled token.
+        token_ids = job.prompt_ids + job.generated_ids[:-1]
+        n = len(token_ids)
+        self.session_cache.store(job.session_id, (self.name, job.adapter_name), token_ids, tuple((k[row:row + 1, :, -n:, :], v[row:row + 1, :, -n:, :]) for k, v in past))
+
+    def _prefill_and_merge(self, lane: BatchLane, job: GenerationJob):
+        cached_len, cached_past = self._lookup_cached_prefix(job)
+        input_ids = torch.tensor([job.prompt_ids[cached_len:]], dtype=torch.long, device=self.device)
+        model_kwargs: Dict[str, Any] = {"past_key_values": tuples_to_cache(cached_past)} if cached_past is not None else {}
+        outputs = self._forward(job.adapter_name, input_ids=input_ids, use_cache=True, **model_kwargs)
+        new_past = cache_to_tuples(outputs.past_key_values)
+        if self.prefix_cache is not None and job.prefix_len > cached_len:
+            self.prefix_cache.store(job.adapter_name, job.prompt_ids[:job.prefix_len], new_past)
+        job.add_token(int(self._sample(outputs.logits[:, -1, :])[0]))
+        if self._is_finished(job) or job.is_cancelled():
+            self._save_session_state(job, new_past, 0)
+            self._complete(job)
+            return
+
+        new_mask = torch.ones((1, len(job.prompt_ids)), dtype=torch.long, device=self.device)
+        if lane.past is None:
+            lane.past, lane.attention_mask = new_past, new_mask
+        else:
+            target_len = max(lane.attention_mask.shape[1], new_mask.shape[1])
+            running = left_pad_cache(lane.past, target_len)
+            incoming = left_pad_cache(new_past, target_len)
+            lane.past = tuple((torch.cat([rk, ik], dim=0), torch.cat([rv, iv], dim=0)) for (rk, rv), (ik, iv) in zip(running, incoming))
+            lane.attention_mask = torch.cat([
+                torch.nn.functional.pad(lane.attention_mask, (target_len - lane.attention_mask.shape[1], 0), value=0),
+                torch.nn.functional.pad(new_mask, (target_len - new_mask.shape[1], 0), value=0)
+            ], dim=0)
+        lane.active.append(job)
+        self.stats["max_observed_batch"] = max(self.stats["max_observed_batch"], len(lane.active))
+
+    def _decode_step(self, lane: BatchLane):
+        input_ids = torch.tensor([[job.generated_ids[-1]] for job in lane.active], dtype=torch.long, device=self.device)
+        # With left padding, the next position of each row is its count of real tokens so far.
+        position_ids = lane.attention_mask.sum(dim=-1, keepdim=True)
+        attention_mask = torch.cat([lane.attention_mask, lane.attention_mask.new_ones((len(lane.active), 1))], dim=1)
+        outputs = self._forward(
+            lane.adapter_name, input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+            past_key_values=tuples_to_cache(lane.past), use_cache=True
+        )
+        lane.past = cache_to_tuples(outputs.past_key_values)
+        lane.attention_mask = attention_mask
+        next_tokens = self._sample(outputs.logits[:, -1, :]).tolist()
+        for job, token_id in zip(lane.active, next_tokens):
+            job.add_token(int(token_id))
+        self.stats["decode_steps"] += 1
+        self._retire_finished(lane)
+
+    def _retire_finished(self, lane: BatchLane):
+        # Cancelled jobs leave the batch too, so their slots go to waiting requests at the next admission.
+        keep = [i for i, job in enumerate(lane.active) if not self._is_finished(job) and not job.is_cancelled()]
+        if len(keep) == len(lane.active):
+            return
+        for i, job in enumerate(lane.active):
+            if i not in keep:
+                self._save_session_state(job, lane.past, i)
+                self._complete(job)
+        if not keep:
+            lane.reset()
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = lane.attention_mask.index_select(0, index)
+        # Drop padding columns that no remaining row needs any more.
+        first_real_column = int(torch.nonzero(mask.sum(dim=0) > 0)[0])
+        lane.attention_mask = mask[:, first_real_column:]
+        lane.past = tuple(
+            (k.index_select(0, index)[:, :, first_real_column:, :], v.index_select(0, index)[:, :, first_real_column:, :])
+            for k, v in lane.past
+        )
+        lane.active = [lane.active[i] for i in keep]
+
+    def _run_unbatched(self, job: GenerationJob):
+        try:
+            input_ids = torch.tensor([job.prompt_ids], dtype=torch.long, device=self.device)
+            eos_token_id = getattr(self.tokenizer, "eos_token_id", None)
+            if eos_token_id is None and self.eos_token_ids: # No tokenizer: the model's generation config may still declare one.
+                eos_token_id = min(self.eos_token_ids)
+            extra_kwargs = {"stopping_criteria": cancellation_stopping_criteria(job.cancellation)} if job.cancellation is not None else {}
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    input_ids, max_new_tokens=job.max_new_tokens, eos_token_id=eos_token_id,
+                    pad_token_id=self.pad_token_id if self.pad_token_id is not None else eos_token_id,
+                    do_sample=self.do_sample, temperature=self.temperature, top_p=self.top_p, **extra_kwargs
+                )
+            for token_id in outputs[0][len(job.prompt_ids):].tolist():
+                job.add_token(int(token_id))
+            self._complete(job)
+        except Exception as e:
+            self.logger.error(f"{self.name}: unbatched generation failed: {e}", exc_info=True)
+            self._fail_jobs([job], e)
+
+    # --- Helpers ---
+    def _sample(self, logits: torch.Tensor) -> torch.Tensor:
+        if not self.do_sample:
+            return logits.argmax(dim=-1)
+        probs = torch.softmax(logits.float() / max(self.temperature, 1e-5), dim=-1)
+        if self.top_p < 1.0:
+            sorted_probs, sorted_indices = probs.sort(dim=-1, descending=True)
+            outside_nucleus = (sorted_probs.cumsum(dim=-1) - sorted_probs) > self.top_p
+            sorted_probs = sorted_probs.masked_fill(outside_nucleus, 0.0)
+            probs = torch.zeros_like(probs).scatter(-1, sorted_indices, sorted_probs)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+    def _is_finished(self, job: GenerationJob) -> bool:
+        return len(job.generated_ids) >= job.max_new_tokens or (bool(job.generated_ids) and job.generated_ids[-1] in self.eos_token_ids)
+
+    def _complete(self, job: GenerationJob):
+        if not self._is_finished(job) and job.is_cancelled(): # A reply that did finish is still delivered.
+            self._cancel(job)
+            return
+        self.stats["jobs_completed"] += 1
+        self.stats["tokens_generated"] += len(job.generated_ids)
+        if not job.future.done():
+            job.future.set_result(job.generated_ids)
+
+    def _cancel(self, job: GenerationJob):
+        self.stats["jobs_cancelled"] += 1
+        self.stats["tokens_generated"] += len(job.generated_ids)
+        if not job.future.done():
+            job.future.set_exception(GenerationCancelledError(job.cancellation.reason, job.generated_ids))
+
+    def _fail_jobs(self, jobs: List[GenerationJob], error: Exception):
+        for job in jobs:
+            self.stats["jobs_failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+
+
+# --- Streaming helpers ---
+class TokenCallbackStreamer:
+    """Minimal `model.generate(streamer=...)` adapter that forwards each new token id to a callback."""
+    def __init__(self, on_token: Callable[[int], None]):
+        self.on_token = on_token
+        self._prompt_skipped = False
+
+    def put(self, value: torch.Tensor):
+        if not self._prompt_skipped: # `generate` first pushes the prompt ids.
+            self._prompt_skipped = True
+            return
+        for token_id in value.reshape(-1).tolist():
+            self.on_token(int(token_id))
+
+    def end(self):
+        pass
+
+class IncrementalDetokenizer:
+    """Turns a growing list of token ids into text deltas, holding back incomplete multi-byte characters."""
+    def __init__(self, tokenizer: Any):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = []
+        self.emitted_text = ""
+
+    def push(self, token_ids: Sequence[int]) -> str:
+        self.token_ids.extend(token_ids)
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True).lstrip()
+        if text.endswith("�") or not text.startswith(self.emitted_text):
+            return ""
+        delta = text[len(self.emitted_text):]
+        self.emitted_text = text
+        return delta
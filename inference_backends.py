@@ -0,0 +1,264 @@
+# inference_backends.py
+"""
+Pluggable inference backends behind `load_model_tokenizer_with_adapter`.
+
+Every backend returns `(model, tokenizer, device)`. `model.generate(...)` takes the keyword
+arguments the AITA services already pass (max_new_tokens, eos/pad token ids, do_sample,
+temperature, top_p, streamer, stopping_criteria), so call sites do not depend on the backend:
+
+- "hf":    the Hugging Face / PyTorch model (`AutoModelForCausalLM` plus PEFT adapter). The only
+           backend that supports continuous batching, multi-adapter models, assisted decoding
+           and shared weights;
+- "onnx":  an ONNX Runtime CPU session over a graph exported from the HF model with the PEFT
+           adapter merged into the base weights. The graph takes and returns the KV cache, so
+           each decode step only runs the new token. The first load exports the graph under
+           AITA_ONNX_EXPORT_DIR; later loads reuse it. With `torch_dtype_str="int8"` the graph's
+           weights are dynamically quantized by ONNX Runtime. Needs `onnxruntime`, plus `onnx`
+           for the export;
+- "dummy": `DummySLM` with the model's tokenizer, for tests and load tests without weights.
+"""
+import inspect
+import os
+import re
+import shutil
+import time
+import warnings
+from typing import Any, Dict, Optional, Tuple, TYPE_CHECKING
+
+from model_loader_utils import DefaultLogger, DummySLM, QUANTIZED_DTYPE_STRS, load_model_tokenizer_with_adapter, load_tokenizer
+
+if TYPE_CHECKING:
+    import torch
+
+INFERENCE_BACKENDS = ("hf", "onnx", "dummy")
+ONNX_EXPORT_DIR = os.environ.get("AITA_ONNX_EXPORT_DIR", "./onnx_exports")
+ONNX_GRAPH_FILENAME = "model.onnx"
+ONNX_OPSET_VERSION = 17
+
+
+def load_backend_model_tokenizer(
+    backend: str,
+    model_id: str,
+    adapter_path: Optional[str] = None,
+    logger: Optional[Any] = None,
+    trust_remote_code_flag: bool = True,
+    torch_dtype_str: str = "auto"
+) -> Tuple[Optional[Any], Optional[Any], Optional["torch.device"]]:
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Expected one of {INFERENCE_BACKENDS}.")
+    if logger is None:
+        logger = DefaultLogger()
+    if backend == "hf":
+        return load_model_tokenizer_with_adapter(model_id, adapter_path=adapter_path, logger=logger, trust_remote_code_flag=trust_remote_code_flag, torch_dtype_str=torch_dtype_str)
+    if backend == "onnx":
+        return load_onnx_model_tokenizer(model_id, adapter_path=adapter_path, logger=logger, trust_remote_code_flag=trust_remote_code_flag, torch_dtype_str=torch_dtype_str)
+    import torch
+    device = torch.device("cpu")
+    try:
+        tokenizer = load_tokenizer(model_id, logger=logger, trust_remote_code_flag=trust_remote_code_flag)
+    except Exception as e:
+        logger.error(f"Could not load tokenizer '{model_id}' for DummySLM: {e}", exc_info=True)
+        tokenizer = None
+    return DummySLM(device, tokenizer, logger=logger), tokenizer, device
+
+
+# --- ONNX export ---
+def onnx_export_path(export_dir: str, model_id: str, adapter_path: Optional[str], quantize_int8: bool) -> str:
+    """Directory holding the exported graph for one base model + adapter combination."""
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "--", model_id.strip("/"))
+    if adapter_path:
+        name += "--" + re.sub(r"[^A-Za-z0-9_.-]+", "--", os.path.basename(os.path.normpath(adapter_path)))
+    return os.path.join(export_dir, name + ("--int8" if quantize_int8 else "--fp32"))
+
+def export_onnx_causal_lm(model: Any, graph_dir: str, quantize_int8: bool = False, logger: Optional[Any] = None) -> str:
+    """
+    Traces `model` (a plain causal LM; merge PEFT adapters first) into `<graph_dir>/model.onnx`.
+    Inputs: input_ids, attention_mask, position_ids and past.<layer>.key/value; outputs: logits and
+    present.<layer>.key/value. The batch, sequence and cache lengths are dynamic, so one graph
+    serves both the prefill and the single-token decode steps.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    import torch
+    from transformers import DynamicCache
+
+    with torch.no_grad():
+        probe = model(input_ids=torch.tensor([[0, 0]]), use_cache=True).past_key_values
+    num_layers = len(probe.layers)
+    kv_heads, head_dim = probe.layers[0].keys.shape[1], probe.layers[0].keys.shape[3]
+
+    class CausalLMWithCache(torch.nn.Module):
+        def __init__(self, causal_lm: Any):
+            super().__init__()
+            self.causal_lm = causal_lm
+
+        def forward(self, input_ids, attention_mask, position_ids, *past):
+            cache = DynamicCache()
+            for layer_index in range(num_layers):
+                cache.update(past[2 * layer_index], past[2 * layer_index + 1], layer_index)
+            outputs = self.causal_lm(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache, use_cache=True)
+            present = [tensor for layer in outputs.past_key_values.layers for tensor in (layer.keys, layer.values)]
+            return (outputs.logits, *present)
+
+    past_names = [f"past.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    present_names = [f"present.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    dynamic_axes: Dict[str, Dict[int, str]] = {
+        "input_ids": {0: "batch", 1: "sequence"}, "position_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "total_sequence"}, "logits": {0: "batch", 1: "sequence"},
+    }
+    dynamic_axes.update({name: {0: "batch", 2: "past_sequence"} for name in past_names})
+    dynamic_axes.update({name: {0: "batch", 2: "total_sequence"} for name in present_names})
+    example_past = [torch.zeros(1, kv_heads, 3, head_dim, dtype=probe.layers[0].keys.dtype) for _ in past_names]
+    example_inputs = (torch.tensor([[0, 0]]), torch.ones(1, 5, dtype=torch.long), torch.tensor([[3, 4]]), *example_past)
+
+    start = time.time()
+    staging_dir = f"{graph_dir}.tmp{os.getpid()}"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    # Models over 2 GB are written with external weight files, so the float graph for int8 gets its own directory.
+    float_dir = os.path.join(staging_dir, "fp32") if quantize_int8 else staging_dir
+    os.makedirs(float_dir)
+    float_graph_path = os.path.join(float_dir, ONNX_GRAPH_FILENAME)
+    # The TorchScript-based exporter handles the cache tuple and dynamic axes; torch >= 2.5 defaults to the dynamo exporter.
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore") # Tracer warnings about shape-dependent branches; the graph is only fed unpadded inputs.
+        torch.onnx.export(
+            CausalLMWithCache(model).eval(), example_inputs, float_graph_path, input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + present_names, dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET_VERSION, **export_kwargs
+        )
+    if quantize_int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(float_graph_path, os.path.join(staging_dir, ONNX_GRAPH_FILENAME), weight_type=QuantType.QInt8, use_external_data_format=True)
+        shutil.rmtree(float_dir)
+    shutil.rmtree(graph_dir, ignore_errors=True)
+    os.replace(staging_dir, graph_dir)
+    logger.info(f"Exported ONNX graph ({num_layers} layers{', int8 weights' if quantize_int8 else ''}) to '{graph_dir}' in {time.time() - start:.1f}s.")
+    return os.path.join(graph_dir, ONNX_GRAPH_FILENAME)
+
+def load_onnx_model_tokenizer(
+    model_id: str,
+    adapter_path: Optional[str] = None,
+    logger: Optional[Any] = None,
+    trust_remote_code_flag: bool = True,
+    torch_dtype_str: str = "auto",
+    export_dir: str = ONNX_EXPORT_DIR
+) -> Tuple[Optional["OnnxRuntimeCausalLM"], Optional[Any], Optional["torch.device"]]:
+    """Loads (exporting first if needed) the ONNX Runtime model for `model_id` with `adapter_path` merged in."""
+    if logger is None:
+        logger = DefaultLogger()
+    import torch
+    quantize_int8 = torch_dtype_str.lower() in QUANTIZED_DTYPE_STRS
+    graph_dir = onnx_export_path(export_dir, model_id, adapter_path, quantize_int8)
+    graph_path = os.path.join(graph_dir, ONNX_GRAPH_FILENAME)
+    device = torch.device("cpu")
+    tokenizer = None
+    try:
+        if not os.path.exists(graph_path):
+            logger.info(f"No ONNX graph at '{graph_dir}'. Exporting '{model_id}' (adapter: {adapter_path or 'None'})...")
+            hf_model, tokenizer, _ = load_model_tokenizer_with_adapter(
+                model_id, adapter_path=adapter_path, logger=logger, trust_remote_code_flag=trust_remote_code_flag, torch_dtype_str="float32"
+            )
+            if hf_model is None:
+                raise RuntimeError(f"Could not load '{model_id}' for the ONNX export.")
+            hf_model = hf_model.to(device)
+            if hasattr(hf_model, "merge_and_unload"): # PeftModel: fold the LoRA deltas into the base weights.
+                hf_model = hf_model.merge_and_unload()
+            export_onnx_causal_lm(hf_model, graph_dir, quantize_int8=quantize_int8, logger=logger)
+            del hf_model
+        if tokenizer is None:
+            tokenizer = load_tokenizer(model_id, logger=logger, trust_remote_code_flag=trust_remote_code_flag)
+        model = OnnxRuntimeCausalLM(graph_path, name_or_path=model_id, logger=logger)
+        return model, tokenizer, device
+    except Exception as e:
+        logger.error(f"Could not load the ONNX Runtime backend for '{model_id}': {e}", exc_info=True)
+        return None, tokenizer, device
+
+
+# --- ONNX Runtime model ---
+class OnnxRuntimeCausalLM:
+    """
+    Runs a graph from `export_onnx_causal_lm` on the ONNX Runtime CPU execution provider.
+    `generate` mirrors the subset of `transformers` `generate` the services use: greedy or
+    temperature/top-p sampling, EOS handling, `streamer` and `stopping_criteria`. Prompts in a
+    batch must have the same length (no padding). Other keyword arguments (e.g. assisted decoding)
+    are ignored. Sessions are thread-safe, so one instance can serve concurrent requests.
+    """
+    def __init__(self, graph_path: str, name_or_path: Optional[str] = None, logger: Optional[Any] = None, intra_op_num_threads: int = 0):
+        import onnxruntime
+        import torch
+        self.logger = logger if logger is not None else DefaultLogger()
+        self.graph_path = graph_path
+        self.name_or_path = name_or_path or graph_path
+        self.device = torch.device("cpu")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads # 0 = ONNX Runtime default (all physical cores)
+        self.session = onnxruntime.InferenceSession(graph_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.past_inputs = [i for i in self.session.get_inputs() if i.name.startswith("past.")]
+        graph_dir = os.path.dirname(graph_path) or "."
+        self.weight_bytes = sum(os.path.getsize(os.path.join(graph_dir, name)) for name in os.listdir(graph_dir) if os.path.isfile(os.path.join(graph_dir, name)))
+        self.logger.info(f"ONNX Runtime session ready for '{self.name_or_path}' ({len(self.past_inputs) // 2} layers, {graph_path}).")
+
+    def generate(
+        self, input_ids: "torch.Tensor", max_new_tokens: int = 20, eos_token_id: Optional[Any] = None, pad_token_id: Optional[int] = None,
+        do_sample: bool = False, temperature: float = 1.0, top_p: float = 1.0, streamer: Optional[Any] = None,
+        stopping_criteria: Optional[Any] = None, attention_mask: Optional["torch.Tensor"] = None, **kwargs: Any
+    ) -> "torch.Tensor":
+        import numpy as np
+        import torch
+        sequences = input_ids.to("cpu", dtype=torch.long)
+        batch_size, prompt_len = sequences.shape
+        # A left-padded batch passes its `attention_mask`; positions then count real tokens only.
+        mask = attention_mask.to("cpu", dtype=torch.long).numpy() if attention_mask is not None else np.ones((batch_size, prompt_len), dtype=np.int64)
+        eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id] if eos_token_id is not None else [])
+        fill_token_id = pad_token_id if pad_token_id is not None else (next(iter(eos_token_ids)) if eos_token_ids else 0)
+        past = [np.zeros((batch_size, i.shape[1], 0, i.shape[3]), dtype=np.float32) for i in self.past_inputs]
+        unfinished = torch.ones(batch_size, dtype=torch.bool)
+        step_ids = sequences.numpy()
+        if streamer is not None:
+            streamer.put(sequences)
+        for _ in range(max_new_tokens):
+            if mask.shape[1] < (past[0].shape[2] if past else 0) + step_ids.shape[1]:
+                mask = np.concatenate([mask, np.ones((batch_size, 1), dtype=np.int64)], axis=1)
+            feeds = {
+                "input_ids": step_ids, "attention_mask": mask,
+                "position_ids": np.maximum(mask.cumsum(axis=1) - 1, 0)[:, -step_ids.shape[1]:],
+            }
+            feeds.update({i.name: tensor for i, tensor in zip(self.past_inputs, past)})
+            logits, *past = self.session.run(None, feeds)
+            next_logits = torch.from_numpy(logits[:, -1, :])
+            next_tokens = sample_next_tokens(next_logits, do_sample, temperature, top_p)
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, fill_token_id))
+            sequences = torch.cat([sequences, next_tokens[:, None]], dim=1)
+            if streamer is not None:
+                streamer.put(next_tokens)
+            if eos_token_ids:
+                unfinished &= ~torch.tensor([int(t) in eos_token_ids for t in next_tokens])
+            if stopping_criteria is not None:
+                unfinished &= ~stopping_criteria(sequences, next_logits)
+            if not bool(unfinished.any()):
+                break
+            step_ids = next_tokens[:, None].numpy()
+        if streamer is not None:
+            streamer.end()
+        return sequences
+
+    def to(self, device: Any):
+        if str(device) != "cpu":
+            self.logger.warning(f"OnnxRuntimeCausalLM runs on the CPU execution provider only; ignoring move to {device}.")
+        return self
+
+    def eval(self):
+        return self
+
+def sample_next_tokens(logits: "torch.Tensor", do_sample: bool, temperature: float, top_p: float) -> "torch.Tensor":
+    """Greedy, or temperature + nucleus (top-p) sampling, over `logits` of shape (batch, vocab)."""
+    import torch
+    if not do_sample:
+        return logits.argmax(dim=-1)
+    probs = torch.softmax(logits.float() / max(temperature, 1e-5), dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_indices = probs.sort(dim=-1, descending=True)
+        outside_nucleus = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p
+        sorted_probs = sorted_probs.masked_fill(outside_nucleus, 0.0)
+        probs = torch.zeros_like(probs).scatter(-1, sorted_indices, sorted_probs)
+    return torch.multinomial(probs, num_samples=1).squeeze(-1)
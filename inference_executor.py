@@ -0,0 +1,76 @@
+# inference_executor.py
+"""
+Executor layer that keeps blocking inference work off the asyncio event loop.
+
+The AITA Interaction Service awaits every CPU-heavy stage of an `/interact` turn
+(tokenization, generation, decoding, moderation) through an `InferenceExecutor`, so
+lightweight endpoints such as `/users/{user_id}` stay responsive while a long reply
+is being generated.
+
+Two modes are supported:
+- "thread":  a `ThreadPoolExecutor`. Stages share the models already loaded in the
+             service process (PyTorch releases the GIL inside its kernels).
+- "process": a `ProcessPoolExecutor` whose workers load and hold their own copy of
+             the models via `initializer`. Submitted callables and their arguments
+             must be picklable (module-level functions, plain data).
+"""
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from model_loader_utils import DefaultLogger
+
+EXECUTOR_MODES = ("thread", "process")
+
+
+class InferenceExecutor:
+    def __init__(
+        self,
+        mode: str = "thread",
+        max_workers: int = 4,
+        initializer: Optional[Callable[..., None]] = None,
+        initargs: Tuple[Any, ...] = (),
+        logger: Optional[Any] = None
+    ):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"Unknown executor mode '{mode}'. Expected one of {EXECUTOR_MODES}.")
+        self.mode = mode
+        self.max_workers = max(1, max_workers)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        self._pool: Optional[Executor] = None
+        self.stats: Dict[str, int] = {"tasks_submitted": 0}
+
+    def start(self):
+        if self._pool is not None:
+            return
+        if self.mode == "process":
+            # "spawn" avoids forking a parent that may already hold PyTorch thread pools.
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.initializer, initargs=self.initargs
+            )
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="aita_inference",
+                initializer=self.initializer, initargs=self.initargs
+            )
+        self.logger.info(f"InferenceExecutor: started {self.mode} pool with {self.max_workers} workers.")
+
+    def shutdown(self, wait: bool = True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+            self.logger.info("InferenceExecutor: pool shut down.")
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Runs `fn(*args, **kwargs)` in the pool and awaits its result."""
+        if self._pool is None:
+            self.start()
+        self.stats["tasks_submitted"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
@@ -0,0 +1,195 @@
+# kv_cache.py
+"""
+Reusable KV-cache state for the generation scheduler.
+
+`PrefixKVCache` keeps the `past_key_values` of shared prompt prefixes. In the AITA
+Interaction Service that is the system prompt built from the persona, grade, passage
+and learning objective, which is identical for every student working on the same
+activity. A new request whose prompt starts with a cached prefix only has to prefill
+its own suffix (conversation history and the new utterance).
+
+`SessionKVCache` keeps, per conversation `session_id`, the token ids of the last turn
+(prompt plus reply) and their KV cache. Clients resend the whole conversation history
+on every turn, so the next prompt starts with those tokens and only the new user
+message has to be prefilled.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+from model_loader_utils import DefaultLogger
+
+if TYPE_CHECKING:
+    from generation_scheduler import LegacyCache # Type-only: generation_scheduler imports torch.
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def slice_cache(layers: "LegacyCache", length: int, copy: bool = False) -> "LegacyCache":
+    """Keeps the first `length` positions of every key/value tensor (optionally as compact copies)."""
+    if copy:
+        return tuple((k[:, :, :length, :].clone(), v[:, :, :length, :].clone()) for k, v in layers)
+    return tuple((k[:, :, :length, :], v[:, :, :length, :]) for k, v in layers)
+
+def cache_nbytes(layers: "LegacyCache") -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+class PrefixKVCache:
+    """
+    Bounded LRU map from (namespace, prefix token ids) to the batch-1 KV cache of that prefix.
+
+    The namespace separates states that are not interchangeable, e.g. different PEFT
+    adapters on a shared base model. `lookup` returns the longest cached prefix of the
+    given prompt (at least `min_prefix_tokens` long), truncated so that at least one
+    prompt token is left to prefill. Thread-safe.
+    """
+    def __init__(self, max_entries: int = 32, max_bytes: Optional[int] = None, min_prefix_tokens: int = 16, logger: Optional[Any] = None):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes if max_bytes else None
+        self.min_prefix_tokens = max(1, min_prefix_tokens)
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        self._entries: "OrderedDict[Tuple[Hashable, Tuple[int, ...]], Tuple[LegacyCache, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"lookups": 0, "hits": 0, "misses": 0, "tokens_reused": 0, "stores": 0, "evictions": 0, "bytes_in_use": 0}
+
+    def lookup(self, namespace: Hashable, token_ids: Sequence[int]) -> Tuple[int, Optional["LegacyCache"]]:
+        """Returns (number of reused prompt tokens, their KV cache), or (0, None) on a miss."""
+        with self._lock:
+            self.stats["lookups"] += 1
+            best_key, best_len = None, 0
+            for key in self._entries:
+                if key[0] != namespace:
+                    continue
+                match_len = common_prefix_length(key[1], token_ids)
+                if match_len > best_len:
+                    best_key, best_len = key, match_len
+            reuse_len = min(best_len, len(token_ids) - 1)
+            if best_key is None or reuse_len < self.min_prefix_tokens:
+                self.stats["misses"] += 1
+                return 0, None
+            self._entries.move_to_end(best_key)
+            self.stats["hits"] += 1
+            self.stats["tokens_reused"] += reuse_len
+            return reuse_len, slice_cache(self._entries[best_key][0], reuse_len)
+
+    def store(self, namespace: Hashable, prefix_ids: Sequence[int], past: "LegacyCache"):
+        """Caches the first `len(prefix_ids)` positions of `past` (a batch-1 cache covering at least that many tokens)."""
+        if len(prefix_ids) < self.min_prefix_tokens:
+            return
+        key = (namespace, tuple(prefix_ids))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+        # Copy outside the lock: a slice view would keep the whole prompt's KV tensors alive.
+        prefix_past = slice_cache(past, len(prefix_ids), copy=True)
+        size_bytes = cache_nbytes(prefix_past)
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (prefix_past, size_bytes)
+            self.stats["stores"] += 1
+            self.stats["bytes_in_use"] += size_bytes
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.stats["bytes_in_use"] > self.max_bytes and len(self._entries) > 1):
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+                self.stats["bytes_in_use"] -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats["bytes_in_use"] = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["lookups"]
+            return {"entries": len(self._entries), "hit_rate": self.stats["hits"] / lookups if lookups else 0.0, **self.stats}
+
+
+class SessionKVCache:
+    """
+    Per-session KV state with idle-timeout eviction and a memory cap (least recently used
+    sessions are dropped first). A session's state is only reused when the lookup comes
+    from the same namespace (model/adapter) that produced it. Thread-safe.
+    """
+    def __init__(self, max_bytes: Optional[int] = None, idle_timeout_s: float = 900.0, min_reuse_tokens: int = 16, logger: Optional[Any] = None):
+        self.max_bytes = max_bytes if max_bytes else None
+        self.idle_timeout_s = idle_timeout_s
+        self.min_reuse_tokens = max(1, min_reuse_tokens)
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        # session_id -> {"namespace", "token_ids", "past", "size_bytes", "last_used_at"}, least recently used first.
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"lookups": 0, "hits": 0, "misses": 0, "tokens_reused": 0, "stores": 0, "idle_evictions": 0, "memory_evictions": 0, "bytes_in_use": 0}
+
+    def lookup(self, session_id: str, namespace: Hashable, token_ids: Sequence[int]) -> Tuple[int, Optional["LegacyCache"]]:
+        """Returns (number of reused prompt tokens, their KV cache), or (0, None) on a miss."""
+        with self._lock:
+            self._evict_idle()
+            self.stats["lookups"] += 1
+            state = self._sessions.get(session_id)
+            reuse_len = 0
+            if state is not None and state["namespace"] == namespace:
+                reuse_len = min(common_prefix_length(state["token_ids"], token_ids), len(token_ids) - 1)
+            if reuse_len < self.min_reuse_tokens:
+                self.stats["misses"] += 1
+                return 0, None
+            state["last_used_at"] = time.time()
+            self._sessions.move_to_end(session_id)
+            self.stats["hits"] += 1
+            self.stats["tokens_reused"] += reuse_len
+            return reuse_len, slice_cache(state["past"], reuse_len)
+
+    def store(self, session_id: str, namespace: Hashable, token_ids: Sequence[int], past: "LegacyCache"):
+        """Replaces the session's state with `token_ids` and the matching batch-1 cache (`past` covers exactly those tokens)."""
+        if len(token_ids) < self.min_reuse_tokens:
+            return
+        past = slice_cache(past, len(token_ids), copy=True) # Detach from the (possibly batched) tensors it was cut from.
+        size_bytes = cache_nbytes(past)
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self.stats["bytes_in_use"] -= previous["size_bytes"]
+            self._sessions[session_id] = {"namespace": namespace, "token_ids": tuple(token_ids), "past": past, "size_bytes": size_bytes, "last_used_at": time.time()}
+            self.stats["stores"] += 1
+            self.stats["bytes_in_use"] += size_bytes
+            self._evict_idle()
+            while self.max_bytes is not None and self.stats["bytes_in_use"] > self.max_bytes and self._sessions:
+                _, evicted = self._sessions.popitem(last=False)
+                self.stats["memory_evictions"] += 1
+                self.stats["bytes_in_use"] -= evicted["size_bytes"]
+
+    def discard(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drops every session whose namespace matches `predicate` (e.g. after its model was unloaded)."""
+        with self._lock:
+            doomed = [session_id for session_id, state in self._sessions.items() if predicate(state["namespace"])]
+            for session_id in doomed:
+                self.stats["bytes_in_use"] -= self._sessions.pop(session_id)["size_bytes"]
+            return len(doomed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._evict_idle()
+            lookups = self.stats["lookups"]
+            return {"sessions": len(self._sessions), "hit_rate": self.stats["hits"] / lookups if lookups else 0.0, **self.stats}
+
+    def _evict_idle(self):
+        # Caller holds the lock. Sessions are in last-used order, so stop at the first fresh one.
+        cutoff = time.time() - self.idle_timeout_s
+        while self._sessions:
+            session_id, state = next(iter(self._sessions.items()))
+            if state["last_used_at"] >= cutoff:
+                break
+            del self._sessions[session_id]
+            self.stats["idle_evictions"] += 1
+            self.stats["bytes_in_use"] -= state["size_bytes"]
@@ -1,9 +1,13 @@
 # model_loader_utils.py
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
-from typing import Optional, Tuple, Any
+# torch / transformers / peft are imported inside the functions that need them, so importing this
+# module (e.g. for DefaultLogger) stays cheap and services can start answering before models load.
+from typing import Optional, Tuple, Any, Dict, List, TYPE_CHECKING
 import os
+import time
+
+if TYPE_CHECKING:
+    import torch
+    from transformers import AutoTokenizer
 
 class DefaultLogger:
     def info(self, message: str): print(f"INFO: {message}")
@@ -13,10 +17,17 @@ class DefaultLogger:
     def warning(self, message: str): print(f"WARNING: {message}")
 
 class DummySLM:
-    def __init__(self, device: torch.device, tokenizer: Optional[AutoTokenizer], logger: Optional[Any] = None):
+    """
+    Stand-in model returning a fixed reply. `prefill_latency_s` / `decode_latency_s` (seconds per
+    prompt token / per generated token) make `generate` sleep like a real model would, for load tests.
+    """
+    def __init__(self, device: "torch.device", tokenizer: Optional["AutoTokenizer"], logger: Optional[Any] = None,
+                 prefill_latency_s: float = 0.0, decode_latency_s: float = 0.0):
         self.device = device
         self.tokenizer = tokenizer # Store tokenizer for encoding dummy response
         self.name_or_path = "DummySLM_Fallback" # Mimic real model attribute
+        self.prefill_latency_s = prefill_latency_s
+        self.decode_latency_s = decode_latency_s
 
         if logger is None:
             self.logger = DefaultLogger()
@@ -24,7 +35,8 @@ class DummySLM:
             self.logger = logger
         self.logger.info(f"Instantiated DummySLM. Device: {self.device}. Tokenizer: {'Available' if self.tokenizer else 'Not Available'}")
 
-    def generate(self, input_ids: torch.Tensor, max_new_tokens: int, eos_token_id: int, pad_token_id: int, **kwargs) -> torch.Tensor:
+    def generate(self, input_ids: "torch.Tensor", max_new_tokens: int, eos_token_id: Optional[int], pad_token_id: Optional[int], **kwargs) -> "torch.Tensor":
+        import torch
         dummy_response_text = "This is a dummy response from DummySLM. The primary model may have failed to load or encountered an issue."
 
         if self.tokenizer:
@@ -48,19 +60,44 @@ class DummySLM:
             else:
                  dummy_response_ids_with_eos = torch.cat([dummy_response_ids, eos_tensor], dim=1)
 
-            # Concatenate with the original input_ids
+            # Concatenate with the original input_ids (every row of a batch gets the same reply)
             # The model.generate() function normally returns the prompt + generated tokens.
-            full_sequence = torch.cat([input_ids, dummy_response_ids_with_eos], dim=1)
-            return full_sequence
+            full_sequence = torch.cat([input_ids, dummy_response_ids_with_eos.expand(input_ids.shape[0], -1)], dim=1)
+            produced = self.simulate_latency(input_ids.shape[1], dummy_response_ids_with_eos.shape[1], kwargs.get("stopping_criteria"), full_sequence)
+            streamer = kwargs.get("streamer")
+            if streamer is not None: # Same protocol as `transformers` generate: the prompt first, then each new token.
+                streamer.put(input_ids)
+                for position in range(input_ids.shape[1], input_ids.shape[1] + produced):
+                    streamer.put(full_sequence[:, position])
+                streamer.end()
+            return full_sequence[:, :input_ids.shape[1] + produced]
         else:
             self.logger.error("DummySLM: Tokenizer not available for encoding dummy response.")
             # Fallback: return input_ids concatenated with an EOS token to avoid downstream errors
             # expecting a longer sequence, and ensure it's on the correct device.
-            eos_fill_tensor = torch.full((input_ids.shape[0], 1), eos_token_id, dtype=torch.long, device=input_ids.device)
+            # Without a tokenizer there may be no EOS id either; the pad id, else 0, stands in for it.
+            fill_id = eos_token_id if eos_token_id is not None else (pad_token_id if pad_token_id is not None else 0)
+            eos_fill_tensor = torch.full((input_ids.shape[0], 1), fill_id, dtype=torch.long, device=input_ids.device)
             return torch.cat([input_ids, eos_fill_tensor], dim=1)
 
 
-    def to(self, device: torch.device):
+    def simulate_latency(self, prompt_tokens: int, new_tokens: int, stopping_criteria: Optional[Any] = None, sequence: Optional["torch.Tensor"] = None) -> int:
+        """Sleeps like a real model would. Returns how many of `new_tokens` were produced before `stopping_criteria` ended generation."""
+        if stopping_criteria is None or sequence is None:
+            delay = self.prefill_latency_s * prompt_tokens + self.decode_latency_s * new_tokens
+            if delay > 0:
+                time.sleep(delay)
+            return new_tokens
+        if self.prefill_latency_s > 0:
+            time.sleep(self.prefill_latency_s * prompt_tokens)
+        for produced in range(1, new_tokens + 1):
+            if self.decode_latency_s > 0:
+                time.sleep(self.decode_latency_s)
+            if produced < new_tokens and bool(stopping_criteria(sequence[:, :prompt_tokens + produced], None).all()):
+                return produced
+        return new_tokens
+
+    def to(self, device: "torch.device"):
         self.logger.info(f"DummySLM: Moving to device {device} (no-op for most internal tensors, device property updated).")
         self.device = device
         return self
@@ -69,42 +106,98 @@ class DummySLM:
         self.logger.info("DummySLM set to eval mode (no-op).")
         pass
 
+def is_valid_adapter_dir(adapter_path: str) -> bool:
+    expected_config_file = os.path.join(adapter_path, "adapter_config.json")
+    has_model_file = any(os.path.exists(os.path.join(adapter_path, fName)) for fName in ["adapter_model.bin", "adapter_model.safetensors"])
+    return os.path.isdir(adapter_path) and os.path.exists(expected_config_file) and has_model_file
+
+# torch_dtype_str values that load float32 weights and then quantize them for CPU inference.
+QUANTIZED_DTYPE_STRS = ("int8",)
+
+def quantize_model_dynamic_int8(model: Any, logger: Optional[Any] = None) -> Any:
+    """
+    Applies dynamic int8 quantization (int8 weights, activations quantized on the fly) to the
+    model's `nn.Linear` layers, in place. Runs on CPU only. PEFT LoRA layers (`lora_A` / `lora_B`)
+    stay in float32: the adapters keep their exact weights and `set_adapter` keeps working, while
+    the frozen base projections they wrap are quantized.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    import torch
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+    qconfig_spec = {
+        name: default_dynamic_qconfig for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and "lora_" not in name
+    }
+    quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    logger.info(f"Applied dynamic int8 quantization to {len(qconfig_spec)} Linear layers.")
+    return model
+
+def load_tokenizer(model_id: str, logger: Optional[Any] = None, trust_remote_code_flag: bool = True) -> "AutoTokenizer":
+    if logger is None:
+        logger = DefaultLogger()
+    from transformers import AutoTokenizer
+    logger.info(f"Loading tokenizer for '{model_id}'...")
+    tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=trust_remote_code_flag)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+        logger.info(f"Set tokenizer.pad_token to tokenizer.eos_token: {tokenizer.eos_token}")
+    return tokenizer
+
 def load_model_tokenizer_with_adapter(
     model_id: str,
     adapter_path: Optional[str] = None,
     logger: Optional[Any] = None,
     trust_remote_code_flag: bool = True,
-    torch_dtype_str: str = "auto"
-) -> Tuple[Optional[Any], Optional[AutoTokenizer], Optional[torch.device]]:
+    torch_dtype_str: str = "auto",
+    shared_weights_dir: Optional[str] = None,
+    backend: str = "hf"
+) -> Tuple[Optional[Any], Optional["AutoTokenizer"], Optional["torch.device"]]:
+    """
+    Loads `model_id` (plus an optional PEFT adapter) for inference. With `shared_weights_dir`,
+    the base weights of a CPU, non-int8 model are memory-mapped from an export there, so worker
+    processes loading the same model share one physical copy (see shared_weights.py).
+    `backend` selects the inference backend: "hf" (this function), "onnx" or "dummy"
+    (see inference_backends.py). Shared weights only apply to "hf".
+    """
     if logger is None:
         logger = DefaultLogger()
+    if backend != "hf":
+        from inference_backends import load_backend_model_tokenizer
+        return load_backend_model_tokenizer(backend, model_id, adapter_path=adapter_path, logger=logger, trust_remote_code_flag=trust_remote_code_flag, torch_dtype_str=torch_dtype_str)
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from peft import PeftModel
+    from shared_weights import is_exported, load_shared_base_weights, shared_weights_path
     logger.info(f"Attempting to load model and tokenizer for '{model_id}'...")
     loaded_tokenizer: Optional[AutoTokenizer] = None
     loaded_model: Optional[Any] = None
     current_device: Optional[torch.device] = None
+    quantize_int8 = torch_dtype_str.lower() in QUANTIZED_DTYPE_STRS
     try:
-        current_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        current_device = torch.device("cuda" if torch.cuda.is_available() and not quantize_int8 else "cpu")
         logger.info(f"Using device: {current_device}")
-        logger.info(f"Loading tokenizer for '{model_id}'...")
-        loaded_tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=trust_remote_code_flag)
-        if loaded_tokenizer.pad_token is None:
-            loaded_tokenizer.pad_token = loaded_tokenizer.eos_token
-            logger.info(f"Set tokenizer.pad_token to tokenizer.eos_token: {loaded_tokenizer.eos_token}")
+        loaded_tokenizer = load_tokenizer(model_id, logger=logger, trust_remote_code_flag=trust_remote_code_flag)
         logger.info(f"Loading base model '{model_id}' with dtype '{torch_dtype_str}'...")
-        dtype_map = {"auto": "auto", "bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+        dtype_map = {"auto": "auto", "bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32, "int8": torch.float32}
         resolved_torch_dtype = dtype_map.get(torch_dtype_str.lower(), "auto")
+        share_weights = bool(shared_weights_dir) and current_device.type == "cpu" and not quantize_int8
+        if shared_weights_dir and not share_weights:
+            logger.warning("Shared weights are only used for unquantized models on CPU. Loading a private copy.")
+        shared_export_dir = shared_weights_path(shared_weights_dir, model_id, torch_dtype_str) if share_weights else None
+        # Once another worker has exported the weights, load from that export so this process never holds its own full copy.
+        weights_source = shared_export_dir if shared_export_dir and is_exported(shared_export_dir) else model_id
         loaded_model = AutoModelForCausalLM.from_pretrained(
-            model_id,
+            weights_source,
             torch_dtype=resolved_torch_dtype,
             trust_remote_code=trust_remote_code_flag
         )
         loaded_model.to(current_device)
         logger.info(f"Base model '{model_id}' loaded successfully on {current_device}.")
+        if share_weights:
+            load_shared_base_weights(loaded_model, model_id, torch_dtype_str, shared_weights_dir, logger)
         if adapter_path:
-            expected_config_file = os.path.join(adapter_path, "adapter_config.json")
-            has_model_file = any(os.path.exists(os.path.join(adapter_path, fName)) for fName in ["adapter_model.bin", "adapter_model.safetensors"])
-
-            if os.path.isdir(adapter_path) and os.path.exists(expected_config_file) and has_model_file:
+            if is_valid_adapter_dir(adapter_path):
                 logger.info(f"Loading PEFT adapter from directory: '{adapter_path}'...")
                 try:
                     loaded_model = PeftModel.from_pretrained(loaded_model, adapter_path)
@@ -115,6 +208,12 @@ def load_model_tokenizer_with_adapter(
                 logger.warning(f"Adapter path '{adapter_path}' not found, not a directory, or doesn't appear to be a valid PEFT adapter directory (missing config or model files). Using base model only.")
         else:
             logger.info("No adapter path provided. Using base model only.")
+        if quantize_int8:
+            # After the adapter is attached, so PEFT wraps ordinary Linear layers.
+            try:
+                loaded_model = quantize_model_dynamic_int8(loaded_model, logger)
+            except Exception as e_quant:
+                logger.error(f"Dynamic int8 quantization failed: {str(e_quant)}. Using float32 weights.", exc_info=True)
         loaded_model.eval()
         logger.info(f"Model setup complete for '{model_id}' (with adapter: {adapter_path if adapter_path else 'None'}). Model is in eval mode.")
         return loaded_model, loaded_tokenizer, current_device
@@ -123,8 +222,82 @@ def load_model_tokenizer_with_adapter(
         # Return tokenizer if it loaded, even if model failed, so DummySLM can use it
         return None, loaded_tokenizer, current_device
 
+def load_model_tokenizer_with_adapters(
+    model_id: str,
+    adapter_paths: Dict[str, str],
+    logger: Optional[Any] = None,
+    trust_remote_code_flag: bool = True,
+    torch_dtype_str: str = "auto",
+    shared_weights_dir: Optional[str] = None
+) -> Tuple[Optional[Any], Optional["AutoTokenizer"], Optional["torch.device"], List[str]]:
+    """
+    Loads the base model once and registers every valid PEFT adapter in `adapter_paths`
+    on it under its dict key, so one copy of the base weights serves many personas.
+    Switch adapters with `model.set_adapter(name)`; run the plain base model inside
+    `with model.disable_adapter():`.
+
+    Returns (model, tokenizer, device, loaded_adapter_names). Adapters that are missing or
+    fail to load are skipped with a warning; their personas should fall back to the base model.
+    With `torch_dtype_str="int8"` the base is quantized once all adapters are registered.
+    `shared_weights_dir` memory-maps the base weights as in `load_model_tokenizer_with_adapter`.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    from peft import PeftModel
+    quantize_int8 = torch_dtype_str.lower() in QUANTIZED_DTYPE_STRS
+    base_model, loaded_tokenizer, current_device = load_model_tokenizer_with_adapter(
+        model_id=model_id, adapter_path=None, logger=logger,
+        trust_remote_code_flag=trust_remote_code_flag, torch_dtype_str="float32" if quantize_int8 else torch_dtype_str,
+        shared_weights_dir=None if quantize_int8 else shared_weights_dir
+    )
+    if quantize_int8 and current_device is not None and current_device.type != "cpu":
+        logger.warning("int8 dynamic quantization runs on CPU only; keeping float32 weights on the GPU.")
+        quantize_int8 = False
+    if base_model is None:
+        return None, loaded_tokenizer, current_device, []
+
+    loaded_model: Any = base_model
+    loaded_adapter_names: List[str] = []
+    for adapter_name, adapter_path in adapter_paths.items():
+        if not adapter_path or not is_valid_adapter_dir(adapter_path):
+            logger.warning(f"Adapter '{adapter_name}' at '{adapter_path}' is not a valid PEFT adapter directory. Its persona will use the base model.")
+            continue
+        try:
+            if isinstance(loaded_model, PeftModel):
+                loaded_model.load_adapter(adapter_path, adapter_name=adapter_name)
+            else:
+                loaded_model = PeftModel.from_pretrained(loaded_model, adapter_path, adapter_name=adapter_name)
+            loaded_adapter_names.append(adapter_name)
+            logger.info(f"Registered PEFT adapter '{adapter_name}' from {adapter_path} on shared base '{model_id}'.")
+        except Exception as e_adapter:
+            logger.error(f"Error registering PEFT adapter '{adapter_name}' from {adapter_path}: {str(e_adapter)}. Its persona will use the base model.", exc_info=True)
+    if quantize_int8:
+        try:
+            loaded_model = quantize_model_dynamic_int8(loaded_model, logger)
+        except Exception as e_quant:
+            logger.error(f"Dynamic int8 quantization failed: {str(e_quant)}. Using float32 weights.", exc_info=True)
+    loaded_model.eval()
+    logger.info(f"Shared base '{model_id}' ready with {len(loaded_adapter_names)} adapter(s): {loaded_adapter_names}.")
+    return loaded_model, loaded_tokenizer, current_device, loaded_adapter_names
+
+
+def assisted_generation_kwargs(draft_model: Any, draft_tokenizer: Any, target_tokenizer: Any) -> Dict[str, Any]:
+    """
+    Extra `generate()` kwargs for assisted (speculative) decoding: `draft_model` proposes a few
+    tokens and the target model verifies them in a single forward pass. When the two tokenizers
+    differ, both are passed so transformers can translate between them (universal assisted decoding).
+    """
+    if draft_model is None or isinstance(draft_model, DummySLM):
+        return {}
+    generation_kwargs: Dict[str, Any] = {"assistant_model": draft_model}
+    if draft_tokenizer is not None and target_tokenizer is not None and draft_tokenizer.get_vocab() != target_tokenizer.get_vocab():
+        generation_kwargs.update(tokenizer=target_tokenizer, assistant_tokenizer=draft_tokenizer)
+    return generation_kwargs
+
 
 if __name__ == '__main__':
+    from peft import PeftModel
+
     logger_test = DefaultLogger()
     logger_test.info("--- Testing model_loader_utils.py ---")
 
@@ -0,0 +1,172 @@
+# model_registry.py
+"""
+Memory-budgeted LRU registry for loaded persona models.
+
+Replaces the unbounded `LOADED_MODELS_CACHE` dict of the AITA Interaction Service:
+- entries are kept in least-recently-used order and cold ones are evicted once the
+  estimated weight memory of all entries exceeds `memory_budget_bytes`;
+- concurrent misses for the same key are single-flight: one caller runs the loader
+  and the others wait for its result instead of loading the model again;
+- hit / miss / load / eviction counters are kept in `stats`.
+"""
+import gc
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from model_loader_utils import DefaultLogger
+
+# A registry entry is a dict with at least "model", "tokenizer" and "device" keys.
+RegistryEntry = Dict[str, Any]
+
+
+def estimate_model_bytes(model: Any) -> int:
+    """Approximate resident size of a model's parameters and buffers (0 for non-torch models such as DummySLM)."""
+    if getattr(model, "weight_bytes", None) is not None: # Models that know their own size, e.g. ONNX Runtime sessions.
+        return int(model.weight_bytes)
+    total = 0
+    seen = set()
+    for tensor_iter_name in ("parameters", "buffers"):
+        tensor_iter = getattr(model, tensor_iter_name, None)
+        if not callable(tensor_iter):
+            continue
+        for tensor in tensor_iter():
+            if id(tensor) in seen:
+                continue
+            seen.add(id(tensor))
+            total += tensor.numel() * tensor.element_size()
+    # Dynamically quantized Linear layers keep their int8 weights in packed params, not in parameters().
+    # Both the Linear and its LinearPackedParams child expose `_weight_bias()`; only the child holds
+    # the packed weights directly (the Linear's `_packed_params` is that child module), so count it once.
+    modules = getattr(model, "modules", None)
+    for module in (modules() if callable(modules) else []):
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(module, "_weight_bias") and not callable(getattr(packed, "modules", None)):
+            weight, bias = module._weight_bias()
+            total += weight.numel() * weight.element_size() + (bias.numel() * bias.element_size() if bias is not None else 0)
+    return total
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        memory_budget_bytes: Optional[int] = None,
+        logger: Optional[Any] = None,
+        on_evict: Optional[Callable[[str, RegistryEntry], None]] = None,
+        size_estimator: Callable[[Any], int] = estimate_model_bytes
+    ):
+        self.memory_budget_bytes = memory_budget_bytes if memory_budget_bytes else None
+        self.logger = logger if logger is not None else DefaultLogger()
+        self.on_evict = on_evict
+        self.size_estimator = size_estimator
+
+        self._entries: "OrderedDict[str, RegistryEntry]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, float] = {"hits": 0, "misses": 0, "single_flight_waits": 0, "loads": 0, "load_failures": 0, "evictions": 0, "bytes_in_use": 0}
+
+    def get_or_load(self, key: str, loader: Callable[[], Optional[RegistryEntry]]) -> Optional[RegistryEntry]:
+        """
+        Returns the entry for `key`, calling `loader()` on a miss. `loader` returns an entry
+        dict, or None when loading failed (failures are not cached, so the next call retries).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                entry["last_used_at"] = time.time()
+                return entry
+            self.stats["misses"] += 1
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                inflight = Future()
+                self._inflight[key] = inflight
+                is_loader = True
+            else:
+                self.stats["single_flight_waits"] += 1
+                is_loader = False
+
+        if not is_loader:
+            self.logger.info(f"ModelRegistry: waiting for in-flight load of '{key}'.")
+            return inflight.result()
+
+        entry = None
+        try:
+            entry = loader()
+        except Exception as e:
+            self.logger.error(f"ModelRegistry: loader for '{key}' raised: {e}", exc_info=True)
+        finally:
+            evicted = self._store(key, entry)
+            inflight.set_result(entry)
+        self._notify_evicted(evicted)
+        return entry
+
+    def peek(self, key: str) -> Optional[RegistryEntry]:
+        """Returns the entry without loading it or changing its LRU position."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def evict(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.stats["evictions"] += 1
+                self.stats["bytes_in_use"] -= entry["size_bytes"]
+        if entry is None:
+            return False
+        self._notify_evicted([(key, entry)])
+        return True
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "entries": [{"key": key, "size_bytes": entry["size_bytes"], "loaded_at": entry["loaded_at"], "last_used_at": entry["last_used_at"]} for key, entry in self._entries.items()],
+                **self.stats
+            }
+
+    # --- Internals ---
+    def _store(self, key: str, entry: Optional[RegistryEntry]) -> List[tuple]:
+        evicted = []
+        with self._lock:
+            self._inflight.pop(key, None)
+            if entry is None:
+                self.stats["load_failures"] += 1
+                return evicted
+            entry["size_bytes"] = self.size_estimator(entry.get("model"))
+            entry["loaded_at"] = entry["last_used_at"] = time.time()
+            self._entries[key] = entry
+            self.stats["loads"] += 1
+            self.stats["bytes_in_use"] += entry["size_bytes"]
+            if self.memory_budget_bytes is not None:
+                # Evict least-recently-used entries, but never the one that was just loaded.
+                while self.stats["bytes_in_use"] > self.memory_budget_bytes and len(self._entries) > 1:
+                    cold_key, cold_entry = self._entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+                    self.stats["bytes_in_use"] -= cold_entry["size_bytes"]
+                    evicted.append((cold_key, cold_entry))
+                if self.stats["bytes_in_use"] > self.memory_budget_bytes:
+                    self.logger.warning(f"ModelRegistry: '{key}' alone ({entry['size_bytes'] / 2**20:.0f} MiB) exceeds the memory budget ({self.memory_budget_bytes / 2**20:.0f} MiB).")
+        return evicted
+
+    def _notify_evicted(self, evicted: List[tuple]):
+        for cold_key, cold_entry in evicted:
+            self.logger.info(f"ModelRegistry: evicted '{cold_key}' ({cold_entry['size_bytes'] / 2**20:.0f} MiB).")
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(cold_key, cold_entry)
+                except Exception as e:
+                    self.logger.error(f"ModelRegistry: on_evict callback failed for '{cold_key}': {e}", exc_info=True)
+        if evicted:
+            gc.collect()
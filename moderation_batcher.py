@@ -0,0 +1,84 @@
+# moderation_batcher.py
+"""
+Cross-request micro-batching for the AITA Interaction Service's moderation checks.
+
+Every turn moderates its input and its output, one text per classifier call. Under load many
+turns do so at nearly the same time, and a BERT classifier handles a batch of short texts in
+little more time than a single one. `ModerationMicroBatcher.check_text` therefore queues the
+text instead of classifying it at once; texts that arrive within `window_s` of the first queued
+one (or until `max_batch_size` have arrived) are classified together by one `run_batch` call,
+e.g. `ModerationService.check_texts` run in the inference executor. Each caller gets the result
+for its own text, the same dict `check_text` returns.
+
+While one batch runs, the next one collects, so batches overlap when the executor has free
+workers. `snapshot()` reports batch counts and sizes. All methods must be called from the event
+loop; none of them block.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from model_loader_utils import DefaultLogger
+
+
+class ModerationMicroBatcher:
+    def __init__(self, run_batch: Callable[[List[str]], Awaitable[List[Dict[str, Any]]]], max_batch_size: int = 32, window_s: float = 0.005, logger: Optional[Any] = None):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window_s = max(0.0, window_s)
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        self._pending: List[Tuple[str, "asyncio.Future[Dict[str, Any]]"]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._running: Set["asyncio.Task[None]"] = set()
+        self.stats: Dict[str, int] = {"texts": 0, "batches": 0, "batched_texts": 0, "failed_batches": 0, "max_batch_texts": 0}
+
+    async def check_text(self, text: str) -> Dict[str, Any]:
+        """Moderates `text` as part of the next batch; raises whatever `run_batch` raised for that batch."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.stats["texts"] += 1
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window_s, self._flush)
+        return await future
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size, "window_ms": round(self.window_s * 1000, 3),
+            "queued_texts": len(self._pending), "running_batches": len(self._running),
+            "mean_batch_texts": round(self.stats["batched_texts"] / self.stats["batches"], 2) if self.stats["batches"] else None,
+            **self.stats,
+        }
+
+    # --- Internals ---
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # Callers that gave up (e.g. a cancelled turn) while queued are left out.
+        batch = [(text, future) for text, future in self._pending if not future.done()]
+        self._pending = []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[str, "asyncio.Future[Dict[str, Any]]"]]):
+        self.stats["batches"] += 1
+        self.stats["batched_texts"] += len(batch)
+        self.stats["max_batch_texts"] = max(self.stats["max_batch_texts"], len(batch))
+        try:
+            results = await self.run_batch([text for text, _ in batch])
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            self.logger.error(f"ModerationMicroBatcher: batch of {len(batch)} text(s) failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,101 @@
+# moderation_cache.py
+"""
+Result cache for `ModerationService`.
+
+Students paste the same sentences, and the service's fixed fallback replies are moderated
+on every turn that produces them, so the classifier often sees text it has already scored.
+`ModerationResultCache` keeps recent verdicts keyed by a hash of
+(model name, toxicity threshold, normalized text):
+- normalization only removes differences the classifier's tokenizer ignores anyway (see
+  `ModerationService`, which checks this against its tokenizer), so a cached verdict is
+  the one a fresh check would return;
+- only the 16-byte hash is stored, not the text, and entries are bounded both by count
+  (`max_entries`) and by their estimated size (`max_bytes`), least recently used first;
+- entries expire after `ttl_s` seconds, so a retuned model or threshold under the same
+  name is picked up eventually.
+
+`snapshot()` reports entries, bytes in use, hit rate and counters. Thread-safe.
+"""
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from model_loader_utils import DefaultLogger
+
+ENTRY_OVERHEAD_BYTES = 240 # Key, OrderedDict node and entry dict, on top of the serialized result.
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_moderation_text(text: str, lowercase: bool = False, collapse_whitespace: bool = False) -> str:
+    if collapse_whitespace:
+        text = _WHITESPACE_RE.sub(" ", text).strip()
+    return text.lower() if lowercase else text
+
+def moderation_cache_key(model_name: str, threshold: float, normalized_text: str) -> bytes:
+    return hashlib.blake2b(f"{model_name}\x00{threshold!r}\x00{normalized_text}".encode("utf-8"), digest_size=16).digest()
+
+
+class ModerationResultCache:
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 * 1024 * 1024, ttl_s: float = 3600.0, logger: Optional[Any] = None):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(0, max_bytes) # 0 = no size cap.
+        self.ttl_s = ttl_s
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        self._entries: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict() # least recently used first
+        self._bytes_in_use = 0
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+
+    def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        """A copy of the cached result for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            self.stats["lookups"] += 1
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["created_at"] > self.ttl_s:
+                self._drop(key)
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return copy.deepcopy(entry["result"])
+
+    def put(self, key: bytes, result: Dict[str, Any]):
+        size_bytes = len(json.dumps(result, default=str)) + ENTRY_OVERHEAD_BYTES
+        if self.max_bytes and size_bytes > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = {"result": copy.deepcopy(result), "created_at": time.time(), "size_bytes": size_bytes}
+            self._bytes_in_use += size_bytes
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes_in_use > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes_in_use = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries), "bytes_in_use": self._bytes_in_use, "max_entries": self.max_entries, "max_bytes": self.max_bytes,
+                "hit_rate": self.stats["hits"] / self.stats["lookups"] if self.stats["lookups"] else 0.0, **self.stats,
+            }
+
+    # --- Internals (caller holds the lock) ---
+    def _drop(self, key: bytes):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes_in_use -= entry["size_bytes"]
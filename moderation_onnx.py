@@ -0,0 +1,135 @@
+# moderation_onnx.py
+"""
+ONNX Runtime backend for `ModerationService`.
+
+The moderation classifier (a BERT-base model for toxic-bert) runs twice per turn, on CPU in most
+deployments. `load_onnx_text_classifier` exports it once to an ONNX graph under
+AITA_ONNX_EXPORT_DIR (the same directory layout as the causal LMs in inference_backends.py), optionally
+with int8 weights from ONNX Runtime's dynamic quantization, and wraps the session in
+`OnnxTextClassifier`. That class is called like the `text-classification` pipeline with `top_k=None`:
+a list of texts in, one list of {"label", "score"} dicts per text out, best label first, with
+sigmoid scores for multi-label models such as toxic-bert and softmax scores otherwise. Like the
+pipeline, it truncates inputs only when called with `truncation=True` (and `max_length`).
+
+Needs `onnxruntime`, plus `onnx` and torch for the first export. Workers starting together
+serialize the export on `<graph dir>.lock` (as shared_weights.py does), so only one of them writes it.
+"""
+import inspect
+import os
+import shutil
+import time
+import warnings
+from typing import Any, Dict, List, Optional
+
+from inference_backends import ONNX_EXPORT_DIR, ONNX_GRAPH_FILENAME, ONNX_OPSET_VERSION, onnx_export_path
+from model_loader_utils import DefaultLogger
+
+try:
+    import fcntl
+except ImportError: # Not on POSIX: exports are not locked, so start one worker first.
+    fcntl = None
+
+
+def export_onnx_text_classifier(model: Any, tokenizer: Any, graph_dir: str, quantize_int8: bool = False, logger: Optional[Any] = None) -> str:
+    """
+    Traces a sequence classification model into `<graph_dir>/model.onnx`. Inputs: the tokenizer's model inputs
+    (input_ids, attention_mask and, for BERT, token_type_ids); output: logits. Batch and sequence lengths are dynamic.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    import torch
+
+    input_names = [name for name in tokenizer.model_input_names if name in ("input_ids", "attention_mask", "token_type_ids")]
+    example = tokenizer(["why was lily scared?", "a longer example sentence for tracing"], padding=True, return_tensors="pt")
+
+    class ClassifierLogits(torch.nn.Module):
+        def __init__(self, classifier: Any):
+            super().__init__()
+            self.classifier = classifier
+
+        def forward(self, *inputs):
+            return self.classifier(**dict(zip(input_names, inputs))).logits
+
+    start = time.time()
+    staging_dir = f"{graph_dir}.tmp{os.getpid()}"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    float_dir = os.path.join(staging_dir, "fp32") if quantize_int8 else staging_dir
+    os.makedirs(float_dir)
+    float_graph_path = os.path.join(float_dir, ONNX_GRAPH_FILENAME)
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        torch.onnx.export(
+            ClassifierLogits(model).eval(), tuple(example[name] for name in input_names), float_graph_path, input_names=input_names, output_names=["logits"],
+            dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in input_names}, "logits": {0: "batch"}}, opset_version=ONNX_OPSET_VERSION, **export_kwargs
+        )
+    if quantize_int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(float_graph_path, os.path.join(staging_dir, ONNX_GRAPH_FILENAME), weight_type=QuantType.QInt8)
+        shutil.rmtree(float_dir)
+    shutil.rmtree(graph_dir, ignore_errors=True)
+    os.replace(staging_dir, graph_dir)
+    logger.info(f"Exported ONNX classifier{' (int8 weights)' if quantize_int8 else ''} to '{graph_dir}' in {time.time() - start:.1f}s.")
+    return os.path.join(graph_dir, ONNX_GRAPH_FILENAME)
+
+def load_onnx_text_classifier(model_name: str, quantize_int8: bool = False, export_dir: str = ONNX_EXPORT_DIR, logger: Optional[Any] = None) -> "OnnxTextClassifier":
+    """
+    The `OnnxTextClassifier` for `model_name`, exporting the graph first if it is not in `export_dir` yet. Concurrent callers
+    serialize on `<graph_dir>.lock`; the first one exports and the others load its graph. Raises on failure.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    from transformers import AutoConfig, AutoTokenizer
+    graph_dir = onnx_export_path(export_dir, model_name, None, quantize_int8)
+    graph_path = os.path.join(graph_dir, ONNX_GRAPH_FILENAME)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    os.makedirs(os.path.dirname(graph_dir) or ".", exist_ok=True)
+    with open(graph_dir + ".lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(graph_path):
+                logger.info(f"No ONNX classifier at '{graph_dir}'. Exporting '{model_name}'...")
+                from transformers import AutoModelForSequenceClassification
+                model = AutoModelForSequenceClassification.from_pretrained(model_name, dtype="float32").eval()
+                export_onnx_text_classifier(model, tokenizer, graph_dir, quantize_int8=quantize_int8, logger=logger)
+                del model
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return OnnxTextClassifier(graph_path, tokenizer, AutoConfig.from_pretrained(model_name), name_or_path=model_name, logger=logger)
+
+
+class OnnxTextClassifier:
+    """Thread-safe; one instance can serve concurrent `check_texts` calls."""
+    def __init__(self, graph_path: str, tokenizer: Any, config: Any, name_or_path: Optional[str] = None, logger: Optional[Any] = None, intra_op_num_threads: int = 0):
+        import onnxruntime
+        self.logger = logger if logger is not None else DefaultLogger()
+        self.tokenizer = tokenizer
+        self.name_or_path = name_or_path or graph_path
+        self.config = config
+        self.labels = [config.id2label[i] for i in range(len(config.id2label))]
+        self.multi_label = config.problem_type == "multi_label_classification" or len(self.labels) == 1
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads # 0 = ONNX Runtime default (all physical cores)
+        self.session = onnxruntime.InferenceSession(graph_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.logger.info(f"ONNX Runtime classifier ready for '{self.name_or_path}' ({graph_path}).")
+
+    def __call__(
+        self, texts: List[str], batch_size: Optional[int] = None, truncation: bool = False, max_length: Optional[int] = None, **kwargs: Any
+    ) -> List[List[Dict[str, Any]]]:
+        import numpy as np
+        batch_size = batch_size or len(texts) or 1
+        outputs: List[List[Dict[str, Any]]] = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=truncation, max_length=max_length, return_tensors="np")
+            logits = self.session.run(["logits"], {name: encoded[name].astype(np.int64) for name in self.input_names})[0].astype(np.float64)
+            if self.multi_label:
+                scores = 1.0 / (1.0 + np.exp(-logits))
+            else:
+                exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+                scores = exp / exp.sum(axis=-1, keepdims=True)
+            for row in scores:
+                outputs.append(sorted(({"label": label, "score": float(score)} for label, score in zip(self.labels, row)), key=lambda item: item["score"], reverse=True))
+        return outputs
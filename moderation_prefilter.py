@@ -0,0 +1,92 @@
+# moderation_prefilter.py
+"""
+Lexical first tier for `ModerationService`.
+
+Some hits are unambiguous and the most common student turns ("can you give me a hint?") are
+plainly harmless, yet both would otherwise pay for a full classifier forward pass.
+`LexicalPrefilter.decide` settles those two cases in microseconds and leaves everything
+else to the model:
+- blocklist: all terms and phrases are compiled into one case-insensitive regular expression
+  with word boundaries (phrases match across any whitespace). A match flags the text as unsafe;
+- allowlist: a text that is, after lower-casing and dropping basic punctuation, exactly one of
+  the allowlisted phrases is safe. Only whole known phrases qualify: harmless words combine into
+  bullying ("go home no one like you"), so a text is never allowed word by word;
+- anything else is ambiguous and `decide` returns None.
+
+Lists can be replaced with files holding one term or phrase per line (`#` starts a comment). Counters
+are in `stats`. Thread-safe (the counters may undercount slightly under contention).
+"""
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+from model_loader_utils import DefaultLogger
+
+PREFILTER_MODEL_NAME = "lexical_prefilter"
+# Texts with other characters (symbols, emoji, other scripts) are never allowlisted: "you ***" goes to the model.
+_PLAIN_TEXT_RE = re.compile(r"[a-z0-9'\s.,!?\"]*")
+_PUNCTUATION_RE = re.compile(r"[.,!?\"]+")
+
+DEFAULT_BLOCKLIST = (
+    "fuck", "fucking", "fucker", "motherfucker", "shit", "bullshit", "bitch", "bitches", "asshole", "bastard", "cunt",
+    "dickhead", "dipshit", "wanker", "twat", "piss off", "kill yourself", "go die", "kys", "i will kill you", "i'm going to kill you",
+)
+DEFAULT_ALLOWLIST = (
+    "ok", "okay", "ok thanks", "okay thanks", "yes", "yes please", "thanks", "thank you", "hi", "hello", "i don't know", "i don't understand",
+    "i don't get it", "can you give me a hint", "give me a hint", "can you help me", "can you explain it again", "can you explain that again",
+    "what does that mean", "what is the story about", "what's the story about", "what is the main idea", "what's the main idea",
+    "what does this word mean", "can we read the next part", "next question", "i'm done", "i think i get it now",
+)
+
+
+def load_terms(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.split("#", 1)[0].strip().lower() for line in f if line.split("#", 1)[0].strip()]
+
+def normalize_phrase(text: str) -> str:
+    """Lower-cased, curly apostrophes straightened, basic punctuation dropped and whitespace collapsed."""
+    return " ".join(_PUNCTUATION_RE.sub(" ", text.lower().replace("’", "'")).split())
+
+def compile_blocklist(terms: Iterable[str]) -> Optional["re.Pattern[str]"]:
+    # Longest first, so a phrase wins over a term it starts with; words of a phrase match across any whitespace.
+    patterns = [r"\s+".join(re.escape(word) for word in term.split()) for term in sorted(set(terms), key=len, reverse=True) if term.strip()]
+    return re.compile(r"(?<![a-z0-9])(?:" + "|".join(patterns) + r")(?![a-z0-9])", re.IGNORECASE) if patterns else None
+
+
+class LexicalPrefilter:
+    def __init__(
+        self,
+        blocklist: Iterable[str] = DEFAULT_BLOCKLIST,
+        allowlist: Iterable[str] = DEFAULT_ALLOWLIST,
+        blocklist_category: str = "toxic",
+        logger: Optional[Any] = None
+    ):
+        self.blocklist_re = compile_blocklist(term.lower() for term in blocklist)
+        self.allowlist = frozenset(normalize_phrase(phrase) for phrase in allowlist)
+        self.blocklist_category = blocklist_category
+        self.logger = logger if logger is not None else DefaultLogger()
+        self.stats: Dict[str, int] = {"checked": 0, "blocked": 0, "allowed": 0, "passed_to_model": 0}
+
+    @classmethod
+    def from_files(cls, blocklist_path: Optional[str] = None, allowlist_path: Optional[str] = None, **kwargs: Any) -> "LexicalPrefilter":
+        """Built-in lists, each replaced by the terms in its file when a path is given."""
+        return cls(
+            blocklist=load_terms(blocklist_path) if blocklist_path else DEFAULT_BLOCKLIST,
+            allowlist=load_terms(allowlist_path) if allowlist_path else DEFAULT_ALLOWLIST, **kwargs
+        )
+
+    def decide(self, text: str) -> Optional[Dict[str, Any]]:
+        """A `check_text`-shaped verdict with `moderation_tier` "lexical", or None when the model has to decide."""
+        self.stats["checked"] += 1
+        matches = self.blocklist_re.findall(text) if self.blocklist_re is not None else []
+        if matches:
+            self.stats["blocked"] += 1
+            return {
+                "is_safe": False, "flagged_categories": [self.blocklist_category], "scores": {}, "model_used": PREFILTER_MODEL_NAME,
+                "moderation_tier": "lexical", "matched_terms": sorted({" ".join(match.lower().split()) for match in matches}),
+            }
+        lowered = text.lower().replace("’", "'")
+        if _PLAIN_TEXT_RE.fullmatch(lowered) and normalize_phrase(lowered) in self.allowlist:
+            self.stats["allowed"] += 1
+            return {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": PREFILTER_MODEL_NAME, "moderation_tier": "lexical"}
+        self.stats["passed_to_model"] += 1
+        return None
@@ -1,32 +1,81 @@
-from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
-from typing import Dict, Any, List, Optional
+import copy
+from typing import Dict, Any, List, Optional, Tuple
+
+from model_loader_utils import QUANTIZED_DTYPE_STRS, quantize_model_dynamic_int8
+from moderation_cache import ModerationResultCache, moderation_cache_key, normalize_moderation_text
+from moderation_prefilter import LexicalPrefilter
+
+MODERATION_BACKENDS = ("hf", "onnx")
 
 class ModerationService:
     """
     A service to check text for toxicity or other undesirable content using a
     Hugging Face text classification pipeline.
+
+    With a `result_cache`, verdicts are reused for texts seen before (see moderation_cache.py).
+    Texts share a cache entry only when the classifier's tokenizer cannot tell them apart.
+    With a `prefilter`, plainly harmless texts and blocklist hits are decided lexically, before
+    the cache and the model (see moderation_prefilter.py). Every result records the deciding
+    tier in "moderation_tier": "lexical" or "model".
+
+    `backend` picks how the classifier runs: "hf" (the PyTorch pipeline) or "onnx" (an ONNX Runtime
+    session over an exported graph, see moderation_onnx.py). With `torch_dtype_str="int8"` its
+    Linear weights are dynamically quantized to int8, by PyTorch or ONNX Runtime respectively.
+    Both options are for CPU; benchmark_moderation_backends.py checks their verdicts against fp32.
+
+    Texts longer than the classifier's input (512 tokens for BERT) are classified in overlapping
+    windows of `window_tokens` tokens (default: as many as the model takes), `window_overlap_tokens`
+    of them shared with the previous window, so the end of a long essay is checked too. The windows
+    of all texts in a `check_texts` call are batched together, each text's in rounds of 1, 1, 2, 4...
+    windows, and a text's remaining windows are skipped once one of them crosses the threshold. Such results carry the
+    highest score per label in "scores" and the per-window scores in "windows".
     """
-    def __init__(self, model_name: str = "unitary/toxic-bert", logger: Optional[Any] = None):
+    def __init__(self, model_name: str = "unitary/toxic-bert", logger: Optional[Any] = None, result_cache: Optional[ModerationResultCache] = None,
+                 prefilter: Optional[LexicalPrefilter] = None, backend: str = "hf", torch_dtype_str: str = "float32",
+                 window_tokens: Optional[int] = None, window_overlap_tokens: int = 64):
         self.logger = logger
         self.model_name = model_name
+        self.backend = backend
+        self.torch_dtype_str = torch_dtype_str
         self.toxicity_threshold = 0.7  # Default threshold
+        self.result_cache = result_cache
+        self.prefilter = prefilter
+        self.cache_lowercase = False
+        self.cache_collapse_whitespace = False
+        self.max_input_tokens: Optional[int] = None # Including special tokens; None = unknown, texts are never windowed.
+        self.window_tokens = 0
+        self.window_overlap_tokens = 0
 
         try:
             if self.logger:
-                self.logger.info(f"ModerationService: Initializing text classification pipeline with model '{self.model_name}'.")
-
-            # Some models, especially multi-label ones, might require explicit tokenizer and model loading
-            # if the default pipeline("text-classification", model=model_name) doesn't handle them well.
-            # For "unitary/toxic-bert", the standard pipeline should work.
-            # return_all_scores=True is important for getting scores for all labels.
-            self.pipeline = pipeline(
-                "text-classification",
-                model=self.model_name,
-                tokenizer=self.model_name, # Explicitly providing tokenizer for clarity
-                return_all_scores=True
-            )
+                self.logger.info(f"ModerationService: Initializing text classification pipeline with model '{self.model_name}' ({self.backend}, {self.torch_dtype_str}).")
+            if self.backend not in MODERATION_BACKENDS:
+                raise ValueError(f"Unknown moderation backend '{self.backend}'. Expected one of {MODERATION_BACKENDS}.")
+            quantize_int8 = self.torch_dtype_str.lower() in QUANTIZED_DTYPE_STRS
+
+            # top_k=None returns the scores of all labels (the older `return_all_scores=True` is gone from
+            # recent transformers releases); with a list input the pipeline, like the ONNX classifier, returns one score
+            # list per text.
+            # transformers is imported here rather than at module level: it takes seconds to import and
+            # the service constructs this class in the background after it has started accepting requests.
+            if self.backend == "onnx":
+                from moderation_onnx import load_onnx_text_classifier
+                self.pipeline = load_onnx_text_classifier(self.model_name, quantize_int8=quantize_int8, logger=self.logger)
+            else:
+                from transformers import pipeline
+                self.pipeline = pipeline(
+                    "text-classification",
+                    model=self.model_name,
+                    tokenizer=self.model_name, # Explicitly providing tokenizer for clarity
+                    top_k=None
+                )
+                if quantize_int8:
+                    quantize_model_dynamic_int8(self.pipeline.model, self.logger)
             if self.logger:
                 self.logger.info(f"ModerationService: Pipeline for '{self.model_name}' initialized successfully.")
+            if self.result_cache is not None:
+                self.cache_lowercase, self.cache_collapse_whitespace = self._tokenizer_invariances()
+            self._configure_windows(window_tokens, window_overlap_tokens)
         except Exception as e:
             if self.logger:
                 self.logger.error(f"ModerationService: Failed to initialize Hugging Face pipeline for model '{self.model_name}'. Error: {e}", exc_info=True)
@@ -43,11 +92,17 @@ class ModerationService:
             - "flagged_categories": List[str] (categories that exceeded the threshold)
             - "scores": Dict[str, float] (all returned labels and their scores)
             - "model_used": str (name of the moderation model)
+            - "moderation_tier": str ("lexical" or "model", whichever decided)
         """
-        is_safe = True
-        flagged_categories: List[str] = []
-        all_scores_dict: Dict[str, float] = {}
+        return self.check_texts([text])[0]
 
+    def check_texts(self, texts: List[str], batch_size: int = 32) -> List[Dict[str, Any]]:
+        """
+        Checks several texts, classifying them in batched pipeline calls of up to `batch_size` texts.
+        Returns one result per text, in order, each the dictionary `check_text` returns for that text.
+        If a batched call fails, its texts are retried one at a time so one bad input cannot fail the others.
+        Long texts are split into windows that share the batches with the other texts (see the class docstring).
+        """
         # Model name to be returned in results, ensuring it reflects the actual model used by the pipeline
         # For pipelines initialized with a model object, pipeline.model.name_or_path might be more accurate.
         # If initialized with model name string, self.model_name is fine.
@@ -55,69 +110,181 @@ class ModerationService:
         if hasattr(self.pipeline, 'model') and hasattr(self.pipeline.model, 'name_or_path'):
             model_identifier = self.pipeline.model.name_or_path
 
-
-        try:
+        results: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+        cache_keys: Dict[int, bytes] = {}
+        duplicates: Dict[int, int] = {} # index -> earlier index with the same cache key, classified once
+        first_index_by_key: Dict[bytes, int] = {}
+        pending: List[int] = []
+        for i, text in enumerate(texts):
             if not text or text.isspace(): # Handle empty or whitespace-only input
                 if self.logger:
                     self.logger.info("ModerationService: Input text is empty or whitespace. Considered safe.")
-                return {
-                    "is_safe": True,
-                    "flagged_categories": [],
-                    "scores": {},
-                    "model_used": model_identifier,
-                    "status": "empty_input"
-                }
-
-            if self.logger:
-                self.logger.info(f"ModerationService: Checking text: '{text[:100]}...'") # Log snippet
-
-            pipeline_output = self.pipeline(text)
-            # The output of pipeline with return_all_scores=True is usually a list of lists of dicts,
-            # e.g., [[{'label': 'toxic', 'score': 0.9}, {'label': 'severe_toxic', 'score': 0.1}, ...]]
-            # We need to process this to get a flat dictionary of scores and check against the threshold.
-
-            if pipeline_output and isinstance(pipeline_output, list) and isinstance(pipeline_output[0], list):
-                scores_list = pipeline_output[0] # Assuming single string input, so take first element
-                for item in scores_list:
-                    label = item.get("label", "unknown_label")
-                    score = item.get("score", 0.0)
-                    all_scores_dict[label] = score
-                    # Check if any of the predefined toxic labels exceed the threshold
-                    # For "unitary/toxic-bert", labels are like 'toxic', 'severe_toxic', 'obscene', etc.
-                    # We can either have a predefined list of "negative" labels or consider any high score as potentially unsafe
-                    # For simplicity, let's assume any category score above threshold makes it "not safe" for now.
-                    # A more nuanced approach might only consider specific labels as "unsafe".
-                    if score > self.toxicity_threshold:
-                        # This logic might need adjustment based on the specific model's labels.
-                        # For toxic-bert, labels like 'toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate' are primary.
-                        # Other models might have 'positive' and 'negative' labels.
-                        # For this example, we'll flag any category that meets the threshold.
-                        is_safe = False
-                        flagged_categories.append(label)
+                results[i] = {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": model_identifier, "moderation_tier": "lexical", "status": "empty_input"}
+                continue
+            if self.prefilter is not None:
+                results[i] = self.prefilter.decide(text)
+                if results[i] is not None:
+                    continue
+            if self.result_cache is not None:
+                cache_keys[i] = self._cache_key(text, model_identifier)
+                if cache_keys[i] in first_index_by_key:
+                    duplicates[i] = first_index_by_key[cache_keys[i]]
+                    continue
+                first_index_by_key[cache_keys[i]] = i
+                results[i] = self.result_cache.get(cache_keys[i])
+            if results[i] is None:
+                pending.append(i)
 
+        # Work items are (text index, window span or None for a text classified whole). Long texts send their windows in
+        # rounds of 1, 1, 2, 4... so an unsafe window skips most of the rest, while later rounds still fill whole batches.
+        window_spans = {i: self._window_spans(texts[i]) for i in pending}
+        windows_by_text: Dict[int, List[Dict[str, Any]]] = {i: [] for i, spans in window_spans.items() if spans}
+        next_window = {i: 0 for i in pending}
+        while True:
+            round_items = []
+            for i in pending:
+                if results[i] is None:
+                    first = next_window[i]
+                    next_window[i] = first + max(1, first)
+                    round_items.extend((i, span) for span in (window_spans[i] or [None])[first:next_window[i]])
+            if not round_items:
+                break
+            for batch_start in range(0, len(round_items), batch_size):
+                batch = [(i, span) for i, span in round_items[batch_start:batch_start + batch_size] if results[i] is None] # Skips texts decided meanwhile.
+                if not batch:
+                    continue
+                batch_texts = [texts[i] if span is None else texts[i][span[0]:span[1]] for i, span in batch]
                 if self.logger:
-                    self.logger.info(f"ModerationService: Scores for '{text[:50]}...': {all_scores_dict}, Is Safe: {is_safe}")
+                    for text in batch_texts:
+                        self.logger.info(f"ModerationService: Checking text: '{text[:100]}...'") # Log snippet
+                for (i, span), scores_list in zip(batch, self._classify(batch_texts)):
+                    if isinstance(scores_list, Exception):
+                        # Default to not safe in case of error
+                        results[i] = {"is_safe": False, "flagged_categories": ["pipeline_error"], "scores": {"error": str(scores_list)}, "model_used": model_identifier, "moderation_tier": "model"}
+                    elif span is None:
+                        results[i] = self._result_from_scores(texts[i], scores_list, model_identifier)
+                    elif results[i] is None:
+                        window_result = self._result_from_scores(texts[i][span[0]:span[1]], scores_list, model_identifier)
+                        windows_by_text[i].append({"start": span[0], "end": span[1], "scores": window_result["scores"]})
+                        if not window_result["is_safe"] or len(windows_by_text[i]) == len(window_spans[i]):
+                            results[i] = self._result_from_windows(texts[i], windows_by_text[i], len(window_spans[i]), model_identifier)
+        for i in pending:
+            if i in cache_keys and "error" not in results[i]["scores"]:
+                self.result_cache.put(cache_keys[i], results[i])
+        for i, first in duplicates.items():
+            results[i] = copy.deepcopy(results[first])
+        return results
 
-            else:
+    def _classify(self, texts: List[str]) -> List[Any]:
+        """
+        One pipeline output (a list of label scores) per text, classified in a single batched call. If that call fails,
+        the texts are retried one at a time, so one bad input cannot fail the others; a text that still fails gets its exception.
+        """
+        try:
+            return list(self.pipeline(texts, batch_size=len(texts), **self._truncation_kwargs()))
+        except Exception as e:
+            if len(texts) > 1:
                 if self.logger:
-                    self.logger.error(f"ModerationService: Unexpected pipeline output format: {pipeline_output}")
-                # Fallback to considering it unsafe if output format is not as expected
-                is_safe = False
-                all_scores_dict = {"error": "unexpected_pipeline_output_format"}
+                    self.logger.warning(f"ModerationService: Batched classification of {len(texts)} texts failed ({e}); retrying them one at a time.")
+                return [self._classify([text])[0] for text in texts]
+            if self.logger:
+                self.logger.error(f"ModerationService: Error during text classification for '{texts[0][:50]}...': {e}", exc_info=True)
+            return [e]
 
+    def _truncation_kwargs(self) -> Dict[str, Any]:
+        # Windows are cut to fit, so truncation only guards against a window retokenizing a few tokens longer
+        # (or, with windows turned off, keeps a long text from failing the whole call).
+        return {"truncation": True, "max_length": self.max_input_tokens} if self.max_input_tokens else {}
 
-        except Exception as e:
+    def _configure_windows(self, window_tokens: Optional[int], window_overlap_tokens: int):
+        tokenizer = getattr(self.pipeline, "tokenizer", None)
+        config = getattr(getattr(self.pipeline, "model", None), "config", None) or getattr(self.pipeline, "config", None)
+        if tokenizer is None or not getattr(tokenizer, "is_fast", False): # Windows are cut at the fast tokenizer's character offsets.
+            if self.logger:
+                self.logger.warning("ModerationService: No fast tokenizer; long texts are classified whole, without windows.")
+            return
+        self.max_input_tokens = min(tokenizer.model_max_length, getattr(config, "max_position_embeddings", None) or tokenizer.model_max_length)
+        model_window_tokens = self.max_input_tokens - tokenizer.num_special_tokens_to_add()
+        self.window_tokens = model_window_tokens if window_tokens is None else max(0, min(window_tokens, model_window_tokens))
+        self.window_overlap_tokens = max(0, min(window_overlap_tokens, self.window_tokens // 2))
+
+    def _window_spans(self, text: str) -> Optional[List[Tuple[int, int]]]:
+        """Character spans of the overlapping windows `text` is classified in, or None when it fits the classifier whole."""
+        if self.window_tokens <= 0 or len(text.encode("utf-8")) <= self.window_tokens: # Every token covers at least one byte.
+            return None
+        offsets = self.pipeline.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        if len(offsets) <= self.window_tokens:
+            return None
+        spans = []
+        for start in range(0, len(offsets), self.window_tokens - self.window_overlap_tokens):
+            end = min(start + self.window_tokens, len(offsets))
+            spans.append((offsets[start][0], offsets[end - 1][1]))
+            if end == len(offsets):
+                break
+        return spans
+
+    def _result_from_windows(self, text: str, windows: List[Dict[str, Any]], windows_total: int, model_identifier: str) -> Dict[str, Any]:
+        max_scores: Dict[str, float] = {}
+        for window in windows:
+            for label, score in window["scores"].items():
+                max_scores[label] = max(score, max_scores.get(label, 0.0))
+        result = self._result_from_scores(text, [{"label": label, "score": score} for label, score in max_scores.items()], model_identifier)
+        result["windows"] = sorted(windows, key=lambda window: window["start"])
+        result["windows_total"] = windows_total
+        result["early_exit"] = len(windows) < windows_total
+        return result
+
+    def _cache_key(self, text: str, model_identifier: str) -> bytes:
+        normalized = normalize_moderation_text(text, lowercase=self.cache_lowercase, collapse_whitespace=self.cache_collapse_whitespace)
+        return moderation_cache_key(model_identifier, self.toxicity_threshold, normalized)
+
+    def _tokenizer_invariances(self) -> Tuple[bool, bool]:
+        """
+        (lowercase, collapse_whitespace): which normalizations leave the classifier's input ids unchanged,
+        so that texts differing only in them can share a cache entry. E.g. both hold for an uncased BERT.
+        """
+        tokenizer = getattr(self.pipeline, "tokenizer", None)
+        if tokenizer is None:
+            return False, False
+        def ids(text: str) -> List[int]:
+            return tokenizer(text)["input_ids"]
+        lowercase = ids("Why Was LILY Scared? I HATE it.") == ids("why was lily scared? i hate it.")
+        collapse_whitespace = ids("  why was\tlily \n\n scared?  ") == ids("why was lily scared?")
+        return lowercase, collapse_whitespace
+
+    def _result_from_scores(self, text: str, scores_list: Any, model_identifier: str) -> Dict[str, Any]:
+        is_safe = True
+        flagged_categories: List[str] = []
+        all_scores_dict: Dict[str, float] = {}
+        # With top_k=None each text's output is a list of dicts, one per label,
+        # e.g., [{'label': 'toxic', 'score': 0.9}, {'label': 'severe_toxic', 'score': 0.1}, ...]
+        if isinstance(scores_list, list) and all(isinstance(item, dict) for item in scores_list):
+            for item in scores_list:
+                label = item.get("label", "unknown_label")
+                score = item.get("score", 0.0)
+                all_scores_dict[label] = score
+                # Any category above the threshold makes the text "not safe". For "unitary/toxic-bert" the
+                # labels are 'toxic', 'severe_toxic', 'obscene', 'threat', 'insult' and 'identity_hate';
+                # models with e.g. 'positive'/'negative' labels would need a list of the unsafe ones.
+                if score > self.toxicity_threshold:
+                    is_safe = False
+                    flagged_categories.append(label)
+
+            if self.logger:
+                self.logger.info(f"ModerationService: Scores for '{text[:50]}...': {all_scores_dict}, Is Safe: {is_safe}")
+        else:
             if self.logger:
-                self.logger.error(f"ModerationService: Error during text classification for '{text[:50]}...': {e}", exc_info=True)
-            is_safe = False # Default to not safe in case of error
-            all_scores_dict = {"error": str(e)}
-            flagged_categories.append("pipeline_error")
+                self.logger.error(f"ModerationService: Unexpected pipeline output format: {scores_list}")
+            # Fallback to considering it unsafe if output format is not as expected
+            is_safe = False
+            all_scores_dict = {"error": "unexpected_pipeline_output_format"}
 
         return {
             "is_safe": is_safe,
             "flagged_categories": flagged_categories,
             "scores": all_scores_dict,
-            "model_used": model_identifier
+            "model_used": model_identifier,
+            "moderation_tier": "model"
         }
 
 if __name__ == '__main__':
@@ -0,0 +1,141 @@
+# moderation_stream.py
+"""
+Incremental output moderation for streamed replies.
+
+A streamed reply used to be moderated only once it was fully generated and decoded, so the
+"done" event waited for one more classifier call over the whole text and an unsafe reply kept
+generating to the end. `StreamingOutputModerator` takes the text deltas as they are streamed and
+checks the reply in chunks while generation goes on:
+- a chunk ends at a sentence end once it holds at least `min_chunk_chars` characters, or at the
+  last space before `max_chunk_chars` when no sentence ends in time;
+- each chunk is checked in the background by `check` (the service's `run_moderation`, so chunks
+  of concurrent streams share classifier batches);
+- text is only released to the client once it has been checked: `take_cleared` returns the text
+  of the chunks that came back safe, in order, and stops at the first chunk still being checked.
+  `cleared` is set whenever a check finishes, so the caller can wait for text to release;
+- the first unsafe chunk is reported to `on_flagged` at once, e.g. to stop generation; it and
+  everything after it is never released;
+- `finish` checks what is left, waits for the pending checks and merges all verdicts into one
+  result shaped like `check_text`'s: unsafe if any chunk is, with the highest score per label and
+  the number of chunks in `chunks`. The text after the released part is the caller's to send once
+  that verdict is safe.
+
+Chunks are classified independently of each other. All methods must be called from the event loop.
+"""
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from model_loader_utils import DefaultLogger
+
+# A sentence end is only certain once the whitespace after it has arrived ("3." may continue as "3.5").
+_SENTENCE_END_RE = re.compile(r"[.!?]+[\"')\]]*(?=\s)")
+
+
+def merge_moderation_results(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """One verdict for a text moderated in parts: unsafe if any part is, highest score per label."""
+    scores: Dict[str, Any] = {}
+    for result in results:
+        for label, score in result.get("scores", {}).items():
+            if isinstance(score, float):
+                scores[label] = max(score, scores.get(label, 0.0))
+    model_results = [result for result in results if result.get("moderation_tier") != "lexical"]
+    return {
+        "is_safe": all(result["is_safe"] for result in results),
+        "flagged_categories": sorted({category for result in results for category in result["flagged_categories"]}),
+        "scores": scores, "model_used": (model_results or results)[0]["model_used"],
+        "moderation_tier": "model" if model_results else "lexical", "chunks": len(results),
+    }
+
+
+class StreamingOutputModerator:
+    def __init__(
+        self,
+        check: Callable[[str], Awaitable[Dict[str, Any]]],
+        max_chunk_chars: int = 200,
+        min_chunk_chars: int = 40,
+        on_flagged: Optional[Callable[[Dict[str, Any]], None]] = None,
+        logger: Optional[Any] = None
+    ):
+        self.check = check
+        self.max_chunk_chars = max(1, max_chunk_chars)
+        self.min_chunk_chars = min(max(0, min_chunk_chars), self.max_chunk_chars)
+        self.on_flagged = on_flagged
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        self.text = "" # Everything pushed so far.
+        self.released_text = "" # What `take_cleared` has handed out: a prefix of `text` made of safe chunks.
+        self.flagged: Optional[Dict[str, Any]] = None # The first unsafe chunk verdict.
+        self.cleared = asyncio.Event() # Set when a check finishes; cleared by the caller before waiting again.
+        self._checked_len = 0 # `text[:_checked_len]` is covered by started checks.
+        self._checks: List["asyncio.Task[Dict[str, Any]]"] = []
+        self._chunk_ends: List[Optional[int]] = [] # End of each check's chunk in `text`; None for checks made by `finish`.
+
+    def push(self, delta: str):
+        """Adds a streamed text delta and starts checks for the chunks it completes."""
+        self.text += delta
+        while True:
+            end = self._next_chunk_end()
+            if end is None:
+                return
+            self._start_check(self.text[self._checked_len:end], end)
+            self._checked_len = end
+
+    def take_cleared(self) -> str:
+        """The text that has passed moderation since the last call: the safe chunks following the released ones, in order."""
+        released_len = len(self.released_text)
+        for task, chunk_end in zip(self._checks, self._chunk_ends):
+            if chunk_end is None or not task.done() or task.cancelled() or task.exception() is not None or not task.result()["is_safe"]:
+                break
+            released_len = max(released_len, chunk_end)
+        cleared = self.text[len(self.released_text):released_len]
+        self.released_text += cleared
+        return cleared
+
+    async def finish(self, final_text: Optional[str] = None) -> Dict[str, Any]:
+        """
+        The merged verdict once the rest of the reply is checked. `final_text` is the fully decoded reply; if it does not
+        extend the streamed text (the detokenizer can settle on different characters), the whole of it is checked again.
+        """
+        checked = self.text[:self._checked_len]
+        if final_text is not None and not final_text.startswith(checked):
+            self.logger.info("Streamed text differs from the decoded reply; moderating the whole reply.")
+            self.cancel()
+            self._checks, self._chunk_ends, checked = [], [], ""
+        rest = (final_text if final_text is not None else self.text)[len(checked):]
+        if self.flagged is None and (rest.strip() or not self._checks): # Once a chunk is flagged, the verdict is settled.
+            self._start_check(rest)
+        self._checked_len = len(self.text)
+        return merge_moderation_results(list(await asyncio.gather(*self._checks)) or [self.flagged])
+
+    def cancel(self):
+        for task in self._checks:
+            task.cancel()
+
+    # --- Internals ---
+    def _next_chunk_end(self) -> Optional[int]:
+        pending_start = self._checked_len
+        for match in _SENTENCE_END_RE.finditer(self.text, pending_start):
+            if match.end() - pending_start >= self.min_chunk_chars:
+                return match.end()
+        if len(self.text) - pending_start < self.max_chunk_chars:
+            return None
+        limit = pending_start + self.max_chunk_chars
+        space = self.text.rfind(" ", pending_start + 1, limit)
+        return space if space > pending_start else limit
+
+    def _start_check(self, chunk: str, chunk_end: Optional[int] = None):
+        task = asyncio.ensure_future(self.check(chunk.strip()))
+        task.add_done_callback(self._on_checked)
+        self._checks.append(task)
+        self._chunk_ends.append(chunk_end)
+
+    def _on_checked(self, task: "asyncio.Task[Dict[str, Any]]"):
+        self.cleared.set()
+        if task.cancelled() or task.exception() is not None: # Failures surface from `finish`.
+            return
+        result = task.result()
+        if not result["is_safe"] and self.flagged is None:
+            self.flagged = result
+            if self.on_flagged is not None:
+                self.on_flagged(result)
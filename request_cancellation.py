@@ -0,0 +1,77 @@
+# request_cancellation.py
+"""
+Cancellation of in-flight generation for the AITA Interaction Service.
+
+A `CancellationToken` is created per turn. It is cancelled explicitly when the client
+disconnects (reason "cancelled") or when incremental output moderation flags the reply being
+streamed (reason "output_unsafe"), and expires on its own once the turn's deadline passes
+(reason "timed_out"). Generation checks it between tokens:
+- `ContinuousBatchingScheduler` retires cancelled jobs from their batch at the next
+  decode step, which frees the slot for a waiting request;
+- `model.generate` stops through the stopping criteria from `cancellation_stopping_criteria`.
+Both then raise / report `GenerationCancelledError` carrying the tokens generated so far.
+
+This module does not import torch at module level, so request handlers can create tokens
+before the inference runtime has finished loading.
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+CANCELLATION_REASONS = ("cancelled", "timed_out", "output_unsafe")
+
+
+class GenerationCancelledError(Exception):
+    def __init__(self, reason: str, generated_ids: Optional[Sequence[int]] = None):
+        super().__init__(f"Generation {reason.replace('_', ' ')}.")
+        self.reason = reason
+        self.generated_ids: List[int] = list(generated_ids or [])
+
+
+class CancellationToken:
+    """Thread-safe; `deadline` is a `time.time()` timestamp (None = no deadline). Only the deadline survives pickling."""
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+
+    @classmethod
+    def with_timeout(cls, timeout_s: Optional[float]) -> "CancellationToken":
+        return cls(deadline=time.time() + timeout_s if timeout_s and timeout_s > 0 else None)
+
+    def cancel(self, reason: str = "cancelled"):
+        if reason not in CANCELLATION_REASONS:
+            raise ValueError(f"Unknown cancellation reason '{reason}'. Expected one of {CANCELLATION_REASONS}.")
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def is_cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None and time.time() >= self.deadline:
+            self.cancel("timed_out")
+        return self._event.is_set()
+
+    def raise_if_cancelled(self, generated_ids: Optional[Sequence[int]] = None):
+        if self.is_cancelled():
+            raise GenerationCancelledError(self.reason, generated_ids)
+
+    def remaining_seconds(self) -> Optional[float]:
+        return None if self.deadline is None else max(0.0, self.deadline - time.time())
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"deadline": self.deadline}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(deadline=state["deadline"])
+
+
+def cancellation_stopping_criteria(token: CancellationToken) -> Any:
+    """A `StoppingCriteriaList` that ends `model.generate` for every row once `token` is cancelled."""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class CancellationStoppingCriteria(StoppingCriteria):
+        def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+            return torch.full((input_ids.shape[0],), token.is_cancelled(), dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([CancellationStoppingCriteria()])
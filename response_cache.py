@@ -0,0 +1,160 @@
+# response_cache.py
+"""
+Semantic response cache for repeated tutoring questions.
+
+Students on the same passage often open with nearly the same question ("what is the
+story about?", "What's the story about"). The AITA Interaction Service can answer those
+from this cache instead of running a full generation.
+
+Entries are grouped by a context key (persona plus the passage / learning-objective
+system prompt). Within a context, the user utterance is normalized (case, punctuation and
+whitespace; arithmetic symbols are kept) and a lookup matches the exact normalized text.
+Entries expire after `ttl_s` seconds and the least recently used ones are dropped beyond
+`max_entries`.
+
+Fuzzy matching is opt-in: with `similarity_threshold` below 1.0, a lookup may also match the
+most similar cached utterance by cosine of character-trigram counts, which tolerates typos.
+Near-identical strings can still be different questions ("is the kitten lost?" / "is the
+kitten not lost?", "chapter 1" / "chapter 2"), so a fuzzy match additionally needs the same
+numbers and the same negations as the cached utterance.
+"""
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from model_loader_utils import DefaultLogger
+
+_NON_WORD_RE = re.compile(r"[^a-z0-9\s+\-*/=<>%]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+_NUMBER_RE = re.compile(r"\d+")
+_NUMBER_WORDS = {
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve", "hundred", "thousand",
+    "first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth", "ninth", "tenth", "last", "half", "twice",
+}
+# Apostrophes are already gone after normalization ("isn't" -> "isnt").
+_NEGATION_WORDS = {
+    "not", "no", "never", "nobody", "nothing", "none", "neither", "nor", "nowhere", "without", "cannot", "cant", "dont", "doesnt",
+    "didnt", "isnt", "arent", "wasnt", "werent", "wont", "wouldnt", "shouldnt", "couldnt", "havent", "hasnt", "hadnt", "aint",
+}
+
+
+def normalize_utterance(text: str) -> str:
+    """Lower-cases, drops punctuation (so "what's" becomes "whats") and collapses whitespace."""
+    return _WHITESPACE_RE.sub(" ", _NON_WORD_RE.sub("", text.lower())).strip()
+
+def meaning_guard(normalized_text: str) -> Tuple[Tuple[str, ...], int]:
+    """What a fuzzy match must not change: the numbers (digits and number words, in order) and the count of negations."""
+    words = normalized_text.split()
+    numbers = tuple(_NUMBER_RE.findall(normalized_text)) + tuple(word for word in words if word in _NUMBER_WORDS)
+    return numbers, sum(word in _NEGATION_WORDS for word in words)
+
+def trigram_vector(normalized_text: str) -> Counter:
+    padded = f"  {normalized_text} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def cosine_similarity(a: Counter, b: Counter) -> float:
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    return dot / (math.sqrt(sum(c * c for c in a.values())) * math.sqrt(sum(c * c for c in b.values())))
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_s: float = 3600.0,
+        similarity_threshold: float = 1.0,
+        max_candidates_per_context: int = 64,
+        logger: Optional[Any] = None
+    ):
+        self.max_entries = max(1, max_entries)
+        self.ttl_s = ttl_s
+        self.similarity_threshold = similarity_threshold
+        self.max_candidates_per_context = max(1, max_candidates_per_context)
+        self.logger = logger if logger is not None else DefaultLogger()
+
+        # (context_key, normalized utterance) -> entry, least recently used first.
+        self._entries: "OrderedDict[Tuple[Hashable, str], Dict[str, Any]]" = OrderedDict()
+        # context_key -> normalized utterances cached for it, with their trigram vector and meaning guard for similarity search.
+        self._by_context: Dict[Hashable, "OrderedDict[str, Tuple[Counter, Tuple[Tuple[str, ...], int]]]"] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+
+    def get(self, context_key: Hashable, utterance: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns {"response", "similarity", "matched_utterance", "age_seconds"} for the best
+        non-expired match in `context_key`, or None.
+        """
+        normalized = normalize_utterance(utterance)
+        if not normalized:
+            return None
+        now = time.time()
+        with self._lock:
+            self.stats["lookups"] += 1
+            key, similarity = (context_key, normalized), 1.0
+            entry = self._live_entry(key, now)
+            exact = entry is not None
+            if not exact and self.similarity_threshold < 1.0:
+                key, similarity = self._most_similar(context_key, normalized, now)
+                entry = self._entries.get(key) if key is not None else None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["exact_hits" if exact else "similar_hits"] += 1
+            return {"response": entry["response"], "similarity": round(similarity, 4), "matched_utterance": entry["utterance"], "age_seconds": round(now - entry["created_at"], 1)}
+
+    def put(self, context_key: Hashable, utterance: str, response: str):
+        normalized = normalize_utterance(utterance)
+        if not normalized or not response:
+            return
+        key = (context_key, normalized)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = {"response": response, "utterance": utterance, "created_at": time.time()}
+            bucket = self._by_context.setdefault(context_key, OrderedDict())
+            bucket[normalized] = (trigram_vector(normalized), meaning_guard(normalized))
+            while len(bucket) > self.max_candidates_per_context:
+                self._drop((context_key, next(iter(bucket))))
+                self.stats["evictions"] += 1
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.stats["exact_hits"] + self.stats["similar_hits"]
+            return {"entries": len(self._entries), "contexts": len(self._by_context), "hit_rate": hits / self.stats["lookups"] if self.stats["lookups"] else 0.0, **self.stats}
+
+    # --- Internals (caller holds the lock) ---
+    def _live_entry(self, key: Tuple[Hashable, str], now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None and now - entry["created_at"] > self.ttl_s:
+            self._drop(key)
+            self.stats["expired"] += 1
+            return None
+        return entry
+
+    def _most_similar(self, context_key: Hashable, normalized: str, now: float) -> Tuple[Optional[Tuple[Hashable, str]], float]:
+        query, guard = trigram_vector(normalized), meaning_guard(normalized)
+        best_key, best_similarity = None, 0.0
+        for candidate, (vector, candidate_guard) in list(self._by_context.get(context_key, {}).items()):
+            if candidate_guard != guard:
+                continue
+            similarity = cosine_similarity(query, vector)
+            if similarity >= self.similarity_threshold and similarity > best_similarity and self._live_entry((context_key, candidate), now) is not None:
+                best_key, best_similarity = (context_key, candidate), similarity
+        return best_key, best_similarity
+
+    def _drop(self, key: Tuple[Hashable, str]):
+        self._entries.pop(key, None)
+        bucket = self._by_context.get(key[0])
+        if bucket is not None:
+            bucket.pop(key[1], None)
+            if not bucket:
+                del self._by_context[key[0]]
@@ -0,0 +1,96 @@
+# service_metrics.py
+"""
+Prometheus metrics for the AITA Interaction Service, served by `GET /metrics` via `prometheus_client`.
+
+Two kinds of metrics are kept in the service's own `CollectorRegistry`:
+- instruments updated by request handlers: `prometheus_client.Counter` and `Histogram` (with
+  labels), e.g. per-stage latency histograms fed from each turn's `StageTimer`;
+- a `ComponentCollector`, run at scrape time, that turns existing `stats` / `snapshot()` dicts
+  (admission queue, caches, model registry, schedulers) into gauge and counter families, so
+  those components need no changes.
+
+Components that can be dropped while the service runs (an evicted model's scheduler and its
+prefix cache) hand their counters to `RetiredTotals`, so summed counters never go backwards.
+Values are per process: with `uvicorn --workers N` each worker reports its own.
+"""
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+# Stage and turn latencies, from sub-millisecond lookups to a full CPU generation.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+DEFAULT_GAUGE_KEYS = ("bytes_in_use", "entries", "sessions")
+
+# (metric name, "gauge" | "counter", help, [(labels, value)]) as returned by `stats_families`.
+MetricFamily = Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]
+
+
+class ComponentCollector(Collector):
+    """Runs `collect_families()` on every scrape and yields its (name, type, help, samples) families."""
+    def __init__(self, collect_families: Callable[[], Iterable[MetricFamily]]):
+        self.collect_families = collect_families
+
+    def collect(self) -> Iterator[Any]:
+        # Several components may report the same family (e.g. one per cache); each family is yielded once.
+        families: Dict[str, Tuple[str, str, List[Tuple[Dict[str, Any], float]]]] = {}
+        for name, metric_type, help_text, samples in self.collect_families():
+            families.setdefault(name, (metric_type, help_text, []))[2].extend(samples)
+        for name, (metric_type, help_text, samples) in families.items():
+            label_names = sorted({key for labels, _ in samples for key in labels})
+            family_class = CounterMetricFamily if metric_type == "counter" else GaugeMetricFamily
+            family = family_class(name, help_text, labels=label_names)
+            for labels, value in samples:
+                family.add_metric([str(labels.get(key, "")) for key in label_names], value)
+            yield family
+
+
+def counter_values(snapshot: Dict[str, Any]) -> Dict[str, float]:
+    # Ratios (`hit_rate`) and high-water marks (`max_*`) are not summable.
+    return {
+        key: value for key, value in snapshot.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "hit_rate" and not key.startswith("max_")
+    }
+
+def stats_families(prefix: str, labels: Dict[str, str], snapshots: Iterable[Dict[str, Any]], gauge_keys: Sequence[str] = DEFAULT_GAUGE_KEYS) -> List[MetricFamily]:
+    """
+    Converts component `stats` snapshots into families: each numeric key in `gauge_keys` becomes the gauge
+    `<prefix>_<key>`, every other number the counter `<prefix>_events_total{event="<key>"}`. Snapshots are
+    summed (e.g. the prefix caches of all schedulers); ratios (`hit_rate`) and high-water marks (`max_*`) are skipped.
+    """
+    totals: Dict[str, float] = {}
+    for snapshot in snapshots:
+        for key, value in counter_values(snapshot).items():
+            totals[key] = totals.get(key, 0) + value
+    families: List[MetricFamily] = [
+        (f"{prefix}_{key}", "gauge", f"Current {key.replace('_', ' ')}.", [(dict(labels), totals[key])])
+        for key in gauge_keys if key in totals
+    ]
+    events = [({**labels, "event": key}, value) for key, value in sorted(totals.items()) if key not in gauge_keys]
+    if events:
+        families.append((f"{prefix}_events_total", "counter", "Cumulative event counts.", events))
+    return families
+
+
+class RetiredTotals:
+    """
+    Counters of components that are gone (e.g. the scheduler of an evicted model), per source.
+    `snapshot(source)` is passed to `stats_families` next to the live snapshots so the summed
+    counters stay monotonic; gauges are not kept. Thread-safe.
+    """
+    def __init__(self):
+        self._totals: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def retire(self, source: str, snapshot: Dict[str, Any], gauge_keys: Sequence[str] = DEFAULT_GAUGE_KEYS):
+        with self._lock:
+            totals = self._totals.setdefault(source, {})
+            for key, value in counter_values(snapshot).items():
+                if key not in gauge_keys:
+                    totals[key] = totals.get(key, 0) + value
+
+    def snapshot(self, source: str) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._totals.get(source, {}))
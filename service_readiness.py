@@ -0,0 +1,114 @@
+# service_readiness.py
+"""
+Startup readiness tracking for the AITA Interaction Service.
+
+The service no longer blocks startup on loading its models. Each heavy component
+(inference runtime imports, the moderation model, the default persona model) is loaded
+by a background task registered here, so the HTTP server accepts connections at once
+and the components load concurrently. `/ready` reports each component's state:
+
+- "pending":  registered, not started yet;
+- "loading":  its loader is running;
+- "ready":    loaded;
+- "degraded": loaded a fallback (e.g. the dummy moderation service or DummySLM);
+- "failed":   the loader raised.
+
+Request handlers that need a component await `wait(name)` instead of failing while it
+is still loading.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from model_loader_utils import DefaultLogger
+
+COMPONENT_STATES = ("pending", "loading", "ready", "degraded", "failed")
+SERVING_STATES = ("ready", "degraded")
+
+
+class ReadinessTracker:
+    def __init__(self, components: Iterable[str] = (), logger: Optional[Any] = None):
+        self.logger = logger if logger is not None else DefaultLogger()
+        self.created_at = time.time()
+        self._components: Dict[str, Dict[str, Any]] = {}
+        self._done_events: Dict[str, asyncio.Event] = {}
+        self._tasks: Dict[str, "asyncio.Task[Any]"] = {}
+        for name in components:
+            self.register(name)
+
+    def register(self, name: str):
+        self._components.setdefault(name, {"state": "pending", "detail": None, "started_at": None, "finished_at": None})
+
+    def start(self, name: str, loader: Callable[[], Awaitable[Optional[str]]], after: Iterable[str] = ()) -> "asyncio.Task[Any]":
+        """
+        Runs `loader()` as a background task once the components in `after` are done.
+        The loader may return "degraded" (or another state) to override the default "ready".
+        """
+        self.register(name)
+        self._event(name)
+        dependencies = list(after)
+
+        async def run():
+            for dependency in dependencies:
+                await self.wait(dependency)
+            self.mark(name, "loading")
+            try:
+                state = await loader()
+            except Exception as e:
+                self.logger.error(f"Readiness: component '{name}' failed to load: {e}", exc_info=True)
+                self.mark(name, "failed", detail=str(e))
+                return
+            self.mark(name, state or "ready")
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._tasks[name] = task
+        return task
+
+    def mark(self, name: str, state: str, detail: Optional[str] = None):
+        if state not in COMPONENT_STATES:
+            raise ValueError(f"Unknown component state '{state}'. Expected one of {COMPONENT_STATES}.")
+        self.register(name)
+        component = self._components[name]
+        component["state"] = state
+        if detail is not None:
+            component["detail"] = detail
+        now = time.time()
+        if state == "loading":
+            component["started_at"] = now
+        elif state != "pending":
+            component["finished_at"] = now
+            self._event(name).set()
+            self.logger.info(f"Readiness: component '{name}' is {state} ({now - self.created_at:.2f}s after startup).")
+
+    async def wait(self, name: str, timeout: Optional[float] = None) -> str:
+        """Waits until `name` has finished loading (in any final state) and returns that state. Unknown components count as ready."""
+        if name not in self._components:
+            return "ready"
+        if self._components[name]["state"] in ("pending", "loading"):
+            await asyncio.wait_for(self._event(name).wait(), timeout)
+        return self._components[name]["state"]
+
+    def is_ready(self) -> bool:
+        return all(component["state"] in SERVING_STATES for component in self._components.values())
+
+    def snapshot(self) -> Dict[str, Any]:
+        components = {}
+        for name, component in self._components.items():
+            started, finished = component["started_at"], component["finished_at"]
+            components[name] = {
+                "state": component["state"], "detail": component["detail"],
+                "load_seconds": round(finished - started, 3) if started and finished else None,
+                "ready_after_startup_seconds": round(finished - self.created_at, 3) if finished else None,
+            }
+        return {"ready": self.is_ready(), "uptime_seconds": round(time.time() - self.created_at, 3), "components": components}
+
+    async def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _event(self, name: str) -> asyncio.Event:
+        # Created lazily so the event binds to the running event loop.
+        if name not in self._done_events:
+            self._done_events[name] = asyncio.Event()
+        return self._done_events[name]
@@ -0,0 +1,178 @@
+# service_storage.py
+"""
+Storage layer for the AITA Interaction Service's user profiles and (simulated) LMS activity contexts.
+
+Both stores keep the indexes the request paths need, so every operation is O(1) however many
+students are registered:
+- `UserStore`: profiles by `user_id`, plus a unique index on `username` for registration;
+- `LMSContextStore`: contexts by `<user_id>_<subject>_<item_id>`, plus a per-user index whose first
+  entry is the user's default context (used when a request names no subject/item).
+
+Each store has an in-memory implementation and a SQLite one (`db_path`), so profiles survive
+service restarts. SQLite needs no extra dependency. Both tables live in the same database file and
+use primary-key / indexed lookups. Each SQLite store has its own connection, used under that store's
+lock; WAL mode lets the two connections read while the other writes. Records are plain dicts; the service turns profiles into its
+pydantic models.
+"""
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from model_loader_utils import DefaultLogger
+
+USER_PROFILE_FIELDS = ("user_id", "username", "grade_level", "preferred_aita_persona_id", "created_at")
+
+
+class UsernameTakenError(ValueError):
+    pass
+
+
+def context_key(user_id: str, subject: str, item_id: str) -> str:
+    return f"{user_id}_{subject}_{item_id}"
+
+def open_sqlite(db_path: str) -> sqlite3.Connection:
+    # One connection per store, shared by the service's threads and serialized by that store's lock. A connection must
+    # not be shared between stores: their locks are independent, so their transactions could interleave on it.
+    connection = sqlite3.connect(db_path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+# --- User profiles ---
+class UserStore:
+    """In-memory profiles with a username index. `add` is atomic: a taken username raises `UsernameTakenError`."""
+    def __init__(self, logger: Optional[Any] = None):
+        self.logger = logger if logger is not None else DefaultLogger()
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, Dict[str, Any]] = {}
+        self._user_ids_by_username: Dict[str, str] = {}
+
+    def add(self, profile: Dict[str, Any]):
+        with self._lock:
+            if profile["username"] in self._user_ids_by_username:
+                raise UsernameTakenError(f"Username '{profile['username']}' already exists.")
+            self._profiles[profile["user_id"]] = dict(profile)
+            self._user_ids_by_username[profile["username"]] = profile["user_id"]
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        profile = self._profiles.get(user_id)
+        return dict(profile) if profile else None
+
+    def get_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        user_id = self._user_ids_by_username.get(username)
+        return self.get(user_id) if user_id else None
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+class SQLiteUserStore(UserStore):
+    """`UserStore` persisted in a SQLite table with a UNIQUE username index."""
+    def __init__(self, db_path: str, logger: Optional[Any] = None):
+        super().__init__(logger)
+        self.db_path = db_path
+        self._db = open_sqlite(db_path)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS user_profiles (user_id TEXT PRIMARY KEY, username TEXT NOT NULL UNIQUE, "
+                "grade_level INTEGER, preferred_aita_persona_id TEXT, created_at TEXT NOT NULL)"
+            )
+        self.logger.info(f"UserStore: {len(self)} profile(s) in SQLite database '{db_path}'.")
+
+    def add(self, profile: Dict[str, Any]):
+        created_at = profile["created_at"]
+        row = tuple(created_at.isoformat() if field == "created_at" and isinstance(created_at, datetime) else profile.get(field) for field in USER_PROFILE_FIELDS)
+        try:
+            with self._lock, self._db:
+                self._db.execute(f"INSERT INTO user_profiles ({', '.join(USER_PROFILE_FIELDS)}) VALUES (?, ?, ?, ?, ?)", row)
+        except sqlite3.IntegrityError:
+            raise UsernameTakenError(f"Username '{profile['username']}' already exists.")
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._fetch_one("user_id", user_id)
+
+    def get_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        return self._fetch_one("username", username)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM user_profiles").fetchone()[0]
+
+    def _fetch_one(self, column: str, value: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(USER_PROFILE_FIELDS)} FROM user_profiles WHERE {column} = ?", (value,)).fetchone()
+        if row is None:
+            return None
+        profile = dict(zip(USER_PROFILE_FIELDS, row))
+        profile["created_at"] = datetime.fromisoformat(profile["created_at"])
+        return profile
+
+
+# --- LMS activity contexts ---
+class LMSContextStore:
+    """In-memory contexts keyed by (user, subject, item), with a per-user index for default-context lookups."""
+    def __init__(self, logger: Optional[Any] = None):
+        self.logger = logger if logger is not None else DefaultLogger()
+        self._lock = threading.Lock()
+        self._contexts: Dict[str, Dict[str, Any]] = {}
+        self._keys_by_user: Dict[str, List[str]] = {}
+
+    def put(self, user_id: str, subject: str, item_id: str, context: Dict[str, Any]):
+        key = context_key(user_id, subject, item_id)
+        with self._lock:
+            if key not in self._contexts:
+                self._keys_by_user.setdefault(user_id, []).append(key)
+            self._contexts[key] = context
+
+    def get(self, user_id: str, subject: str, item_id: str) -> Optional[Dict[str, Any]]:
+        return self._contexts.get(context_key(user_id, subject, item_id))
+
+    def get_default(self, user_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """(key, context) of the user's first stored context, or None."""
+        keys = self._keys_by_user.get(user_id)
+        return (keys[0], self._contexts[keys[0]]) if keys else None
+
+    def load(self, contexts: Iterable[Tuple[str, str, str, Dict[str, Any]]]):
+        """Bulk `put` of (user_id, subject, item_id, context) tuples."""
+        for user_id, subject, item_id, context in contexts:
+            self.put(user_id, subject, item_id, context)
+
+class SQLiteLMSContextStore(LMSContextStore):
+    """`LMSContextStore` persisted in SQLite, indexed by user in insertion order."""
+    def __init__(self, db_path: str, logger: Optional[Any] = None):
+        super().__init__(logger)
+        self.db_path = db_path
+        self._db = open_sqlite(db_path)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS lms_contexts (seq INTEGER PRIMARY KEY AUTOINCREMENT, context_key TEXT NOT NULL UNIQUE, "
+                "user_id TEXT NOT NULL, context_json TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS lms_contexts_by_user ON lms_contexts (user_id, seq)")
+
+    def put(self, user_id: str, subject: str, item_id: str, context: Dict[str, Any]):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO lms_contexts (context_key, user_id, context_json) VALUES (?, ?, ?) "
+                "ON CONFLICT(context_key) DO UPDATE SET context_json = excluded.context_json",
+                (context_key(user_id, subject, item_id), user_id, json.dumps(context))
+            )
+
+    def get(self, user_id: str, subject: str, item_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT context_json FROM lms_contexts WHERE context_key = ?", (context_key(user_id, subject, item_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_default(self, user_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            row = self._db.execute("SELECT context_key, context_json FROM lms_contexts WHERE user_id = ? ORDER BY seq LIMIT 1", (user_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+
+def create_stores(db_path: Optional[str] = None, logger: Optional[Any] = None) -> Tuple[UserStore, LMSContextStore]:
+    """In-memory stores, or SQLite-backed ones in `db_path`, each with its own connection."""
+    if not db_path:
+        return UserStore(logger), LMSContextStore(logger)
+    return SQLiteUserStore(db_path, logger), SQLiteLMSContextStore(db_path, logger)
@@ -0,0 +1,125 @@
+# shared_weights.py
+"""
+Memory-mapped base-model weights shared by several worker processes.
+
+Without this, each uvicorn worker (`--workers N`) and each "process" executor worker loads
+its own copy of the persona base model. With a shared weights directory:
+
+1. The first worker to load a (model id, dtype) pair exports the loaded base weights, in
+   the dtype they are served in, as safetensors into `<shared_weights_dir>/<model>--<dtype>/`.
+   A lock file ensures only one worker writes; the others wait for it and then reuse the export.
+2. Every worker maps those files read-only (`safetensors.safe_open`, which mmaps) and points
+   the model's parameters at the mapped tensors. Its private copy is then freed.
+
+All workers' weights are then backed by the same page-cache pages, so N workers share one
+physical copy. Put the directory on tmpfs (e.g. `/dev/shm/aita_weights`) to keep it in
+shared memory instead of on disk.
+
+The mapped tensors must not be modified in place. Inference does not do that, but merging
+LoRA weights into the base (`merge_and_unload`) or dynamic int8 quantization would. The
+loader therefore only shares weights for unquantized CPU models and leaves adapters
+(small, per persona) private.
+"""
+import glob
+import os
+import re
+import shutil
+import time
+from typing import Any, Dict, Optional
+
+from model_loader_utils import DefaultLogger
+
+try:
+    import fcntl
+except ImportError: # Not on POSIX: exports are not locked, so start one worker first.
+    fcntl = None
+
+EXPORT_COMPLETE_MARKER = "export_complete.json"
+
+
+def shared_weights_path(shared_weights_dir: str, model_id: str, dtype_str: str) -> str:
+    """Export directory for one base model in one dtype."""
+    safe_model_id = re.sub(r"[^A-Za-z0-9_.-]+", "--", model_id.strip("/"))
+    return os.path.join(shared_weights_dir, f"{safe_model_id}--{dtype_str.lower()}")
+
+def is_exported(export_dir: str) -> bool:
+    return os.path.exists(os.path.join(export_dir, EXPORT_COMPLETE_MARKER))
+
+def export_shared_weights(model: Any, export_dir: str, logger: Optional[Any] = None) -> bool:
+    """
+    Saves `model`'s weights as safetensors into `export_dir` unless another worker already has.
+    Concurrent callers serialize on `<export_dir>.lock`. Returns True if this call wrote the export.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    os.makedirs(os.path.dirname(export_dir) or ".", exist_ok=True)
+    with open(export_dir + ".lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if is_exported(export_dir):
+                return False
+            start = time.time()
+            staging_dir = f"{export_dir}.tmp{os.getpid()}"
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            model.save_pretrained(staging_dir, safe_serialization=True)
+            with open(os.path.join(staging_dir, EXPORT_COMPLETE_MARKER), "w") as f:
+                f.write('{"exported_by_pid": %d, "exported_at": %f}\n' % (os.getpid(), time.time()))
+            shutil.rmtree(export_dir, ignore_errors=True)
+            os.replace(staging_dir, export_dir)
+            logger.info(f"Exported shared weights to '{export_dir}' in {time.time() - start:.1f}s.")
+            return True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def map_shared_weights(export_dir: str) -> Dict[str, Any]:
+    """Memory-maps every safetensors file in `export_dir` (no copy) and returns name -> CPU tensor."""
+    from safetensors import safe_open
+    tensors: Dict[str, Any] = {}
+    for path in sorted(glob.glob(os.path.join(export_dir, "*.safetensors"))):
+        with safe_open(path, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                tensors[name] = f.get_tensor(name)
+    return tensors
+
+def attach_shared_weights(model: Any, tensors: Dict[str, Any], logger: Optional[Any] = None) -> int:
+    """
+    Points every parameter and buffer of `model` that has a mapped tensor of the same name, shape
+    and dtype at that tensor, releasing the model's own copy. Tied weights are attached once.
+    Non-persistent buffers (e.g. rotary embedding tables) are not exported and stay private.
+    Returns the number of bytes now backed by the mapping.
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    shared_bytes, skipped = 0, []
+    for is_parameter, named_tensors in ((True, model.named_parameters()), (False, model.named_buffers())):
+        for name, tensor in named_tensors:
+            mapped = tensors.get(name)
+            if mapped is None or mapped.shape != tensor.shape or mapped.dtype != tensor.dtype:
+                if is_parameter:
+                    skipped.append(name)
+                continue
+            tensor.data = mapped
+            shared_bytes += mapped.numel() * mapped.element_size()
+    if skipped:
+        logger.warning(f"{len(skipped)} parameter(s) have no matching shared weight and stay private to this process, e.g. {skipped[:3]}.")
+    return shared_bytes
+
+def load_shared_base_weights(model: Any, model_id: str, dtype_str: str, shared_weights_dir: str, logger: Optional[Any] = None) -> int:
+    """
+    Exports `model` (a freshly loaded base model, before adapters) on first use, then swaps its
+    weights for the shared memory-mapped copy. Returns the shared byte count (0 on failure; the
+    model then keeps its private weights).
+    """
+    if logger is None:
+        logger = DefaultLogger()
+    export_dir = shared_weights_path(shared_weights_dir, model_id, dtype_str)
+    try:
+        export_shared_weights(model, export_dir, logger)
+        shared_bytes = attach_shared_weights(model, map_shared_weights(export_dir), logger)
+    except Exception as e:
+        logger.error(f"Could not share weights through '{export_dir}': {e}. Keeping this process's own copy.", exc_info=True)
+        return 0
+    logger.info(f"Base model '{model_id}' uses {shared_bytes / 2**20:.1f} MB of memory-mapped shared weights from '{export_dir}'.")
+    return shared_bytes
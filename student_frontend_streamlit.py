@@ -3,9 +3,13 @@ import streamlit as st
 from typing import List, Dict, Any, Optional
 import requests # Added for API calls
 import uuid # Added for potential client-side session init if needed
+import json
 
 # --- Configuration ---
 AITA_SERVICE_URL = "http://localhost:8000" # URL of the FastAPI backend service
+MAX_HISTORY_TURNS = 3
+# Seconds to wait for the connection and between streamed chunks (not for the whole reply).
+STREAM_READ_TIMEOUT = 60
 
 # --- Session State Initialization ---
 if "messages" not in st.session_state:
@@ -106,16 +110,29 @@ def run_student_frontend_v2():
             # "current_item_id": "passage_kitten_001" # Example
         }
 
-        # Display AITA "thinking" animation and call backend
+        # Call the streaming backend endpoint and render tokens as they arrive
         with st.chat_message("assistant"):
+            response_placeholder = st.empty()
             with st.spinner("AITA is thinking..."):
                 try:
-                    response = requests.post(f"{AITA_SERVICE_URL}/interact", json=payload, timeout=60) # Increased timeout
-                    response.raise_for_status()
-                    response_data = response.json()
-
-                    assistant_response = response_data.get("aita_response", "Sorry, I encountered an issue processing your request.")
-                    st.session_state.session_id = response_data.get("session_id") # Update/set session_id from backend
+                    assistant_response = "Sorry, I encountered an issue processing your request."
+                    streamed_text = ""
+                    with requests.post(f"{AITA_SERVICE_URL}/interact/stream", json=payload, stream=True, timeout=STREAM_READ_TIMEOUT) as response:
+                        response.raise_for_status()
+                        for line in response.iter_lines(decode_unicode=True):
+                            if not line or not line.startswith("data: "):
+                                continue
+                            event = json.loads(line[len("data: "):])
+                            if event.get("type") == "token":
+                                streamed_text += event.get("text", "")
+                                response_placeholder.markdown(streamed_text + "▌")
+                            elif event.get("type") == "done":
+                                # The final event carries the moderated reply, which may replace the streamed text.
+                                assistant_response = event.get("aita_response", streamed_text)
+                                st.session_state.session_id = event.get("session_id") # Update/set session_id from backend
+                            elif event.get("type") == "error":
+                                assistant_response = f"Error from AITA service: {event.get('status_code')} - {event.get('detail')}"
+                                st.error(assistant_response)
 
                 except requests.exceptions.Timeout:
                     assistant_response = "Error: The AITA service timed out. Please try again."
@@ -138,7 +155,7 @@ def run_student_frontend_v2():
                     assistant_response = f"An unexpected error occurred: {e}"
                     st.error(assistant_response)
 
-            st.markdown(assistant_response) # Display AITA's response
+            response_placeholder.markdown(assistant_response) # Display AITA's final response
 
         st.session_state.messages.append({"role": "assistant", "content": assistant_response})
         # No explicit st.rerun() needed here as st.chat_input and widget interactions trigger it.
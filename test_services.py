@@ -7,6 +7,36 @@ import sys
 import os
 from pathlib import Path
 
+def _tiny_llama(seed=0, **config_overrides):
+    """A randomly initialised two-layer Llama small enough for CPU tests; it never emits EOS, so replies run to max_new_tokens."""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    config = {"vocab_size": 64, "hidden_size": 32, "intermediate_size": 64, "num_hidden_layers": 2, "num_attention_heads": 4, "num_key_value_heads": 2, "max_position_embeddings": 256}
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(LlamaConfig(**{**config, **config_overrides})).eval()
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = 0
+    return model
+
+def _tiny_tokenizer():
+    """A whitespace word-level tokenizer over the tiny Llama's 64-token vocabulary ("w3" ... "w63")."""
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {"<pad>": 0, "<unk>": 1, "</s>": 2, **{f"w{i}": i for i in range(3, 64)}}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="<pad>", unk_token="<unk>", eos_token="</s>")
+
+def _tiny_llama_scheduler(model=None, **overrides):
+    """(model, greedy CPU ContinuousBatchingScheduler) for `model` (default: `_tiny_llama()`); `overrides` go to the scheduler."""
+    import torch
+    from generation_scheduler import ContinuousBatchingScheduler
+
+    model = model if model is not None else _tiny_llama()
+    return model, ContinuousBatchingScheduler(model, tokenizer=None, device=torch.device("cpu"), **{"max_batch_size": 4, "do_sample": False, **overrides})
+
 def test_fastapi_service():
     """Test if the FastAPI service can initialize"""
     print("🔄 Testing FastAPI service initialization...")
@@ -68,6 +98,930 @@ def test_model_utilities():
         print(f"❌ Model utilities failed: {e}")
         return False
 
+def test_generation_scheduler():
+    """Test that the generation scheduler serves queued requests"""
+    print("🔄 Testing generation scheduler...")
+    try:
+        import torch
+        from model_loader_utils import DummySLM
+        from generation_scheduler import ContinuousBatchingScheduler
+
+        device = torch.device("cpu")
+        scheduler = ContinuousBatchingScheduler(DummySLM(device=device, tokenizer=None), tokenizer=None, device=device, max_batch_size=4)
+        futures = [scheduler.submit([1, 2, 3], max_new_tokens=10) for _ in range(3)]
+        results = [future.result(timeout=10) for future in futures]
+        scheduler.shutdown()
+        print(f"✅ Generation scheduler completed {len(results)} queued requests: {results}")
+        return len(results) == 3 and all(len(result) == 1 for result in results)
+    except Exception as e:
+        print(f"❌ Generation scheduler failed: {e}")
+        return False
+
+def test_batched_generation_matches_generate():
+    """Test that batched prefill, merge and decode of a real model give the same greedy tokens as model.generate"""
+    print("🔄 Testing batched generation against model.generate...")
+    try:
+        import torch
+
+        model, scheduler = _tiny_llama_scheduler()
+        prompts = [[5, 9, 11, 3, 7, 21, 8], [14, 2], [30, 31, 32, 33]] # Different lengths, so merged rows are left-padded.
+        with torch.no_grad():
+            expected = [model.generate(torch.tensor([prompt]), max_new_tokens=8, do_sample=False)[0, len(prompt):].tolist() for prompt in prompts]
+        futures = [scheduler.submit(prompt, max_new_tokens=8) for prompt in prompts]
+        results = [future.result(timeout=30) for future in futures]
+        scheduler.shutdown()
+        print(f"✅ Batched greedy output matches generate: {results == expected} (largest batch: {scheduler.stats['max_observed_batch']})")
+        return results == expected and scheduler.stats["max_observed_batch"] > 1
+    except Exception as e:
+        print(f"❌ Batched generation failed: {e}")
+        return False
+
+def test_multi_adapter_scheduling():
+    """Test that per-adapter lanes give each LoRA adapter its solo greedy output, never mix adapters in a step, and run adapter-less personas on the base"""
+    print("🔄 Testing multi-adapter scheduling...")
+    try:
+        import contextlib
+        import torch
+        from peft import LoraConfig, get_peft_model
+
+        lora = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj"], init_lora_weights=False) # Random weights, so adapters change the output.
+        torch.manual_seed(1)
+        model = get_peft_model(_tiny_llama(), lora, adapter_name="reading")
+        model.add_adapter("ecology", lora)
+        model.eval()
+        prompt = [5, 9, 11, 3, 7, 21, 8]
+        jobs = [("reading", prompt), ("ecology", prompt), (None, prompt), ("reading", [14, 2]), ("ecology", [30, 31, 32, 33]), (None, [40, 41])]
+
+        def solo(adapter_name, prompt_ids):
+            with torch.no_grad(), (model.disable_adapter() if adapter_name is None else contextlib.nullcontext()):
+                if adapter_name is not None:
+                    model.set_adapter(adapter_name)
+                return model.generate(input_ids=torch.tensor([prompt_ids]), max_new_tokens=8, do_sample=False)[0, len(prompt_ids):].tolist()
+        expected = [solo(adapter_name, prompt_ids) for adapter_name, prompt_ids in jobs]
+
+        _, scheduler = _tiny_llama_scheduler(model, max_batch_size=8, adapter_switching=True)
+        step_adapters, base_forwards = [], []
+        decode_step, disable_adapter = scheduler._decode_step, model.disable_adapter
+        def recording_decode_step(lane):
+            step_adapters.append((lane.adapter_name, {job.adapter_name for job in lane.active}))
+            return decode_step(lane)
+        def recording_disable_adapter():
+            base_forwards.append(True)
+            return disable_adapter()
+        scheduler._decode_step, model.disable_adapter = recording_decode_step, recording_disable_adapter
+        futures = [scheduler.submit(prompt_ids, max_new_tokens=8, adapter_name=adapter_name) for adapter_name, prompt_ids in jobs]
+        results = [future.result(timeout=30) for future in futures]
+        scheduler.shutdown()
+        del model.disable_adapter
+
+        mixed_steps = [step for step in step_adapters if step[1] != {step[0]}]
+        adapters_differ = len({tuple(reply) for reply in expected[:3]}) == 3
+        print(f"✅ Matches solo generate per adapter: {results == expected}; adapters give different replies: {adapters_differ}; "
+              f"mixed decode steps: {len(mixed_steps)} of {len(step_adapters)}; base-model forwards: {len(base_forwards)}")
+        return results == expected and adapters_differ and bool(step_adapters) and not mixed_steps and bool(base_forwards)
+    except Exception as e:
+        print(f"❌ Multi-adapter scheduling failed: {e}")
+        return False
+
+def test_prefix_kv_cache():
+    """Test that a reply generated from a cached system-prompt prefix matches one generated without the cache"""
+    print("🔄 Testing prefix KV cache reuse...")
+    try:
+        from kv_cache import PrefixKVCache
+
+        model = _tiny_llama()
+        system_prompt = [7, 12, 19, 4, 33, 41, 8, 15, 26, 9, 50, 3, 11, 27, 38, 6, 45, 22, 13, 58] # Above the cache's 16-token minimum.
+        prompts = [system_prompt + [21, 5, 44], system_prompt + [17, 30]] # The second student's turn reuses the first one's prefix.
+
+        def run(prefix_cache):
+            _, scheduler = _tiny_llama_scheduler(model, prefix_cache=prefix_cache)
+            results = [scheduler.submit(prompt, max_new_tokens=8, prefix_len=len(system_prompt)).result(timeout=30) for prompt in prompts]
+            scheduler.shutdown()
+            return results
+
+        without_cache = run(None)
+        prefix_cache = PrefixKVCache(max_entries=4)
+        with_cache = run(prefix_cache)
+        snapshot = prefix_cache.snapshot()
+        print(f"✅ Same replies with the prefix cache: {with_cache == without_cache} (hits: {snapshot['hits']}, misses: {snapshot['misses']})")
+        return with_cache == without_cache and snapshot["hits"] >= 1
+    except Exception as e:
+        print(f"❌ Prefix KV cache failed: {e}")
+        return False
+
+def test_session_kv_cache():
+    """Test that a session's next turn gives the same reply from its kept KV state as from a full prefill"""
+    print("🔄 Testing session KV cache reuse...")
+    try:
+        from kv_cache import SessionKVCache
+
+        model = _tiny_llama()
+        first_turn = [7, 12, 19, 4, 33, 41, 8, 15, 26, 9, 50, 3, 11, 27, 38, 6, 45, 22, 21, 5]
+
+        def run(session_cache):
+            # The second turn's prompt is the first turn's prompt, its reply and the student's next utterance.
+            _, scheduler = _tiny_llama_scheduler(model, session_cache=session_cache)
+            first_reply = scheduler.submit(first_turn, max_new_tokens=8, session_id="s1").result(timeout=30)
+            second_reply = scheduler.submit(first_turn + first_reply + [17, 30, 44], max_new_tokens=8, session_id="s1").result(timeout=30)
+            scheduler.shutdown()
+            return [first_reply, second_reply]
+
+        without_cache = run(None)
+        session_cache = SessionKVCache(idle_timeout_s=60)
+        with_cache = run(session_cache)
+        snapshot = session_cache.snapshot()
+        print(f"✅ Same replies with the session cache: {with_cache == without_cache} (hits: {snapshot['hits']}, sessions: {snapshot['sessions']})")
+        return with_cache == without_cache and snapshot["hits"] >= 1
+    except Exception as e:
+        print(f"❌ Session KV cache failed: {e}")
+        return False
+
+def test_generation_cancellation():
+    """Test that cancelling a turn's token, or passing its deadline, stops its generation with the reason and the partial reply"""
+    print("🔄 Testing generation cancellation...")
+    try:
+        import time
+        from request_cancellation import CancellationToken, GenerationCancelledError
+
+        _, scheduler = _tiny_llama_scheduler()
+
+        disconnected, streamed = CancellationToken(), []
+        def on_token(token_id): # The client goes away after its third token.
+            streamed.append(token_id)
+            if len(streamed) == 3:
+                disconnected.cancel("cancelled")
+        cancelled_job = scheduler.submit([5, 9, 11, 3], max_new_tokens=100, on_token=on_token, cancellation=disconnected)
+        expired_job = scheduler.submit([14, 2, 8], max_new_tokens=100, cancellation=CancellationToken(deadline=time.time() - 1))
+        other_job = scheduler.submit([30, 31, 32], max_new_tokens=8)
+
+        outcomes = {}
+        for name, future in (("cancelled", cancelled_job), ("expired", expired_job)):
+            try:
+                future.result(timeout=30)
+                outcomes[name] = ("completed", None)
+            except GenerationCancelledError as e:
+                outcomes[name] = (e.reason, len(e.generated_ids))
+        other_reply = other_job.result(timeout=30)
+        scheduler.shutdown()
+        print(f"✅ Outcomes (reason, partial tokens): {outcomes}; unaffected job generated {len(other_reply)} tokens")
+        return (
+            outcomes["cancelled"][0] == "cancelled" and 3 <= outcomes["cancelled"][1] < 100 and outcomes["expired"][0] == "timed_out"
+            and len(other_reply) == 8 and scheduler.stats["jobs_cancelled"] == 2
+        )
+    except Exception as e:
+        print(f"❌ Generation cancellation failed: {e}")
+        return False
+
+def test_model_registry():
+    """Test that the model registry evicts least-recently-used models over budget"""
+    print("🔄 Testing model registry...")
+    try:
+        from model_registry import ModelRegistry
+
+        registry = ModelRegistry(memory_budget_bytes=2, size_estimator=lambda model: 1)
+        for key in ["a", "b", "a", "c"]:
+            registry.get_or_load(key, lambda: {"model": object(), "tokenizer": None, "device": None})
+        print(f"✅ Model registry holds {registry.keys()} after {registry.stats['evictions']} eviction(s)")
+        return registry.keys() == ["a", "c"] and registry.stats["hits"] == 1
+    except Exception as e:
+        print(f"❌ Model registry failed: {e}")
+        return False
+
+def test_int8_model_loading():
+    """Test that int8 loading quantizes the Linear layers, is accounted smaller than the float copy and still generates"""
+    print("🔄 Testing int8 model loading...")
+    try:
+        import tempfile
+        import torch
+        from model_loader_utils import load_model_tokenizer_with_adapter
+        from model_registry import ModelRegistry
+
+        with tempfile.TemporaryDirectory() as model_dir:
+            _tiny_llama().save_pretrained(model_dir)
+            _tiny_tokenizer().save_pretrained(model_dir)
+            float_model, tokenizer, _ = load_model_tokenizer_with_adapter(model_dir, torch_dtype_str="float32")
+            int8_model, _, int8_device = load_model_tokenizer_with_adapter(model_dir, torch_dtype_str="int8")
+
+        float_linears = [name for name, module in int8_model.named_modules() if type(module) is torch.nn.Linear]
+        quantized_linears = [name for name, module in int8_model.named_modules() if isinstance(module, torch.ao.nn.quantized.dynamic.Linear)]
+        registry = ModelRegistry()
+        for key, model in (("tiny::float32", float_model), ("tiny::int8", int8_model)):
+            registry.get_or_load(key, lambda model=model: {"model": model, "tokenizer": tokenizer, "device": int8_device})
+        sizes = {entry["key"]: entry["size_bytes"] for entry in registry.snapshot()["entries"]}
+        prompt_ids = tokenizer("w5 w9 w11 w3 w7", return_tensors="pt").input_ids
+        with torch.no_grad():
+            reply = int8_model.generate(prompt_ids, max_new_tokens=8, do_sample=False, eos_token_id=None, pad_token_id=tokenizer.pad_token_id)[0, prompt_ids.shape[1]:].tolist()
+        print(f"✅ {len(quantized_linears)} Linear layers quantized, {len(float_linears)} left in float; sizes {sizes}; int8 reply {reply}")
+        return (
+            int8_device.type == "cpu" and quantized_linears and not float_linears and sizes["tiny::int8"] < sizes["tiny::float32"] / 2
+            and registry.stats["bytes_in_use"] == sum(sizes.values()) and len(reply) == 8 and all(0 <= token < 64 for token in reply)
+        )
+    except Exception as e:
+        print(f"❌ int8 model loading failed: {e}")
+        return False
+
+def test_assisted_decoding():
+    """Test that greedy assisted decoding with a draft model matches plain greedy output, and the no-draft / other-vocabulary fallbacks"""
+    print("🔄 Testing assisted decoding...")
+    try:
+        import tempfile
+        import torch
+        import aita_interaction_service as service
+        from model_loader_utils import DummySLM, assisted_generation_kwargs
+        from model_registry import ModelRegistry
+
+        target, tokenizer = _tiny_llama(), _tiny_tokenizer()
+        other_vocab_tokenizer = _tiny_tokenizer()
+        other_vocab_tokenizer.add_tokens(["extra"])
+        with tempfile.TemporaryDirectory() as draft_dir, tempfile.TemporaryDirectory() as other_vocab_dir:
+            for directory, draft_tokenizer in ((draft_dir, tokenizer), (other_vocab_dir, other_vocab_tokenizer)):
+                _tiny_llama(seed=1, num_hidden_layers=1).save_pretrained(directory)
+                draft_tokenizer.save_pretrained(directory)
+            patches = {"DRAFT_MODEL_CONFIG": {"reading": draft_dir, "ecology": other_vocab_dir}, "MODEL_REGISTRY": ModelRegistry()}
+            originals = {name: getattr(service, name) for name in patches}
+            try:
+                for name, value in patches.items():
+                    setattr(service, name, value)
+                assisted = service.get_assisted_generation_kwargs("reading", tokenizer)
+                other_vocab = service.get_assisted_generation_kwargs("ecology", tokenizer)
+                no_draft = service.get_assisted_generation_kwargs("math", tokenizer)
+            finally:
+                for name, value in originals.items():
+                    setattr(service, name, value)
+
+        prompt_ids, draft_calls = torch.tensor([[5, 9, 11, 3, 7, 21, 8]]), []
+        assisted["assistant_model"].register_forward_hook(lambda module, inputs, outputs: draft_calls.append(True))
+        with torch.no_grad():
+            plain = target.generate(prompt_ids, max_new_tokens=12, do_sample=False)[0].tolist()
+            with_draft = target.generate(prompt_ids, max_new_tokens=12, do_sample=False, **assisted)[0].tolist()
+        dummy_draft = assisted_generation_kwargs(DummySLM(device=torch.device("cpu"), tokenizer=None), None, tokenizer)
+        print(f"✅ Assisted output matches plain greedy: {with_draft == plain} ({len(draft_calls)} draft forward passes); no draft: {no_draft}; other vocabulary passes tokenizers: {sorted(other_vocab)}")
+        return (
+            "assistant_model" in assisted and "assistant_tokenizer" not in assisted and with_draft == plain and bool(draft_calls)
+            and no_draft == {} and dummy_draft == {} and other_vocab.get("assistant_tokenizer") is not None and other_vocab.get("tokenizer") is tokenizer
+        )
+    except Exception as e:
+        print(f"❌ Assisted decoding failed: {e}")
+        return False
+
+def test_response_cache():
+    """Test that the response cache matches exact questions only, and fuzzy matches never change numbers or negations"""
+    print("🔄 Testing response cache...")
+    try:
+        from response_cache import ResponseCache
+
+        exact = ResponseCache()
+        exact.put("ctx", "What's the story about?", "A lost kitten.")
+        exact_hit = exact.get("ctx", "whats the   STORY about") is not None
+        reworded_miss = exact.get("ctx", "what is the story about") is None
+
+        fuzzy = ResponseCache(similarity_threshold=0.8)
+        for question in ["is the kitten lost?", "what happens in chapter 1", "12 + 5", "what is the story about?"]:
+            fuzzy.put("ctx", question, f"answer to {question}")
+        different_questions = ["is the kitten not lost?", "what happens in chapter 2", "12 + 6", "12 - 5"]
+        wrong_hits = [question for question in different_questions if fuzzy.get("ctx", question) is not None]
+        typo_hit = fuzzy.get("ctx", "what is the stroy about")
+        print(f"✅ Exact hit: {exact_hit}; reworded miss: {reworded_miss}; fuzzy hits on different questions: {wrong_hits}; typo hit: {typo_hit is not None}")
+        return exact_hit and reworded_miss and not wrong_hits and typo_hit is not None and typo_hit["response"] == "answer to what is the story about?"
+    except Exception as e:
+        print(f"❌ Response cache failed: {e}")
+        return False
+
+def test_inference_executor():
+    """Test that blocking work run through the inference executor leaves the event loop responsive"""
+    print("🔄 Testing inference executor...")
+    try:
+        import asyncio
+        import time
+        from inference_executor import InferenceExecutor
+
+        def blocking_stage(seconds):
+            time.sleep(seconds)
+            return "generated"
+
+        async def run_with_ticker(executor):
+            ticks = 0
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            ticking = asyncio.ensure_future(ticker())
+            results = await asyncio.gather(*(executor.run(blocking_stage, 0.2) for _ in range(2)))
+            ticking.cancel()
+            return results, ticks
+
+        executor = InferenceExecutor(mode="thread", max_workers=2)
+        start = time.perf_counter()
+        results, ticks = asyncio.run(run_with_ticker(executor))
+        elapsed = time.perf_counter() - start
+        executor.shutdown()
+        print(f"✅ {results} in {elapsed:.2f}s; event loop ticked {ticks} times meanwhile")
+        return results == ["generated", "generated"] and ticks >= 5 and elapsed < 0.35 and executor.stats["tasks_submitted"] == 2
+    except Exception as e:
+        print(f"❌ Inference executor failed: {e}")
+        return False
+
+def test_interaction_load_benchmark():
+    """Test that the load test's simulated students grow their history, retry 503s and are summarized by percentile"""
+    print("🔄 Testing interaction load benchmark...")
+    try:
+        import asyncio
+        import json
+        import random
+        import httpx
+        from benchmark_interaction_load import build_report, percentile, run_student
+
+        sent = []
+        def handle(request):
+            payload = json.loads(request.content)
+            sent.append(payload)
+            if len(sent) == 1: # The first attempt is rejected by admission control.
+                return httpx.Response(503, headers={"Retry-After": "0"}, json={"detail": "busy"})
+            return httpx.Response(200, json={"aita_response": f"reply {len(sent)}", "debug_info": {"stage_seconds": {"generation": 0.1 * len(sent)}}})
+
+        async def simulate():
+            samples = []
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handle), base_url="http://loadtest") as client:
+                await run_student(client, 0, turns=3, think_time_s=0.0, rng=random.Random(0), samples=samples, max_retries=1)
+            return samples
+
+        samples = asyncio.run(simulate())
+        report = build_report(samples, wall_seconds=1.0)
+        history_lengths = [len(payload["conversation_history"]) for payload in sent]
+        print(f"✅ History per attempt: {history_lengths}; rejected attempts: {report['rejected_attempts']}; generation p50: {report['stage_seconds']['generation']['p50']}")
+        return (
+            history_lengths == [0, 0, 2, 4] and report["successful_requests"] == 3 and report["rejected_attempts"] == 1 and not report["errors"]
+            and report["stage_seconds"]["generation"]["p50"] == 0.3 and percentile([1, 2, 3, 4], 50) == 2 and percentile([1, 2, 3, 4], 99) == 4
+        )
+    except Exception as e:
+        print(f"❌ Interaction load benchmark failed: {e}")
+        return False
+
+def test_service_readiness():
+    """Test that startup components report loading -> ready/degraded and overall readiness"""
+    print("🔄 Testing service readiness tracking...")
+    try:
+        import asyncio
+        from service_readiness import ReadinessTracker
+
+        async def scenario():
+            tracker = ReadinessTracker()
+            gate = asyncio.Event()
+            async def slow_loader():
+                await gate.wait()
+            async def fallback_loader():
+                return "degraded"
+            tracker.start("model", slow_loader)
+            tracker.start("moderation", fallback_loader, after=["model"])
+            await asyncio.sleep(0)
+            loading = tracker.snapshot()
+            gate.set()
+            moderation_state = await tracker.wait("moderation")
+            return loading, moderation_state, tracker.snapshot()
+
+        loading, moderation_state, final = asyncio.run(scenario())
+        print(f"✅ Readiness went from {loading['ready']} to {final['ready']} ({ {k: v['state'] for k, v in final['components'].items()} })")
+        return (not loading["ready"] and loading["components"]["model"]["state"] == "loading"
+                and moderation_state == "degraded" and final["ready"])
+    except Exception as e:
+        print(f"❌ Service readiness failed: {e}")
+        return False
+
+def test_moderation_unavailable():
+    """Test that a turn waiting on a moderation component that failed to load gets the dummy verdict instead of an error"""
+    print("🔄 Testing moderation after a failed load...")
+    try:
+        import asyncio
+        import aita_interaction_service as service
+        from service_readiness import ReadinessTracker
+
+        tracker = ReadinessTracker()
+        tracker.mark("moderation", "failed", detail="inference runtime import failed")
+        patches = {"SERVICE_READINESS": tracker, "MODERATION_PREFILTER": None, "moderation_service": None}
+        originals = {name: getattr(service, name) for name in patches}
+        try:
+            for name, value in patches.items():
+                setattr(service, name, value)
+            verdict = asyncio.run(service.run_moderation("why was lily scared?"))
+        finally:
+            for name, value in originals.items():
+                setattr(service, name, value)
+        print(f"✅ Verdict with moderation failed: {verdict}")
+        return verdict["is_safe"] and verdict["model_used"] == "dummy_moderation_unavailable"
+    except Exception as e:
+        print(f"❌ Moderation after a failed load failed: {e}")
+        return False
+
+def test_shared_weights():
+    """Test that a second model picks up the exported, memory-mapped weights of the first"""
+    print("🔄 Testing shared weights...")
+    try:
+        import tempfile
+        import torch
+        from shared_weights import load_shared_base_weights
+
+        with tempfile.TemporaryDirectory() as shared_dir:
+            first, second = _tiny_llama(seed=0), _tiny_llama(seed=1)
+            shared_bytes = load_shared_base_weights(first, "tiny/llama", "float32", shared_dir)
+            load_shared_base_weights(second, "tiny/llama", "float32", shared_dir)
+            input_ids = torch.tensor([[1, 2, 3]])
+            with torch.no_grad():
+                same_output = torch.equal(first(input_ids).logits, second(input_ids).logits)
+        print(f"✅ Shared {shared_bytes} bytes of weights; outputs match: {same_output}")
+        return shared_bytes > 0 and same_output
+    except Exception as e:
+        print(f"❌ Shared weights failed: {e}")
+        return False
+
+def test_inference_backends():
+    """Test that the ONNX Runtime backend matches the PyTorch model and DummySLM still answers"""
+    print("🔄 Testing inference backends...")
+    try:
+        import importlib.util
+        import tempfile
+        import torch
+        from model_loader_utils import DummySLM
+
+        prompt = torch.tensor([[1, 5, 9, 14, 3]])
+        dummy_output = DummySLM(device=torch.device("cpu"), tokenizer=None).generate(prompt, max_new_tokens=10, eos_token_id=2, pad_token_id=0)
+        if importlib.util.find_spec("onnxruntime") is None or importlib.util.find_spec("onnx") is None:
+            print("⚠️ onnxruntime/onnx not installed, skipping the ONNX parity check")
+            return dummy_output.shape[1] > prompt.shape[1]
+
+        from inference_backends import OnnxRuntimeCausalLM, export_onnx_causal_lm
+        model = _tiny_llama()
+        with tempfile.TemporaryDirectory() as export_dir:
+            onnx_model = OnnxRuntimeCausalLM(export_onnx_causal_lm(model, f"{export_dir}/tiny"))
+            with torch.no_grad():
+                hf_ids = model.generate(prompt, max_new_tokens=12, do_sample=False, eos_token_id=None, pad_token_id=0)[0].tolist()
+            onnx_ids = onnx_model.generate(prompt, max_new_tokens=12, do_sample=False, eos_token_id=None, pad_token_id=0)[0].tolist()
+        print(f"✅ ONNX Runtime output matches PyTorch: {hf_ids == onnx_ids}")
+        return hf_ids == onnx_ids and dummy_output.shape[1] > prompt.shape[1]
+    except Exception as e:
+        print(f"❌ Inference backends failed: {e}")
+        return False
+
+def test_interact_stream_endpoint():
+    """Test that POST /interact/stream sends the reply as incremental token events followed by one done event"""
+    print("🔄 Testing /interact/stream server-sent events...")
+    try:
+        import asyncio
+        import json
+        import httpx
+        import aita_interaction_service as service
+
+        reply = "Lily was scared because she was lost. She missed her home and her family a lot."
+
+        async def generate(persona_id, prompt_ids, on_token=None, cancellation=None, **kwargs): # One token per character.
+            for char in reply:
+                on_token(ord(char))
+                await asyncio.sleep(0.001)
+            return [ord(char) for char in reply]
+
+        async def prepared(turn, request, timer):
+            prompt = asyncio.get_running_loop().create_future()
+            prompt.set_result(("prompt", [1, 2, 3], "stub_model", 0, {}))
+            return {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": "stub"}, None, prompt
+
+        async def safe_moderation(text):
+            return {"is_safe": True, "flagged_categories": [], "scores": {"toxic": 0.01}, "model_used": "stub"}
+
+        class CharTokenizer:
+            def decode(self, ids, skip_special_tokens=True):
+                return "".join(chr(i) for i in ids)
+
+        async def post_stream():
+            transport = httpx.ASGITransport(app=service.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                response = await client.post("/interact/stream", json={"user_id": "student001", "user_utterance": "why was lily scared?", "session_id": "sse_test"})
+            return response
+
+        patches = {
+            "moderate_input_while_preparing": prepared, "generate_response_ids": generate, "run_moderation": safe_moderation,
+            "get_model_and_tokenizer_for_persona": lambda persona_id, base_model_id: (None, CharTokenizer(), None),
+            "decode_response": lambda persona_id, ids: "".join(chr(i) for i in ids).strip(), "OUTPUT_MODERATION_CHUNK_CHARS": 20,
+        }
+        originals = {name: getattr(service, name) for name in patches}
+        try:
+            for name, value in patches.items():
+                setattr(service, name, value)
+            response = asyncio.run(post_stream())
+        finally:
+            for name, value in originals.items():
+                setattr(service, name, value)
+        events = [json.loads(block[len("data: "):]) for block in response.text.split("\n\n") if block.startswith("data: ")]
+        types = [event["type"] for event in events]
+        streamed = "".join(event["text"] for event in events if event["type"] == "token")
+        print(f"✅ {response.status_code} {response.headers.get('content-type')}: {types.count('token')} token events, then {types[-1]!r}")
+        return (
+            response.status_code == 200 and response.headers["content-type"].startswith("text/event-stream")
+            and types.count("token") > 1 and types[-1] == "done" and types.count("done") == 1 and "error" not in types
+            and streamed == reply and events[-1]["aita_response"] == reply and events[-1]["session_id"] == "sse_test"
+        )
+    except Exception as e:
+        print(f"❌ /interact/stream events failed: {e}")
+        return False
+
+def test_stream_cancellation_status():
+    """Test that a cancelled streamed turn reports the status of its cancellation reason, not always a timeout"""
+    print("🔄 Testing streamed turn cancellation status...")
+    try:
+        import asyncio
+        import json
+        import time
+        import aita_interaction_service as service
+        from request_cancellation import CancellationToken
+
+        async def error_event(cancellation):
+            request = service.InteractionRequest(user_id="student001", user_utterance="why was lily scared?")
+            turn = service.build_turn_context(request)
+            events = [json.loads(event[len("data: "):]) async for event in service.stream_turn_events(turn, request, cancellation, service.StageTimer(), time.time())]
+            return events[-1]
+
+        cancelled = CancellationToken()
+        cancelled.cancel("cancelled")
+        cancelled_event = asyncio.run(error_event(cancelled))
+        timed_out_event = asyncio.run(error_event(CancellationToken(deadline=time.time() - 1)))
+        print(f"✅ Cancelled: {cancelled_event.get('status_code')}; timed out: {timed_out_event.get('status_code')}")
+        return (cancelled_event["type"] == "error" and cancelled_event["status_code"] == 499 and cancelled_event["reason"] == "cancelled"
+                and timed_out_event["status_code"] == 504 and timed_out_event["reason"] == "timed_out")
+    except Exception as e:
+        print(f"❌ Streamed turn cancellation status failed: {e}")
+        return False
+
+def test_service_storage():
+    """Test username uniqueness, default-context lookup, concurrent writes to both SQLite stores and persistence across a reopen"""
+    print("🔄 Testing service storage...")
+    try:
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import datetime
+        from service_storage import create_stores, UsernameTakenError
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_path = os.path.join(db_dir, "aita.db")
+            users, contexts = create_stores(db_path)
+            users.add({"user_id": "u1", "username": "ada", "grade_level": 4, "preferred_aita_persona_id": None, "created_at": datetime.utcnow()})
+            try:
+                users.add({"user_id": "u2", "username": "ada", "grade_level": 5, "preferred_aita_persona_id": None, "created_at": datetime.utcnow()})
+                duplicate_rejected = False
+            except UsernameTakenError:
+                duplicate_rejected = True
+            contexts.put("student001", "Ecology", "eco_1", {"subject": "Ecology"})
+            contexts.put("student0012", "Reading", "kitten_1", {"subject": "Reading"})
+            def write_both(i):
+                users.add({"user_id": f"t{i}", "username": f"student{i}", "grade_level": 3, "preferred_aita_persona_id": None, "created_at": datetime.utcnow()})
+                contexts.put(f"t{i}", "Reading", "kitten_1", {"subject": "Reading", "n": i})
+            with ThreadPoolExecutor(max_workers=8) as pool: # Transactions on both stores from many threads at once.
+                list(pool.map(write_both, range(50)))
+            users, contexts = create_stores(db_path) # Reopen, as after a restart.
+            persisted = users.get_by_username("ada") is not None and users.get("u1")["grade_level"] == 4 and len(users) == 51
+            persisted = persisted and all(contexts.get(f"t{i}", "Reading", "kitten_1") == {"subject": "Reading", "n": i} for i in range(50))
+            default_ok = contexts.get_default("student001")[1] == {"subject": "Ecology"} and contexts.get("student0012", "Reading", "kitten_1") is not None
+        print(f"✅ Duplicate rejected: {duplicate_rejected}; persisted: {persisted}; default context: {default_ok}")
+        return duplicate_rejected and persisted and default_ok
+    except Exception as e:
+        print(f"❌ Service storage failed: {e}")
+        return False
+
+def test_admission_control():
+    """Test that queued student turns are admitted before bulk ones and a full queue rejects with Retry-After"""
+    print("🔄 Testing admission control...")
+    try:
+        import asyncio
+        from admission_control import AdmissionController, AdmissionRejectedError
+
+        async def scenario():
+            controller = AdmissionController(max_concurrent=1, max_queue_depth=2)
+            admitted, rejected = [], []
+            async def turn(name, request_class):
+                try:
+                    async with controller.admit(request_class):
+                        admitted.append(name)
+                        await asyncio.sleep(0.01)
+                except AdmissionRejectedError as e:
+                    rejected.append((name, e.reason, e.retry_after_s))
+            tasks = []
+            for name, request_class in [("running", "student"), ("bulk", "bulk"), ("bulk_2", "bulk"), ("student", "student"), ("bulk_3", "bulk")]:
+                tasks.append(asyncio.ensure_future(turn(name, request_class)))
+                await asyncio.sleep(0) # Arrive in this order.
+            await asyncio.gather(*tasks)
+            return admitted, rejected, controller.snapshot()
+
+        admitted, rejected, snapshot = asyncio.run(scenario())
+        ok = admitted == ["running", "student", "bulk"] and sorted(r[:2] for r in rejected) == [("bulk_2", "shed"), ("bulk_3", "queue_full")]
+        ok = ok and all(r[2] >= 1 for r in rejected) and snapshot["in_flight"] == 0 and snapshot["queue_depth"] == 0
+        print(f"✅ Admitted {admitted}; rejected {rejected}")
+        return ok
+    except Exception as e:
+        print(f"❌ Admission control failed: {e}")
+        return False
+
+def test_service_metrics():
+    """Test that histograms, counters and collected component stats render in Prometheus text format, and that retired counters stay monotonic"""
+    print("🔄 Testing service metrics...")
+    try:
+        from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest
+        from service_metrics import ComponentCollector, RetiredTotals, stats_families
+
+        registry = CollectorRegistry()
+        stage_seconds = Histogram("aita_stage_duration_seconds", "Stage latency.", ("stage",), buckets=(0.1, 1.0), registry=registry)
+        stage_seconds.labels(stage="prefill").observe(0.05)
+        stage_seconds.labels(stage="prefill").observe(0.5)
+        Counter("aita_generated_tokens_total", "Tokens.", ("persona",), registry=registry).labels(persona="default_phi3_base").inc(42)
+        # Two schedulers report hits; the first is then evicted and only its retired totals remain.
+        retired = RetiredTotals()
+        schedulers = [{"jobs_completed": 5, "max_observed_batch": 4}, {"jobs_completed": 2, "max_observed_batch": 1}]
+        registry.register(ComponentCollector(lambda: (
+            stats_families("aita_cache", {"cache": "session"}, [{"hits": 3, "misses": 1, "hit_rate": 0.75, "bytes_in_use": 2048}])
+            + stats_families("aita_scheduler", {}, [retired.snapshot("scheduler")] + schedulers)
+        )))
+        text = generate_latest(registry).decode()
+        retired.retire("scheduler", schedulers.pop(0))
+        after_eviction = generate_latest(registry).decode()
+        expected = [
+            'aita_stage_duration_seconds_bucket{le="0.1",stage="prefill"} 1.0',
+            'aita_stage_duration_seconds_bucket{le="+Inf",stage="prefill"} 2.0',
+            'aita_stage_duration_seconds_count{stage="prefill"} 2.0',
+            'aita_generated_tokens_total{persona="default_phi3_base"} 42.0',
+            'aita_cache_bytes_in_use{cache="session"} 2048.0',
+            'aita_cache_events_total{cache="session",event="hits"} 3.0',
+            'aita_scheduler_events_total{event="jobs_completed"} 7.0',
+        ]
+        missing = [line for line in expected if line not in text.splitlines()]
+        monotonic = 'aita_scheduler_events_total{event="jobs_completed"} 7.0' in after_eviction.splitlines()
+        print(f"✅ Rendered {len(text.splitlines())} lines; missing: {missing}; jobs_completed kept after eviction: {monotonic}")
+        return not missing and monotonic and "hit_rate" not in text and "max_observed_batch" not in text
+    except Exception as e:
+        print(f"❌ Service metrics failed: {e}")
+        return False
+
+def test_batch_inference():
+    """Test length-bucketed batch planning, resuming from a partly written output file and the service's system prompt"""
+    print("🔄 Testing batch inference...")
+    try:
+        import tempfile
+        import aita_interaction_service as service
+        from batch_inference import build_system_prompt, plan_batches, read_completed_ids
+
+        batches = plan_batches([5, 40, 12, 38, 6, 11], batch_size=2, max_batch_tokens=78)
+        with tempfile.TemporaryDirectory() as out_dir:
+            output_path = os.path.join(out_dir, "outputs.jsonl")
+            with open(output_path, "w") as f:
+                f.write('{"id": "a"}\n{"id": "b"}\n{"id": "c", "aita_res')
+            completed = read_completed_ids(output_path)
+            with open(output_path) as f:
+                truncated = f.read().endswith("}\n")
+
+        # A record carrying the LMS context of a served turn must get the prompt that turn was served with.
+        turn = service.build_turn_context(service.InteractionRequest(user_id="student001", user_utterance="why was lily scared?"))
+        lms = turn.lms_context
+        record = {
+            "current_item_title": lms["current_passage_title"], "current_item_text_snippet": lms["current_passage_text_snippet"],
+            "target_learning_objectives": lms["target_learning_objectives_for_activity"], "teacher_notes_for_student_on_lo": lms["teacher_notes_for_student_on_lo"],
+        }
+        same_prompt = build_system_prompt(record, turn.persona_id) == turn.system_prompt and "Teacher note" in turn.system_prompt
+        print(f"✅ Batches: {batches}; completed ids: {sorted(completed)}; same system prompt as the service: {same_prompt}")
+        return batches == [[1], [3, 2], [5, 4], [0]] and completed == {"a", "b"} and truncated and same_prompt
+    except Exception as e:
+        print(f"❌ Batch inference failed: {e}")
+        return False
+
+def test_moderation_batcher():
+    """Test that concurrent moderation checks share one batch and each caller gets its own result"""
+    print("🔄 Testing moderation micro-batcher...")
+    try:
+        import asyncio
+        from moderation_batcher import ModerationMicroBatcher
+
+        batches = []
+        async def run_batch(texts):
+            batches.append(list(texts))
+            return [{"is_safe": "idiot" not in text, "flagged_categories": [], "scores": {}, "model_used": "fake"} for text in texts]
+
+        async def run():
+            batcher = ModerationMicroBatcher(run_batch, max_batch_size=8, window_s=0.01)
+            return await asyncio.gather(*(batcher.check_text(text) for text in ["hi", "you idiot", "why?"]))
+        results = asyncio.run(run())
+        print(f"✅ Batches: {batches}; verdicts: {[r['is_safe'] for r in results]}")
+        return batches == [["hi", "you idiot", "why?"]] and [r["is_safe"] for r in results] == [True, False, True]
+    except Exception as e:
+        print(f"❌ Moderation micro-batcher failed: {e}")
+        return False
+
+def test_moderation_cache():
+    """Test that the moderation cache returns stored verdicts and evicts least recently used entries over its size cap"""
+    print("🔄 Testing moderation cache...")
+    try:
+        from moderation_cache import ModerationResultCache, moderation_cache_key, normalize_moderation_text
+
+        verdict = {"is_safe": False, "flagged_categories": ["toxic"], "scores": {"toxic": 0.93}, "model_used": "unitary/toxic-bert"}
+        cache = ModerationResultCache(max_entries=10, max_bytes=900)
+        keys = [moderation_cache_key("unitary/toxic-bert", 0.7, normalize_moderation_text(text, lowercase=True, collapse_whitespace=True)) for text in ["You  IDIOT", "you idiot", "hello", "why?"]]
+        cache.put(keys[0], verdict)
+        hit = cache.get(keys[1])
+        cache.put(keys[2], {**verdict, "is_safe": True})
+        cache.put(keys[3], {**verdict, "is_safe": True}) # Over 900 bytes: the least recently used entry goes.
+        snapshot = cache.snapshot()
+        print(f"✅ Hit equals stored verdict: {hit == verdict}; entries: {snapshot['entries']}, evictions: {snapshot['evictions']}")
+        return hit == verdict and keys[0] == keys[1] and cache.get(keys[0]) is None and snapshot["evictions"] == 1 and snapshot["bytes_in_use"] <= 900
+    except Exception as e:
+        print(f"❌ Moderation cache failed: {e}")
+        return False
+
+def test_moderation_prefilter():
+    """Test that the lexical prefilter blocks blocklisted phrases, allows known-safe phrases and leaves the rest to the model"""
+    print("🔄 Testing moderation prefilter...")
+    try:
+        from moderation_prefilter import LexicalPrefilter
+
+        prefilter = LexicalPrefilter()
+        blocked = prefilter.decide("just go\n  DIE already")
+        allowed = prefilter.decide("Can you give me a HINT?")
+        # Everyday words that combine into bullying must still reach the model.
+        ambiguous = [prefilter.decide(text) for text in ["This story is stupid.", "you ***", "go home no one like you", "no one would like you", "can you give me a hint you idiot"]]
+        print(f"✅ Blocked: {blocked and blocked.get('matched_terms')}; allowed: {allowed is not None and allowed['is_safe']}; ambiguous passed on: {ambiguous.count(None)}/5")
+        return (
+            blocked is not None and not blocked["is_safe"] and blocked["matched_terms"] == ["go die"] and blocked["moderation_tier"] == "lexical"
+            and allowed is not None and allowed["is_safe"] and ambiguous == [None] * 5 and prefilter.stats["passed_to_model"] == 5
+        )
+    except Exception as e:
+        print(f"❌ Moderation prefilter failed: {e}")
+        return False
+
+def test_streaming_output_moderation():
+    """Test that streamed replies are moderated in sentence chunks and the first unsafe chunk is reported at once"""
+    print("🔄 Testing streaming output moderation...")
+    try:
+        import asyncio
+        from moderation_stream import StreamingOutputModerator
+
+        async def fake_check(text):
+            await asyncio.sleep(0)
+            return {"is_safe": "darn" not in text, "flagged_categories": [] if "darn" not in text else ["toxic"], "scores": {"toxic": 0.9 if "darn" in text else 0.1}, "model_used": "fake"}
+
+        async def stream():
+            flagged = []
+            moderator = StreamingOutputModerator(fake_check, max_chunk_chars=60, min_chunk_chars=10, on_flagged=flagged.append)
+            reply = "Lily was scared because she was lost. She missed her home a lot. That darn dog barked at her."
+            for start in range(0, len(reply), 7):
+                moderator.push(reply[start:start + 7])
+                await asyncio.sleep(0)
+            chunks_started = len(moderator._checks)
+            return await moderator.finish(reply), flagged, chunks_started
+
+        result, flagged, chunks_started = asyncio.run(stream())
+        print(f"✅ Chunks checked while streaming: {chunks_started}; merged verdict safe: {result['is_safe']}; flagged early: {len(flagged)}")
+        return chunks_started == 2 and len(flagged) == 1 and not result["is_safe"] and result["chunks"] == 3 and result["scores"]["toxic"] == 0.9
+    except Exception as e:
+        print(f"❌ Streaming output moderation failed: {e}")
+        return False
+
+def test_stream_holds_unmoderated_text():
+    """Test that /interact/stream only sends text whose chunk passed moderation, and never the flagged chunk"""
+    print("🔄 Testing that streamed text waits for output moderation...")
+    try:
+        import asyncio
+        import json
+        import time
+        import aita_interaction_service as service
+        from request_cancellation import GenerationCancelledError
+
+        class CharTokenizer: # One token per character.
+            def decode(self, ids, skip_special_tokens=True):
+                return "".join(chr(i) for i in ids)
+
+        async def slow_moderation(text): # Stubbed moderator: flags "darn", and takes a while like the classifier.
+            await asyncio.sleep(0.05)
+            return {"is_safe": "darn" not in text, "flagged_categories": ["toxic"] if "darn" in text else [], "scores": {"toxic": 0.9 if "darn" in text else 0.1}, "model_used": "stub"}
+
+        def stream_reply(reply):
+            async def generate(persona_id, prompt_ids, on_token=None, cancellation=None, **kwargs):
+                ids = []
+                for char in reply:
+                    if cancellation is not None and cancellation.is_cancelled():
+                        raise GenerationCancelledError(cancellation.reason, ids)
+                    ids.append(ord(char))
+                    on_token(ord(char))
+                    await asyncio.sleep(0.002)
+                return ids
+
+            async def prepared(turn, request, timer):
+                prompt = asyncio.get_running_loop().create_future()
+                prompt.set_result(("prompt", [1, 2, 3], "stub_model", 0, {}))
+                return {"is_safe": True, "flagged_categories": [], "scores": {}, "model_used": "stub"}, None, prompt
+
+            async def collect():
+                request = service.InteractionRequest(user_id="student001", user_utterance="tell me about the dog")
+                turn = service.build_turn_context(request)
+                cancellation = service.CancellationToken.with_timeout(30)
+                return [json.loads(event[len("data: "):]) async for event in service.stream_turn_events(turn, request, cancellation, service.StageTimer(), time.time())]
+
+            patches = {
+                "moderate_input_while_preparing": prepared, "generate_response_ids": generate, "run_moderation": slow_moderation,
+                "get_model_and_tokenizer_for_persona": lambda persona_id, base_model_id: (None, CharTokenizer(), None),
+                "decode_response": lambda persona_id, ids: "".join(chr(i) for i in ids).strip(), "OUTPUT_MODERATION_CHUNK_CHARS": 40,
+            }
+            originals = {name: getattr(service, name) for name in patches}
+            try:
+                for name, value in patches.items():
+                    setattr(service, name, value)
+                events = asyncio.run(collect())
+            finally:
+                for name, value in originals.items():
+                    setattr(service, name, value)
+            return "".join(event["text"] for event in events if event["type"] == "token"), events[-1]
+
+        unsafe_reply = "Lily was scared because she was lost. She missed her home a lot. That darn dog barked at her all night long."
+        streamed, done = stream_reply(unsafe_reply)
+        safe_reply = "Lily was scared because she was lost. She missed her home a lot. Then she found her way back."
+        safe_streamed, safe_done = stream_reply(safe_reply)
+        print(f"✅ Streamed before the flagged chunk: {streamed!r}; flagged text sent: {'darn' in streamed}; safe reply streamed whole: {safe_streamed == safe_reply}")
+        return (
+            "darn" not in streamed and streamed.startswith("Lily was scared") and done["type"] == "done" and done["debug_info"]["output_moderation_triggered"]
+            and safe_streamed == safe_reply and not safe_done["debug_info"]["output_moderation_triggered"]
+        )
+    except Exception as e:
+        print(f"❌ Streamed text moderation failed: {e}")
+        return False
+
+def test_moderation_onnx():
+    """Test that the ONNX Runtime moderation classifier returns the pipeline's scores"""
+    print("🔄 Testing ONNX moderation classifier...")
+    try:
+        import importlib.util
+        import tempfile
+        if importlib.util.find_spec("onnxruntime") is None or importlib.util.find_spec("onnx") is None:
+            print("⚠️ onnxruntime/onnx not installed, skipping the ONNX moderation check")
+            return True
+
+        import torch
+        from transformers import BertConfig, BertForSequenceClassification, BertTokenizer, pipeline
+        from moderation_onnx import OnnxTextClassifier, export_onnx_text_classifier
+
+        texts = ["why was lily scared?", "you are an idiot and i hate this story", "ok"]
+        with tempfile.TemporaryDirectory() as model_dir:
+            with open(os.path.join(model_dir, "vocab.txt"), "w") as f:
+                f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "?"] + sorted({word for text in texts for word in text.replace("?", "").split()})))
+            tokenizer = BertTokenizer(os.path.join(model_dir, "vocab.txt"))
+            labels = {0: "toxic", 1: "insult", 2: "threat"}
+            torch.manual_seed(0)
+            model = BertForSequenceClassification(BertConfig(
+                vocab_size=tokenizer.vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+                id2label=labels, label2id={label: i for i, label in labels.items()}, problem_type="multi_label_classification"
+            )).eval()
+            reference = pipeline("text-classification", model=model, tokenizer=tokenizer, top_k=None)(texts)
+            classifier = OnnxTextClassifier(export_onnx_text_classifier(model, tokenizer, os.path.join(model_dir, "onnx")), tokenizer, model.config)
+            onnx_output = classifier(texts, batch_size=2)
+        max_diff = max(abs(ref["score"] - out["score"]) for ref_row, out_row in zip(reference, onnx_output) for ref, out in zip(ref_row, out_row))
+        same_order = all([item["label"] for item in ref_row] == [item["label"] for item in out_row] for ref_row, out_row in zip(reference, onnx_output))
+        print(f"✅ ONNX scores match the pipeline: max difference {max_diff:.2e}, same label order: {same_order}")
+        return same_order and max_diff < 1e-4
+    except Exception as e:
+        print(f"❌ ONNX moderation classifier failed: {e}")
+        return False
+
+def test_moderation_windows():
+    """Test that long texts are moderated in overlapping windows, stopping at the first unsafe one"""
+    print("🔄 Testing windowed moderation of long texts...")
+    try:
+        import tempfile
+        import torch
+        from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+        from moderation_service import ModerationService
+
+        words = ["lily", "was", "lost", "in", "the", "woods", "and", "felt", "scared", "until", "she", "found", "her", "way", "home"]
+        text = " ".join(words[i % len(words)] for i in range(120)) + "."
+        with tempfile.TemporaryDirectory() as model_dir:
+            with open(os.path.join(model_dir, "vocab.txt"), "w") as f:
+                f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "."] + sorted(set(words))))
+            tokenizer = BertTokenizerFast(os.path.join(model_dir, "vocab.txt"))
+            labels = {0: "toxic", 1: "insult"}
+            torch.manual_seed(0)
+            BertForSequenceClassification(BertConfig(
+                vocab_size=tokenizer.vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+                id2label=labels, label2id={label: i for i, label in labels.items()}, problem_type="multi_label_classification"
+            )).save_pretrained(model_dir)
+            tokenizer.save_pretrained(model_dir)
+            service = ModerationService(model_dir, window_tokens=16, window_overlap_tokens=4)
+
+            full = service.check_text(text)
+            windows = full.get("windows", [])
+            covered = bool(windows) and windows[0]["start"] == 0 and windows[-1]["end"] == len(text)
+            overlapping = all(later["start"] < earlier["end"] for earlier, later in zip(windows, windows[1:]))
+            max_matches = all(abs(full["scores"][label] - max(window["scores"][label] for window in windows)) < 1e-9 for label in labels.values())
+            print(f"✅ {len(windows)} windows of 16 tokens cover {len(text)} characters: overlapping {overlapping}, max scores {max_matches}")
+
+            service.toxicity_threshold = 0.0 # Every window is unsafe now: the first one decides.
+            flagged = service.check_texts([text, "lily was lost"])[0]
+            print(f"✅ Unsafe text stopped after {len(flagged['windows'])} of {flagged['windows_total']} windows")
+        return (len(windows) == full["windows_total"] > 2 and not full["early_exit"] and covered and overlapping and max_matches
+                and not flagged["is_safe"] and flagged["early_exit"] and len(flagged["windows"]) == 1)
+    except Exception as e:
+        print(f"❌ Windowed moderation failed: {e}")
+        return False
+
 def test_data_manager():
     """Test if data manager works"""
     print("🔄 Testing data manager...")
@@ -88,6 +1042,35 @@ def main():
         ("FastAPI Service", test_fastapi_service),
         ("Streamlit Dashboard", test_streamlit_dashboard),
         ("Model Utilities", test_model_utilities),
+        ("Generation Scheduler", test_generation_scheduler),
+        ("Batched Generation", test_batched_generation_matches_generate),
+        ("Multi-Adapter Scheduling", test_multi_adapter_scheduling),
+        ("Prefix KV Cache", test_prefix_kv_cache),
+        ("Session KV Cache", test_session_kv_cache),
+        ("Generation Cancellation", test_generation_cancellation),
+        ("Model Registry", test_model_registry),
+        ("Int8 Model Loading", test_int8_model_loading),
+        ("Assisted Decoding", test_assisted_decoding),
+        ("Response Cache", test_response_cache),
+        ("Inference Executor", test_inference_executor),
+        ("Interaction Load Benchmark", test_interaction_load_benchmark),
+        ("Service Readiness", test_service_readiness),
+        ("Moderation Unavailable", test_moderation_unavailable),
+        ("Shared Weights", test_shared_weights),
+        ("Inference Backends", test_inference_backends),
+        ("Interact Stream Endpoint", test_interact_stream_endpoint),
+        ("Stream Cancellation Status", test_stream_cancellation_status),
+        ("Service Storage", test_service_storage),
+        ("Admission Control", test_admission_control),
+        ("Service Metrics", test_service_metrics),
+        ("Batch Inference", test_batch_inference),
+        ("Moderation Batcher", test_moderation_batcher),
+        ("Moderation Cache", test_moderation_cache),
+        ("Moderation Prefilter", test_moderation_prefilter),
+        ("Streaming Output Moderation", test_streaming_output_moderation),
+        ("Stream Holds Unmoderated Text", test_stream_holds_unmoderated_text),
+        ("Moderation ONNX", test_moderation_onnx),
+        ("Moderation Windows", test_moderation_windows),
         ("Data Manager", test_data_manager),
     ]
 
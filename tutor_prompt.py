@@ -0,0 +1,19 @@
+# tutor_prompt.py
+"""
+The AITA tutor's system prompt, shared by the Interaction Service (`build_turn_context`) and the
+offline batch runner (batch_inference.py), so adapters are evaluated on the prompt they are served with.
+"""
+from typing import Optional
+
+
+def build_tutor_system_prompt(
+    persona_id: str,
+    passage_title: str = "the current topic",
+    passage_snippet: str = "a relevant educational activity",
+    lo_description: str = "the learning goal",
+    grade_level: Optional[int] = None,
+    teacher_note: str = ""
+) -> str:
+    grade_level_info = f" The student is in grade {grade_level}." if grade_level else ""
+    teacher_note_info = f'Teacher note: "{teacher_note}" ' if teacher_note else ''
+    return f"You are {persona_id}, a helpful AI Tutor.{grade_level_info} You are discussing '{passage_title}' related to the learning objective: '{lo_description}'. Passage snippet: \"{passage_snippet}\". {teacher_note_info}Respond clearly, concisely, and age-appropriately. Guide the student; don't just give answers."